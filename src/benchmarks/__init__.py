@@ -0,0 +1,6 @@
+"""
+Benchmark suite measuring bootstrap, dispatching and scheduling at scale on synthetic configurations built from
+fake drivers. Run from the src directory:
+
+    python -m benchmarks --devices 10,100,1000 --output results.json --baseline baseline.json
+"""
@@ -0,0 +1,126 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from typing import List
+
+from .configs import generate_config, write_config
+from .scenarios import SCENARIOS, HIGHER_IS_BETTER, LOWER_IS_BETTER
+
+DEFAULT_DEVICES = '10,100,1000'
+DEFAULT_TOLERANCE = 0.2
+CHILD_TIMEOUT = 600
+
+
+def run_child(scenario: str, devices_count: int, runtime: str, **options):
+    """
+    Runs single scenario in the current process and prints result as JSON. Every scenario is executed in its own
+    process so peak RSS and leftover threads of one run don't affect another
+    """
+    logging.basicConfig(level=logging.ERROR)
+    result = SCENARIOS[scenario](devices_count, runtime, **options)
+    sys.stdout.write(json.dumps(result) + '\n')
+    sys.stdout.flush()
+    os._exit(0)  # Don't wait for daemon threads of the application
+
+
+def run_suite(scenarios: List[str], sizes: List[int], runtime: str, gpio_pins: str = None) -> dict:
+    results = []
+    for scenario in scenarios:
+        for devices_count in sizes:
+            print('Running {} with {} devices ({})...'.format(scenario, devices_count, runtime), file=sys.stderr)
+            command = [sys.executable, '-m', 'benchmarks', '--child', scenario, '--devices', str(devices_count),
+                       '--runtime', runtime]
+            if gpio_pins:
+                command += ['--gpio-pins', gpio_pins]
+            output = subprocess.check_output(command, timeout=CHILD_TIMEOUT)
+            results.append({
+                'scenario': scenario,
+                'devices': devices_count,
+                'metrics': json.loads(output.decode('utf-8').strip().splitlines()[-1])
+            })
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'runtime': runtime,
+        'results': results
+    }
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    :param tolerance: allowed relative degradation, e.g. 0.2 means 20%
+    :return: descriptions of metrics which are worse than baseline by more than tolerance
+    """
+    regressions = []
+    baseline_results = {(r['scenario'], r['devices']): r['metrics'] for r in baseline.get('results', [])}
+    for result in current['results']:
+        reference = baseline_results.get((result['scenario'], result['devices']))
+        if reference is None:
+            continue
+        for metric, value in result['metrics'].items():
+            base = reference.get(metric)
+            if not base or value is None:
+                continue
+            if metric in HIGHER_IS_BETTER:
+                degradation = (base - value) / base
+            elif metric in LOWER_IS_BETTER:
+                degradation = (value - base) / base
+            else:
+                continue
+            if degradation > tolerance:
+                regressions.append('{}[{} devices].{}: {:.3f} -> {:.3f} ({:+.0%})'.format(
+                    result['scenario'], result['devices'], metric, base, value, degradation))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Runs benchmark suite')
+    parser.add_argument('--devices', default=DEFAULT_DEVICES, help='Comma separated list of device counts')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma separated list of scenarios')
+    parser.add_argument('--runtime', default='threaded', help='Application runtime: threaded or asyncio')
+    parser.add_argument('--output', help='File to write JSON results to. Printed to stdout if not set')
+    parser.add_argument('--baseline', help='JSON results of the previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Allowed relative degradation against baseline')
+    parser.add_argument('--gpio-pins', help='Comma separated pins to benchmark hardware GPIO backends on. '
+                                            'Pins are switched during the benchmark, so nothing should be connected')
+    parser.add_argument('--dump-config', help='Write generated YAML config for the first device count and exit')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.devices.split(',')]
+
+    if args.child:
+        run_child(args.child, sizes[0], args.runtime, gpio_pins=args.gpio_pins)
+    if args.dump_config:
+        write_config(generate_config(sizes[0], args.runtime), args.dump_config)
+        return
+    scenarios = args.scenarios.split(',')
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error('Unknown scenarios: {}. Available: {}'.format(unknown, list(SCENARIOS)))
+
+    results = run_suite(scenarios, sizes, args.runtime, args.gpio_pins)
+    serialized = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(serialized + '\n')
+    else:
+        print(serialized)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import yaml
+
+BUS_NAME = 'bus'
+GROUP_SIZE = 3  # Button, lamp and thermometer
+GESTURE_START_DELAY = 200  # Milliseconds. Gives main loop time to start before the first gesture
+
+
+def generate_config(devices_count: int, runtime: str = 'threaded') -> dict:
+    """
+    Builds configuration with given number of devices. Devices are organized in groups: button toggling the lamp,
+    lamp pushing its state to the bus and thermometer. Single communication bus is shared by all groups.
+    :return: configuration dictionary in the same form as parsed config.yaml
+    """
+    devices = {
+        BUS_NAME: {'module_name': 'CommunicationBus', 'server_address': '127.0.0.1',
+                   'acl': {'mode': 'restrictive', 'allow': ['#lamp_*.toggle']}}
+    }
+    for i in range((max(devices_count - 1, GROUP_SIZE)) // GROUP_SIZE):
+        devices['button_{}'.format(i)] = {'module_name': 'Button', 'gpio': 2 * i,
+                                          'pipe': {'click': '#lamp_{}.toggle'.format(i)}}
+        devices['lamp_{}'.format(i)] = {'module_name': 'PowerKey', 'gpio': 2 * i + 1,
+                                        'pipe': {'state_changed': '#{}.push_state'.format(BUS_NAME)}}
+        devices['thermometer_{}'.format(i)] = {'module_name': '1wireThermometer', 'device_id': '28-00018370300f',
+                                               'update_interval': 60000,
+                                               'pipe': {'state_changed': '#{}.push_state'.format(BUS_NAME)}}
+    return {
+        'instance': {'id': 'benchmark', 'runtime': runtime},
+        'drivers': [
+            'unix.drivers.FakeGPIODriver',
+            'unix.drivers.FakeWireDriver',
+            'benchmarks.drivers.LoopbackDataChannelDriver'
+        ],
+        'devices': devices
+    }
+
+
+def generate_gesture_config(devices_count: int, runtime: str = 'threaded', repeats: int = 3, bounce: int = 0,
+                            edges: bool = True) -> dict:
+    """
+    Same as generate_config but every button recognizes all the gestures and is driven by simulated waveform
+    consisting of click, double click and long click repeated given number of times. Clicks toggle the lamp,
+    double clicks turn it on and long clicks turn it off, so every recognized gesture produces exactly one write.
+    :param edges: simulated inputs report transitions, otherwise buttons have to poll them
+    """
+    config = generate_config(devices_count, runtime)
+    script = [{gesture: {'bounce': bounce}} for gesture in ('click', 'double_click', 'long_click')] * repeats
+    pins = {}
+    for i in range(groups_count(config)):
+        button = config['devices']['button_{}'.format(i)]
+        button.update({'handle_long_click': True, 'handle_double_click': True, 'pipe': {
+            'click': '#lamp_{}.toggle'.format(i),
+            'double_click': '#lamp_{}.on'.format(i),
+            'long_click': '#lamp_{}.off'.format(i),
+        }})
+        pins[button['gpio']] = {'start': GESTURE_START_DELAY, 'script': script}
+    config['drivers'][0] = {'class': 'unix.simulation.SimulationGPIODriver', 'seed': 1, 'edges': edges,
+                            'pins': pins}
+    return config
+
+
+def groups_count(config: dict) -> int:
+    return sum(1 for name in config['devices'] if name.startswith('button_'))
+
+
+def write_config(config: dict, file_name: str):
+    with open(file_name, 'w') as f:
+        yaml.safe_dump(config, f, default_flow_style=False)
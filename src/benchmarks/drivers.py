@@ -0,0 +1,41 @@
+from common.drivers import DataChannelDriver
+
+
+class LoopbackDataChannelDriver(DataChannelDriver):
+    """
+    Stand-in for MQTT driver. Channels are always connected, sent messages are only counted and incoming messages
+    can be injected with receive()
+    """
+
+    class Message(object):
+        def __init__(self, topic: str, payload: bytes):
+            self.topic = topic
+            self.payload = payload
+
+    class LoopbackChannel(DataChannelDriver.Channel):
+        def __init__(self, connection_options: dict):
+            super().__init__(connection_options)
+            self.sent_count = 0
+            self.errors_count = 0
+
+        def is_connected(self) -> bool:
+            return True
+
+        def send(self, destination: str, data):
+            self.sent_count += 1
+
+        def receive(self, topic: str, payload: str):
+            # Errors are counted instead of being raised the same way MQTT driver only logs them
+            try:
+                self.on_data_received(LoopbackDataChannelDriver.Message(topic, payload.encode('utf-8')))
+            except Exception:
+                self.errors_count += 1
+
+    def __init__(self):
+        super().__init__()
+        self.channels = []
+
+    def new_channel(self, connection_options: dict) -> LoopbackChannel:
+        channel = LoopbackDataChannelDriver.LoopbackChannel(connection_options)
+        self.channels.append(channel)
+        return channel
@@ -0,0 +1,367 @@
+import gc
+import functools
+import os
+import shutil
+import tempfile
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+from typing import Callable, Dict, List
+
+from common.bootstrap import bootstrap
+from common.core import ApplicationManager
+from common.drivers import GPIODriver
+from common.model import InternalEvent, BackgroundTask
+from modules.button import EVENT_CLICK
+from unix.drivers import FakeGPIODriver
+from unix.simulation import GESTURE_CLICK, GESTURE_DOUBLE_CLICK, GESTURE_LONG_CLICK, SimulationGPIODriver
+from .configs import generate_config, generate_gesture_config, groups_count, BUS_NAME
+from .drivers import LoopbackDataChannelDriver
+
+DRAIN_TIMEOUT = 60  # Seconds. Max time to wait for emitted events to be processed
+
+
+def peak_rss_kb() -> int:
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_in_background(application: ApplicationManager) -> threading.Thread:
+    thread = threading.Thread(target=application.main_loop, name='BenchmarkMainLoop', daemon=True)
+    thread.start()
+    return thread
+
+
+def stop(application: ApplicationManager, thread: threading.Thread = None):
+    application.shutdown()
+    if thread is not None:
+        thread.join(DRAIN_TIMEOUT)
+
+
+def bootstrap_time(devices_count: int, runtime: str, **options) -> dict:
+    config = generate_config(devices_count, runtime)
+    started_at = time.perf_counter()
+    application = bootstrap(config)
+    elapsed = time.perf_counter() - started_at
+    result = {
+        'bootstrap_ms': elapsed * 1000,
+        'peak_rss_kb': peak_rss_kb()
+    }
+    stop(application)
+    return result
+
+
+def dispatch(devices_count: int, runtime: str, events: int = 20000, **options) -> dict:
+    """
+    Emits click events of all buttons round-robin. Every click goes through interactive lane to the lamp toggle,
+    lamp state change goes through the bulk lane to the bus
+    """
+    config = generate_config(devices_count, runtime)
+    application = bootstrap(config)
+    thread = run_in_background(application)
+    buttons = [application.get_device_by_name('button_{}'.format(i)) for i in range(groups_count(config))]
+    started_at = time.perf_counter()
+    for i in range(events):
+        application.emit_event(buttons[i % len(buttons)], EVENT_CLICK)
+    latency = __wait_processed(application, 'interactive', events)
+    elapsed = time.perf_counter() - started_at
+    stop(application, thread)
+    return {
+        'events': latency.count,
+        'events_per_sec': latency.count / elapsed,
+        'latency_p50_ms': latency.percentile(50),
+        'latency_p90_ms': latency.percentile(90),
+        'latency_p99_ms': latency.percentile(99),
+        'peak_rss_kb': peak_rss_kb()
+    }
+
+
+def __wait_processed(application: ApplicationManager, lane: str, expected: int):
+    return __wait_observed(application.metrics.histogram('event_latency_ms', lane=lane), expected)
+
+
+def __wait_observed(histogram, expected: int):
+    deadline = time.perf_counter() + DRAIN_TIMEOUT
+    while histogram.count < expected and time.perf_counter() < deadline:
+        time.sleep(0.001)
+    return histogram
+
+
+def allocations(devices_count: int, runtime: str, events: int = 5000, **options) -> dict:
+    """
+    Measures allocation churn of event dispatching and remote action calls with hot-path object recycling enabled
+    and disabled. Every click is dispatched to the lamp which in turn pushes its state to the bus, every remote call
+    is executed by the worker pool
+    """
+    result = {}
+    for suffix, freelist_enabled in (('', True), ('_no_freelist', False)):
+        for k, v in __measure_allocations(devices_count, runtime, events, freelist_enabled).items():
+            result[k + suffix] = v
+    return result
+
+
+def __measure_allocations(devices_count: int, runtime: str, events: int, freelist_enabled: bool) -> dict:
+    freelists = (InternalEvent.freelist, BackgroundTask.freelist)
+    capacities = [f.capacity for f in freelists]
+    if not freelist_enabled:
+        for f in freelists:
+            f.capacity = 0
+            del f.items[:]
+    config = generate_config(devices_count, runtime)
+    application = bootstrap(config)
+    thread = run_in_background(application)
+    buttons = [application.get_device_by_name('button_{}'.format(i)) for i in range(groups_count(config))]
+    bus = application.get_device_by_name(BUS_NAME)
+    lamps = ['{}/lamp_{}/toggle'.format(bus.TOPIC_PREFIX + bus.TOPIC_CMD_SUFFIX, i) for i in range(len(buttons))]
+    executed = application.metrics.histogram('worker_pool_execution_ms', pool='default')
+    # Warm up so freelists, caches and routes are populated
+    for i in range(100):
+        application.emit_event(buttons[i % len(buttons)], EVENT_CLICK)
+    __wait_processed(application, 'interactive', 100)
+
+    collections = [0]
+
+    def on_gc(phase, info):
+        if phase == 'start' and info['generation'] == 0:
+            collections[0] += 1
+
+    allocated_before = sum(f.allocated for f in freelists)
+    gc.callbacks.append(on_gc)
+    tracemalloc.start()
+    for i in range(events):
+        application.emit_event(buttons[i % len(buttons)], EVENT_CLICK)
+        bus.channel.receive(lamps[i % len(lamps)], '')
+    __wait_processed(application, 'interactive', events + 100)
+    __wait_observed(executed, events - bus.channel.errors_count)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc.callbacks.remove(on_gc)
+    allocated = sum(f.allocated for f in freelists) - allocated_before
+    stop(application, thread)
+    for f, capacity in zip(freelists, capacities):
+        f.capacity = capacity
+    return {
+        'hot_objects_per_event': allocated / events,
+        'gc_gen0_per_1k_events': collections[0] * 1000 / events,
+        'peak_traced_kb': peak / 1024
+    }
+
+
+def idle_cpu(devices_count: int, runtime: str, window: float = 3.0, **options) -> dict:
+    """
+    Measures CPU consumed by the whole process while devices are only polled by the main loop
+    """
+    application = bootstrap(generate_config(devices_count, runtime))
+    thread = run_in_background(application)
+    time.sleep(0.5)  # Warm up: let all the devices make their first step
+    cpu_started_at, started_at = time.process_time(), time.perf_counter()
+    time.sleep(window)
+    cpu_time, elapsed = time.process_time() - cpu_started_at, time.perf_counter() - started_at
+    jitter = application.metrics.histogram('main_loop_jitter_ms')
+    stop(application, thread)
+    return {
+        'cpu_percent': cpu_time / elapsed * 100,
+        'jitter_p50_ms': jitter.percentile(50),
+        'jitter_p99_ms': jitter.percentile(99)
+    }
+
+
+def rpc(devices_count: int, runtime: str, calls: int = 20000, **options) -> dict:
+    """
+    Injects remote action calls through the bus channel. Measures lookup of the device and action by name, ACL
+    check and submission of the action to the worker pool
+    """
+    config = generate_config(devices_count, runtime)
+    application = bootstrap(config)
+    bus = application.get_device_by_name(BUS_NAME)
+    channel = bus.channel  # type: LoopbackDataChannelDriver.LoopbackChannel
+    topic_prefix = bus.TOPIC_PREFIX + bus.TOPIC_CMD_SUFFIX
+    lamps = ['{}/lamp_{}/toggle'.format(topic_prefix, i) for i in range(groups_count(config))]
+    started_at = time.perf_counter()
+    for i in range(calls):
+        channel.receive(lamps[i % len(lamps)], '')
+    elapsed = time.perf_counter() - started_at
+    stop(application)
+    return {
+        'calls_per_sec': calls / elapsed,
+        'call_us': elapsed / calls * 1000000,
+        'rejected': channel.errors_count  # Calls over worker pool capacity
+    }
+
+
+def gestures(devices_count: int, runtime: str, repeats: int = 3, bounce: int = 5, edges: bool = True,
+             **options) -> dict:
+    """
+    Replays gesture waveforms on all the buttons simultaneously. Measures how many of the gestures were recognized
+    correctly and latency between completion of the gesture and write to the lamp output
+    :param edges: inputs report timestamped transitions, otherwise buttons poll them
+    """
+    config = generate_gesture_config(devices_count, runtime, repeats, bounce, edges)
+    application = bootstrap(config)
+    gpio = application.get_driver(SimulationGPIODriver.typeid())  # type: SimulationGPIODriver
+    thread = run_in_background(application)
+    groups = groups_count(config)
+    buttons = [config['devices']['button_{}'.format(i)]['gpio'] for i in range(groups)]
+    lamps = [config['devices']['lamp_{}'.format(i)]['gpio'] for i in range(groups)]
+    waveform = gpio.get_channel(buttons[0]).waveform
+    time.sleep((waveform.duration + 1000) / 1000)
+    stop(application, thread)
+
+    expected = {GESTURE_CLICK: 0, GESTURE_DOUBLE_CLICK: 0, GESTURE_LONG_CLICK: 0}
+    for _, gesture in waveform.expected:
+        expected[gesture] += groups
+    actions = {GESTURE_CLICK: 'toggle', GESTURE_DOUBLE_CLICK: 'on', GESTURE_LONG_CLICK: 'off'}
+    result = {'false_positives': 0}
+    for gesture, action in actions.items():
+        recognized = sum(application.metrics.histogram('action_duration_ms', device='lamp_{}'.format(i),
+                                                       action=action).count for i in range(groups))
+        result[gesture + '_accuracy'] = min(recognized, expected[gesture]) / expected[gesture]
+        result['false_positives'] += max(0, recognized - expected[gesture])
+    latencies = sorted(latency for button, lamp in zip(buttons, lamps)
+                       for latency in gpio.input_to_output_latency(button, lamp))
+    for p in (50, 90, 99):
+        result['latency_p{}_ms'.format(p)] = latencies[int(len(latencies) * p / 100)] if latencies else None
+    return result
+
+
+GPIO_BACKENDS = ('fake', 'simulation', 'sysfs', 'opi')
+GPIO_MAX_LINES = 32
+
+
+def gpio_lines(devices_count: int, runtime: str, iterations: int = 2000, gpio_pins: str = None, **options) -> dict:
+    """
+    Compares accessing lines one by one with line group calls for every available GPIO backend. Number of lines is
+    the number of devices capped by GPIO_MAX_LINES. Hardware backends drive real pins, so they are measured only if
+    pins are given explicitly
+    :param gpio_pins: comma separated pins for hardware backends
+    """
+    count = min(devices_count, GPIO_MAX_LINES)
+    backends = [('fake', FakeGPIODriver(), list(range(count))),
+                ('simulation', SimulationGPIODriver(), list(range(count)))]
+    if gpio_pins:
+        pins = gpio_pins.split(',')
+        backends += [('sysfs', __sysfs_driver, [int(p) for p in pins if p.isdigit()]), ('opi', __opi_driver, pins)]
+    result = {'lines': count}
+    for name, driver, pins in backends:
+        try:
+            if callable(driver):
+                driver = driver()
+            # Output channels are readable as well, so the same lines are used for reads and writes
+            channels = [driver.new_channel(pin, GPIODriver.GPIO_MODE_WRITE) for pin in pins]
+        except Exception as e:
+            print('Skipping {} GPIO backend: {}'.format(name, e), file=sys.stderr)
+            continue
+        result.update(__measure_lines(name, channels, driver.new_line_group(channels), iterations))
+    return result
+
+
+def __sysfs_driver() -> GPIODriver:
+    from unix.sysfs.gpio import SysfsGPIODriver
+    driver = SysfsGPIODriver()
+    driver.on_initialized(None)
+    return driver
+
+
+def __opi_driver() -> GPIODriver:
+    from opi.drivers import OpiH3GPIODriver
+    driver = OpiH3GPIODriver()
+    driver.on_initialized(None)
+    return driver
+
+
+def __measure_lines(backend: str, channels: List[GPIODriver.Channel], group: GPIODriver.LineGroup,
+                    iterations: int) -> dict:
+    patterns = ([1] * len(channels), [0] * len(channels))
+
+    def read_each(i):
+        return [channel.read() for channel in channels]
+
+    def write_each(i):
+        for channel, state in zip(channels, patterns[i & 1]):
+            channel.write(state)
+
+    def read_group(i):
+        return group.read()
+
+    def write_group(i):
+        group.write(patterns[i & 1])
+
+    result = {}
+    for metric, call in (('reads', read_each), ('bulk_reads', read_group),
+                         ('writes', write_each), ('bulk_writes', write_group)):
+        started_at = time.perf_counter()
+        for i in range(iterations):
+            call(i)
+        result['{}_{}_per_sec'.format(backend, metric)] = iterations / (time.perf_counter() - started_at)
+    return result
+
+
+def sysfs_io(devices_count: int, runtime: str, iterations: int = 100000, **options) -> dict:
+    """
+    Compares value I/O of sysfs Pin with the text file based access it replaced. Real sysfs is not required: pin
+    files are emulated by regular files on tmpfs, so the result reflects Python overhead rather than kernel GPIO
+    """
+    from unix.sysfs.gpio import Pin, OUTPUT
+    root = tempfile.mkdtemp(prefix='sysfs-gpio-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    try:
+        os.makedirs(os.path.join(root, 'gpio1'))
+        for name in ('value', 'direction'):
+            with open(os.path.join(root, 'gpio1', name), 'w') as f:
+                f.write('0\n')
+
+        class StandInPin(Pin):
+            def _sysfs_gpio_value_path(self):
+                return os.path.join(root, 'gpio%d' % self.number, 'value')
+
+            def _sysfs_gpio_direction_path(self):
+                return os.path.join(root, 'gpio%d' % self.number, 'direction')
+
+        pin = StandInPin(1, OUTPUT)
+        legacy = open(pin._sysfs_gpio_value_path(), 'r+')
+
+        def legacy_read():
+            val = legacy.read()
+            legacy.seek(0)
+            return int(val)
+
+        def legacy_set():
+            legacy.write('1')
+            legacy.seek(0)
+
+        result = {}
+        for metric, call in (('legacy_reads', legacy_read), ('reads', pin.read),
+                             ('legacy_writes', legacy_set), ('writes', pin.set)):
+            started_at = time.perf_counter()
+            for _ in range(iterations):
+                call()
+            result['sysfs_{}_per_sec'.format(metric)] = iterations / (time.perf_counter() - started_at)
+        legacy.close()
+        pin.close()
+        return result
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+SCENARIOS = {
+    'bootstrap': bootstrap_time,
+    'dispatch': dispatch,
+    'idle_cpu': idle_cpu,
+    'rpc': rpc,
+    'gestures': gestures,
+    'gestures_polling': functools.partial(gestures, edges=False),
+    'allocations': allocations,
+    'gpio_lines': gpio_lines,
+    'sysfs_io': sysfs_io,
+}  # type: Dict[str, Callable[..., dict]]
+
+# Direction of improvement for each metric. Metrics not listed here are informational and never compared
+HIGHER_IS_BETTER = ('events_per_sec', 'calls_per_sec', 'click_accuracy', 'double_click_accuracy',
+                    'long_click_accuracy') \
+    + tuple('{}_{}_per_sec'.format(backend, metric) for backend in GPIO_BACKENDS
+            for metric in ('reads', 'bulk_reads', 'writes', 'bulk_writes')) \
+    + ('sysfs_reads_per_sec', 'sysfs_writes_per_sec')
+LOWER_IS_BETTER = ('bootstrap_ms', 'peak_rss_kb', 'latency_p50_ms', 'latency_p99_ms', 'cpu_percent', 'call_us',
+                   'false_positives', 'hot_objects_per_event', 'gc_gen0_per_1k_events', 'peak_traced_kb')
@@ -0,0 +1,300 @@
+import asyncio
+import concurrent.futures
+import logging
+
+from typing import Dict, Callable, List
+
+from common import utils
+from .core import ApplicationManager, ThreadManager, DelayedCall
+from .errors import LifecycleError
+from .model import Module, ActionDef, PipedEvent, BackgroundTask
+
+
+class ModuleAdapter(object):
+    """
+    Exposes both coroutine-based and regular modules through the coroutine interface. Blocking steps of
+    IN_BACKGROUND modules are offloaded to the worker pool of the module so they don't stall the event loop.
+    """
+
+    def __init__(self, device: Module, application: 'AsyncApplicationManager'):
+        self.device = device
+        self.__application = application
+        self.__is_coroutine_step = asyncio.iscoroutinefunction(device.step)
+
+    async def step(self):
+        if self.__is_coroutine_step:
+            await self.device.step()
+        elif self.device.IN_BACKGROUND:
+            await self.__application.run_in_pool(self.device.WORKER_POOL, self.device.step)
+        else:
+            self.device.step()
+
+
+class AsyncThreadManager(ThreadManager):
+    """
+    Runs periodic callbacks on the event loop instead of dedicated threads. Callbacks must not block.
+    """
+
+    class PeriodicCall(object):
+        def __init__(self, name: str):
+            self.name = name
+            self.cancelled = False
+
+        def getName(self):
+            return self.name
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        super().__init__()
+        self.__loop = loop
+        self.__calls = {}  # type: Dict[str, AsyncThreadManager.PeriodicCall]
+        self.__logger = logging.getLogger(self.__class__.__name__)
+
+    def request_thread(self, name, callback, context: [List, None] = None,
+                       step_interval=ThreadManager.DEFAULT_THREAD_INTERVAL) -> PeriodicCall:
+        call = AsyncThreadManager.PeriodicCall('m-' + str(name))
+        if context is None:
+            context = ()
+
+        def on_step():
+            if call.cancelled:
+                return
+            try:
+                callback(*context)
+            except Exception as e:
+                self.__logger.error('Periodic call {} failed: {}'.format(call.name, e))
+            self.__loop.call_later(float(step_interval) / 1000, on_step)
+
+        self.__calls[call.name] = call
+        self.__loop.call_soon_threadsafe(on_step)
+        return call
+
+    def dispose_thread(self, thread: PeriodicCall):
+        if thread.getName() not in self.__calls:
+            raise LifecycleError("Can't dispose {} because it is not managed periodic call".format(thread.getName()))
+        self.__calls.pop(thread.getName()).cancelled = True
+
+    def dispose_all(self):
+        for call in list(self.__calls.values()):
+            self.dispose_thread(call)
+        super().dispose_all()  # Dedicated threads are still served by the base implementation
+
+
+class AsyncApplicationManager(ApplicationManager):
+    """
+    Runtime executing device steps and delayed calls on a single asyncio event loop. Modules might define step and
+    actions as coroutines, regular modules are served through ModuleAdapter.
+    Anything which might block, i.e. regular actions, background tasks and steps of IN_BACKGROUND modules, is
+    served by dispatch lanes and worker pools exactly as in the threaded runtime. Coroutine actions and tasks take the
+    same route, so queue capacity and overflow policies apply to them as well, but the worker only spawns the
+    coroutine on the loop. Hence action duration of coroutines is the time to spawn them.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.__loop = asyncio.new_event_loop()
+        self.thread_manager = AsyncThreadManager(self.__loop)
+        self.__logger = logging.getLogger('AsyncApplicationManager')
+        self.__device_tasks = {}  # type: Dict[int, asyncio.Task]
+        self.__sleeping = {}  # type: Dict[int, asyncio.Future] # Device id -> future resolved when it should step
+        self.__step_requested = set()  # Devices which requested step while they weren't sleeping
+        self.__stopped = None  # type: asyncio.Event
+        self.__spawning_actions = {}  # type: Dict[ActionDef, ActionDef]
+
+    def get_loop(self) -> asyncio.AbstractEventLoop:
+        return self.__loop
+
+    def _validate_device(self, device: Module):
+        pass  # Coroutine based modules are supported natively
+
+    def _schedule_device(self, device: Module):
+        self.__loop.call_soon_threadsafe(self.__start_device_task, device)
+
+    def _unschedule_device(self, device: Module):
+        self.__loop.call_soon_threadsafe(self.__stop_device_task, device)
+
+    def __stop_device_task(self, device: Module):
+        task = self.__device_tasks.pop(device.id, None)
+        self.__step_requested.discard(device.id)
+        if task is not None:
+            task.cancel()
+
+    def __start_device_task(self, device: Module):
+        self.__device_tasks[device.id] = self.__loop.create_task(
+            self.__device_loop(ModuleAdapter(device, self)))
+
+    async def __device_loop(self, adapter: ModuleAdapter):
+        device = adapter.device
+        due = utils.capture_time()
+        while True:
+            self._observe_jitter(utils.clock.tick() - due)
+            started_at = utils.capture_time_ns()
+            try:
+                await adapter.step()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.__logger.error("Error in during step of {}: {}".format(device.name, e))
+            self._observe_step(device, started_at)
+            device.last_step = utils.capture_time()
+            due = self._next_due(device, due)
+            await self.__sleep(device, max(0, due - utils.capture_time()) / 1000)
+            due = min(due, utils.capture_time())  # Requested step is due right away
+
+    async def __sleep(self, device: Module, delay: float):
+        if device.id in self.__step_requested:
+            self.__step_requested.discard(device.id)
+            return
+        waiter = self.__loop.create_future()
+        timer = self.__loop.call_later(delay, self.__wake, waiter)
+        self.__sleeping[device.id] = waiter
+        try:
+            await waiter
+        finally:
+            timer.cancel()
+            self.__sleeping.pop(device.id, None)
+
+    @staticmethod
+    def __wake(waiter: asyncio.Future):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    def request_step(self, device: Module):
+        self.__loop.call_soon_threadsafe(self.__wake_device, device)
+
+    def __wake_device(self, device: Module):
+        if device.id not in self.__device_tasks:
+            return
+        waiter = self.__sleeping.get(device.id)
+        if waiter is not None:
+            self.__wake(waiter)
+        else:
+            self.__step_requested.add(device.id)  # Device is stepping right now, next step shouldn't wait
+
+    def _wakeup_flush(self):
+        # Callback runs once the loop gets control back, i.e. after the step or action which requested flush.
+        # Requests made after the loop is closed, e.g. during shutdown, are flushed by shutdown itself
+        if not self.__loop.is_closed():
+            self.__loop.call_soon_threadsafe(self._flush_pending)
+
+    def call_later(self, delay: int, callback: Callable, *args) -> DelayedCall:
+        call = DelayedCall(callback, args, utils.capture_time() + max(0, delay))
+        self.__loop.call_soon_threadsafe(self.__start_call, call)
+        return call
+
+    def __start_call(self, call: DelayedCall):
+        if not call.cancelled:
+            # Delay is recalculated so the time spent in the loop queue doesn't postpone the call
+            call.handle = self.__loop.call_later(max(0, call.due - utils.capture_time()) / 1000,
+                                                 self.__run_call, call)
+
+    def __run_call(self, call: DelayedCall):
+        utils.clock.tick()  # Callback starts its own tick like it does in the scheduler of the threaded runtime
+        self._run_delayed_call(call)
+
+    def cancel_call(self, call: DelayedCall):
+        call.cancelled = True
+        if call.handle is not None:
+            self.__loop.call_soon_threadsafe(call.handle.cancel)
+
+    def supports_fd_watching(self) -> bool:
+        return True
+
+    def watch_fd(self, fd, callback: Callable):
+        self.__loop.call_soon_threadsafe(self.__loop.add_reader, fd, callback)
+
+    def unwatch_fd(self, fd):
+        self.__loop.call_soon_threadsafe(self.__loop.remove_reader, fd)
+
+    def register_pipe(self, piped_event: PipedEvent):
+        action = piped_event.action
+        if asyncio.iscoroutinefunction(action.callable):
+            piped_event = PipedEvent(declared_in=piped_event.declared_in, target=piped_event.target,
+                                     event=piped_event.event, args=piped_event.args, priority=piped_event.priority,
+                                     action=self.__spawning_action(action))
+        super().register_pipe(piped_event)
+
+    def __spawning_action(self, action: ActionDef) -> ActionDef:
+        spawning = self.__spawning_actions.get(action)
+        if spawning is None:
+            # Races are harmless, both wrappers are equivalent
+            spawning = ActionDef(action.id, action.name, self.__spawning(action.callable), priority=action.priority)
+            self.__spawning_actions[action] = spawning
+        return spawning
+
+    def __spawning(self, coroutine_function: Callable) -> Callable:
+        """
+        Wraps coroutine function so calling it schedules new task instead of returning coroutine object. Might be
+        called from any thread, e.g. dispatch lanes
+        """
+
+        def spawn(*args, **kwargs):
+            asyncio.run_coroutine_threadsafe(coroutine_function(*args, **kwargs), self.__loop).add_done_callback(
+                self.__on_task_done)
+
+        return spawn
+
+    def run_async_action(self, device: Module, action: ActionDef, data=None, sender=None, policy: str = None) -> bool:
+        if asyncio.iscoroutinefunction(action.callable):
+            action = self.__spawning_action(action)
+        return super().run_async_action(device, action, data, sender, policy)
+
+    def submit(self, pool_name: str, callable, *args, **kwargs) -> bool:
+        if asyncio.iscoroutinefunction(callable):
+            callable = self.__spawning(callable)
+        return super().submit(pool_name, callable, *args, **kwargs)
+
+    def run_in_pool(self, pool_name: str, callable: Callable) -> asyncio.Future:
+        """
+        Runs blocking callable in the worker pool. Must be called from the loop thread
+        :return: future resolved with the result of the callable. It fails if the pool queue rejects the call
+        """
+        future = self.__loop.create_future()
+        task = BackgroundTask.acquire(self.__run_resolving, (future, callable))
+        task.on_drop = self.__on_run_dropped
+        self.get_worker_pool(pool_name).submit(task)
+        return future
+
+    def __run_resolving(self, future: asyncio.Future, callable: Callable):
+        try:
+            result = callable()
+        except Exception as e:
+            self.__loop.call_soon_threadsafe(self.__resolve, future, None, e)
+        else:
+            self.__loop.call_soon_threadsafe(self.__resolve, future, result, None)
+
+    def __on_run_dropped(self, task: BackgroundTask):
+        future, _ = task.args
+        error = OverflowError('Call was rejected because of worker pool queue overflow')
+        self.__loop.call_soon_threadsafe(self.__resolve, future, None, error)
+
+    @staticmethod
+    def __resolve(future: asyncio.Future, result, error: [Exception, None]):
+        if future.done():
+            return  # Awaiting task was cancelled meanwhile
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def __on_task_done(self, future: concurrent.futures.Future):
+        if not future.cancelled() and future.exception() is not None:
+            self.__logger.error("Unhandled error during background task execution: {}".format(future.exception()))
+
+    def main_loop(self):
+        asyncio.set_event_loop(self.__loop)
+        try:
+            self.__loop.run_until_complete(self.__run())
+        finally:
+            tasks = list(self.__device_tasks.values())
+            for task in tasks:
+                task.cancel()
+            self.__loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+    async def __run(self):
+        self.__stopped = asyncio.Event()
+        await self.__stopped.wait()
+
+    def shutdown(self):
+        if self.__stopped is not None:
+            self.__loop.call_soon_threadsafe(self.__stopped.set)
+        super().shutdown()
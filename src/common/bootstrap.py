@@ -1,13 +1,16 @@
 import sys
 
 import gc
+import signal
+import threading
 import logging
 import os.path
 from typing import List, Tuple
 
 from common import parse_utils
 from common.drivers import ModuleDiscoveryDriver
-from common.model import Module, PipedEvent
+from common.model import Module, PipedEvent, InstanceSettings, PRIORITIES
+from common.queues import OVERFLOW_POLICIES
 from common.utils import int_to_hex4str
 from modules import StandardModulesOnlyDriver
 from .errors import ConfigValidationError, InvalidDriverError
@@ -19,11 +22,12 @@ __logger = logging.getLogger('Bootstrap')
 
 
 def bootstrap(config: dict) -> ApplicationManager:
-    application = ApplicationManager()
+    application = __create_application(config)
     # Save instance config
     __logger.info('Reading config file')
     __save_instance_config(config, application)
     __load_context_path(application)
+    __setup_profiler(application)
     __logger.info('Config captured')
     gc.collect()
     # Load drivers
@@ -41,18 +45,27 @@ def bootstrap(config: dict) -> ApplicationManager:
     # Initialize components
 
     # Run event handling loop
-    application.thread_manager.request_thread('EventLoop', application.event_loop,
-                                              step_interval=application.EVENT_HANDLING_LOOP_INTERVAL)
-    application.thread_manager.request_thread('BgLoop', application.background_tasks_loop,
-                                              step_interval=application.BG_TASK_HANDLING_LOOP_INTERVAL)
+    application.start_dispatching()
+    application.start_metrics_export()
 
     return application
 
 
+def __create_application(config: dict) -> ApplicationManager:
+    runtime = (config.get('instance') or {}).get('runtime', InstanceSettings.RUNTIME_THREADED)
+    if runtime == InstanceSettings.RUNTIME_THREADED:
+        return ApplicationManager()
+    elif runtime == InstanceSettings.RUNTIME_ASYNCIO:
+        from .async_runtime import AsyncApplicationManager
+        return AsyncApplicationManager()
+    raise ConfigValidationError('instance/runtime', 'Runtime should be one of: ' + str(InstanceSettings.RUNTIMES))
+
+
 def __save_instance_config(config: dict, application: ApplicationManager):
     if 'instance' in config:
         settings = application.get_instance_settings()
         settings.id = config.get('id')
+        settings.runtime = config['instance'].get('runtime', InstanceSettings.RUNTIME_THREADED)
         # Context Path
         for path in config.get('context_path', []):
             if isinstance(path, str):
@@ -61,6 +74,44 @@ def __save_instance_config(config: dict, application: ApplicationManager):
                 settings.context_path.append(path)
             else:
                 raise ConfigValidationError('instance/context_path', 'Context path should be the list of strings')
+        # Worker pools
+        worker_pools = config['instance'].get('worker_pools', {})
+        if not isinstance(worker_pools, dict):
+            raise ConfigValidationError('instance/worker_pools', 'Should be dictionary of pool name to pool size')
+        for pool_name, size in worker_pools.items():
+            if not isinstance(size, int) or size < 1:
+                raise ConfigValidationError('instance/worker_pools/' + str(pool_name),
+                                            'Pool size should be positive integer')
+            settings.worker_pools[pool_name] = size
+        # Metrics export
+        metrics = config['instance'].get('metrics', {})
+        if not isinstance(metrics, dict):
+            raise ConfigValidationError('instance/metrics', 'Should be dictionary')
+        settings.metrics = metrics
+        # Profiler
+        profiler = config['instance'].get('profiler', {})
+        if not isinstance(profiler, dict):
+            raise ConfigValidationError('instance/profiler', 'Should be dictionary')
+        for key in ('duration', 'interval'):
+            if key in profiler and (not isinstance(profiler[key], int) or profiler[key] < 1):
+                raise ConfigValidationError('instance/profiler/' + key, 'Should be positive integer')
+        settings.profiler = profiler
+        # Queues
+        queues = config['instance'].get('queues', {})
+        if not isinstance(queues, dict):
+            raise ConfigValidationError('instance/queues', 'Should be dictionary')
+        for queue_name, queue_def in queues.items():
+            path = 'instance/queues/' + str(queue_name)
+            if queue_name not in InstanceSettings.QUEUES:
+                raise ConfigValidationError(path, 'Queue should be one of: ' + str(InstanceSettings.QUEUES))
+            if not isinstance(queue_def, dict):
+                raise ConfigValidationError(path, 'Should be dictionary')
+            for key in ('capacity', 'block_timeout'):
+                if key in queue_def and (not isinstance(queue_def[key], int) or queue_def[key] < 0):
+                    raise ConfigValidationError(path + '/' + key, 'Should be non-negative integer')
+            if 'policy' in queue_def and queue_def['policy'] not in OVERFLOW_POLICIES:
+                raise ConfigValidationError(path + '/policy', 'Policy should be one of: ' + str(OVERFLOW_POLICIES))
+            settings.queues[queue_name] = queue_def
 
 
 def __load_context_path(application: ApplicationManager):
@@ -69,17 +120,32 @@ def __load_context_path(application: ApplicationManager):
         sys.path.append(p)
 
 
+def __setup_profiler(application: ApplicationManager):
+    settings = application.get_instance_settings().profiler
+    profiler = application.profiler
+    profiler.output_dir = settings.get('output_dir', profiler.output_dir)
+    profiler.duration = settings.get('duration', profiler.duration)
+    profiler.interval = settings.get('interval', profiler.interval)
+    # Signal handlers can be installed only from the main thread, e.g. embedding application might bootstrap elsewhere
+    if hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.start())
+    else:
+        __logger.warning('Unable to install SIGUSR1 handler. Profiling is available only via RPC')
+
+
 def __load_drivers(config: dict, application: ApplicationManager):
     drivers = config.get('drivers', [])
     for d in drivers:
         driver_class_name = None
+        options = {}
         if isinstance(d, str):
             driver_class_name = d
         elif isinstance(d, dict) and 'class' in d:
             driver_class_name = d.get('class')
+            options = {k: v for k, v in d.items() if k != 'class'}
         if driver_class_name is None:
             raise ConfigValidationError('drivers', 'Section is invalid')
-        application.register_driver(driver_class_name)
+        application.register_driver(driver_class_name, options)
     # Check if there is module discovery driver loaded. If not - load default implementation
     try:
         application.get_driver(MODULE_DISCOVERY_DRIVER)
@@ -104,7 +170,7 @@ def __instantiate_devices(config: dict, application: ApplicationManager) -> List
         )
         try:
             # Parse and set parameters
-            for param_def in instance.PARAMS:
+            for param_def in instance.get_params():
                 if param_def.name in device_def:
                     val = device_def[param_def.name]
                     if param_def.parser is not None:
@@ -138,10 +204,11 @@ def __build_pipes(devices_and_configs: List[Tuple[Module, dict]], application: A
                 if event is None:
                     raise ConfigValidationError('devices.{}.pipe.{}'.format(device.name, event),
                                                 'Unknown event name: ' + event_name)
-                # If link data is just string we will treat it as single item list
-                if isinstance(link_data, str):
+                # If link data is just string or single link definition we will treat it as single item list
+                if isinstance(link_data, (str, dict)):
                     link_data = [link_data]
-                for link_string in link_data:
+                for link_def in link_data:
+                    link_string, priority = __parse_link_def(link_def, 'devices.{}.pipe.{}'.format(device.name, event))
                     linked_device_name, action_name = parse_utils.parse_link_string(link_string)
                     linked_device = application.get_device_by_name(linked_device_name)
                     if linked_device is None:
@@ -156,7 +223,25 @@ def __build_pipes(devices_and_configs: List[Tuple[Module, dict]], application: A
                         declared_in=device,
                         target=linked_device,
                         event=event,
-                        action=action
+                        action=action,
+                        priority=priority
                     )
                     application.register_pipe(piped_event)
                     __logger.info('Piped event "{}" from #{} -> {}'.format(event_name, device.name, link_string))
+
+
+def __parse_link_def(link_def: [str, dict], section: str) -> Tuple[str, int]:
+    """
+    Link might be defined either as link string or as dictionary containing link string under "target" key and
+    optional "priority" overriding priority declared by event and action. E.g.:
+        {target: '#central_bus.push_state', priority: bulk}
+    :return: tuple (link string, priority). Priority is None unless overridden
+    """
+    if isinstance(link_def, str):
+        return link_def, None
+    if not isinstance(link_def, dict) or 'target' not in link_def:
+        raise ConfigValidationError(section, 'Link should be either string or dictionary with "target" key')
+    priority_name = link_def.get('priority')
+    if priority_name is not None and priority_name not in PRIORITIES:
+        raise ConfigValidationError(section, 'Priority should be one of: ' + str(list(PRIORITIES.keys())))
+    return link_def['target'], PRIORITIES.get(priority_name)
@@ -1,18 +1,40 @@
+from common.errors import ConfigError
 from common.model import ConfigParser, ACL
 from common.parse_utils import parse_link_string
 
 
 class ACLParser(ConfigParser):
+    """
+    Rules are link strings, optionally with * wildcards in device and target names, e.g. '#bedroom_*.toggle' or
+    '#*.toggle'. Use '#device.*' to refer to all the targets of the device, rule without target name doesn't match
+    anything. By default rules refer to actions, rule for event should be defined as dictionary:
+    {event: '#bedroom_lamp_1.state_changed'}. Event rules control which events are published to remote subscribers.
+    """
+
     def parse(self, config_section: dict, application, absolute_path: str = '') -> ACL:
         acl = ACL()
         if 'mode' in config_section:
             acl.mode = config_section['mode']
         if 'allow' in config_section:
             for rule in config_section['allow']:
-                device, action = parse_link_string(rule)
-                acl.allow(device, action, ACL.TARGET_TYPE_ACTION)
+                acl.allow(*self.__parse_rule(rule, absolute_path))
         if 'deny' in config_section:
             for rule in config_section['deny']:
-                device, action = parse_link_string(rule)
-                acl.deny(device, action, ACL.TARGET_TYPE_ACTION)
+                acl.deny(*self.__parse_rule(rule, absolute_path))
         return acl
+
+    @staticmethod
+    def __parse_rule(rule: [str, dict], absolute_path: str):
+        """
+        :return: tuple (device name, target name, target type). Target name is None if rule doesn't define it
+        """
+        target_type = ACL.TARGET_TYPE_ACTION
+        if isinstance(rule, dict):
+            if len(rule) != 1 or list(rule.keys())[0] not in ACL.SUPPORTED_TARGET_TYPES:
+                raise ConfigError('{}: ACL rule should contain exactly one of the keys: {}'
+                                  .format(absolute_path, ACL.SUPPORTED_TARGET_TYPES))
+            target_type, rule = list(rule.items())[0]
+        if not isinstance(rule, str):
+            raise ConfigError('{}: ACL rule should be a link string, e.g. #device.action'.format(absolute_path))
+        device, target = parse_link_string(rule)
+        return device, target, target_type
@@ -1,28 +1,36 @@
+import bisect
+import functools
 import logging
+import os
 import threading
 
 import time
-from queue import Queue
+from queue import Queue, Empty
 from threading import Thread
 
-from typing import Dict, Callable, List, Any
+from typing import Dict, Callable, List, Any, Tuple
 
 from common import utils
 from .utils import int_to_hex4str
 from .errors import InvalidModuleError, InvalidDriverError, LifecycleError
-from .model import InstanceSettings, Driver, Module, InternalEvent, PipedEvent, BackgroundTask, ActionDef
+from .model import InstanceSettings, Driver, Module, StateAwareModule, InternalEvent, PipedEvent, BackgroundTask, \
+    ActionDef, WORKER_POOL_DEFAULT, WORKER_POOL_IO, PRIORITIES, resolve_priority
+from .queues import PriorityLaneQueue, OVERFLOW_POLICIES, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST
+from .profiler import SamplingProfiler
+from .scheduler import Scheduler, TimerWheel
 
 
 class ModuleRegistry:
     def __init__(self):
         super().__init__()
         self.modules = {}  # type: Dict[Module]
+        self.__modules_by_name = {}  # type: Dict[str, Module]
 
     def find_module_by_name(self, module_name):
-        for x in self.modules.values():
-            if x.type_name() == module_name:
-                return x
-        raise InvalidModuleError('Unknown module {} '.format(module_name))
+        module_class = self.__modules_by_name.get(module_name)
+        if module_class is None:
+            raise InvalidModuleError('Unknown module {} '.format(module_name))
+        return module_class
 
     def register(self, module_class):
         module_class_name = module_class.__name__
@@ -36,7 +44,9 @@ class ModuleRegistry:
             if typeid in self.modules.keys():
                 raise InvalidModuleError(
                     'Module {} is already registered'.format(int_to_hex4str(typeid), module_class.type_name()))
+            module_class.build_index()
             self.modules[typeid] = module_class
+            self.__modules_by_name.setdefault(module_class.type_name(), module_class)
         except InvalidModuleError as e:
             raise InvalidModuleError("Can't register module " + module_class_name + ": " + e.message, e)
 
@@ -72,73 +82,608 @@ class ModuleRegistry:
             raise InvalidModuleError("Unable to create module for device {}: {}".format(instance_id, e.message), e)
 
 
+class Histogram(object):
+    """
+    Histogram with fixed buckets. Recording doesn't take locks and doesn't allocate containers: it is a bisect over
+    bucket bounds and increments of preallocated counters. Concurrent updates might rarely lose an increment which is
+    acceptable for monitoring purposes.
+    """
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last one is +Inf bucket
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def percentile(self, p: float) -> [float, None]:
+        """
+        :return: upper bound of the bucket containing given percentile or None if nothing was recorded yet
+        """
+        counts = list(self.counts)
+        total = sum(counts)
+        if not total:
+            return None
+        threshold = total * p / 100
+        accumulated = 0
+        for i, c in enumerate(counts):
+            accumulated += c
+            if accumulated >= threshold:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+
+    def summary(self) -> dict:
+        """
+        :return: count and percentiles. Percentile is None if nothing was recorded or it falls into +Inf bucket
+        """
+        return dict(count=self.count, p50=utils.finite_or_none(self.percentile(50)),
+                    p99=utils.finite_or_none(self.percentile(99)))
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+
+class DelayedCall(object):
+    """
+    One-shot callback scheduled with ApplicationManager.call_later()
+    """
+    __slots__ = ('callback', 'args', 'due', 'cancelled', 'handle')
+
+    def __init__(self, callback: Callable, args: tuple, due: int):
+        """
+        :param due: time in milliseconds
+        """
+        self.callback = callback
+        self.args = args
+        self.due = due
+        self.cancelled = False
+        self.handle = None  # Runtime specific handle of the scheduled call
+
+
+class MetricsRegistry(object):
+    """
+    Registry of runtime metrics. Metrics are identified by name and labels. Instruments should be obtained once
+    and cached by the caller, so hot path only touches the instrument itself. Gauges are callbacks evaluated on export.
+    """
+    PREFIX = 'heats_'
+
+    TYPE_HISTOGRAM = 'histogram'
+    TYPE_COUNTER = 'counter'
+    TYPE_GAUGE = 'gauge'
+
+    def __init__(self):
+        self.__metrics = {}  # type: Dict[str, Tuple[str, str, Dict[Tuple, Any]]] # name -> (type, help, instruments)
+        self.__lock = threading.Lock()
+
+    def __get(self, metric_type: str, name: str, help: str, labels: dict, factory: Callable):
+        with self.__lock:
+            if name not in self.__metrics:
+                self.__metrics[name] = (metric_type, help, {})
+            declared_type, _, instruments = self.__metrics[name]
+            if declared_type != metric_type:
+                raise ValueError("Metric {} is already registered as {}".format(name, declared_type))
+            key = tuple(sorted(labels.items()))
+            if key not in instruments:
+                instruments[key] = factory()
+            return instruments[key]
+
+    def histogram(self, name: str, help: str = '', **labels) -> Histogram:
+        return self.__get(self.TYPE_HISTOGRAM, name, help, labels, Histogram)
+
+    def counter(self, name: str, help: str = '', **labels) -> Counter:
+        return self.__get(self.TYPE_COUNTER, name, help, labels, Counter)
+
+    def gauge(self, name: str, callback: Callable, help: str = '', **labels):
+        """
+        :param callback: callable without arguments returning current value
+        """
+        self.__get(self.TYPE_GAUGE, name, help, labels, lambda: callback)
+
+    def remove(self, **labels):
+        """
+        Drops instruments of all metrics having given labels, e.g. when device is removed
+        """
+        criteria = set(labels.items())
+        with self.__lock:
+            for _, _, instruments in self.__metrics.values():
+                for key in [k for k in instruments.keys() if criteria.issubset(k)]:
+                    del instruments[key]
+
+    def __items(self):
+        with self.__lock:
+            return [(name, metric_type, help, list(instruments.items()))
+                    for name, (metric_type, help, instruments) in sorted(self.__metrics.items())]
+
+    @staticmethod
+    def __format_labels(labels, **extra) -> str:
+        pairs = list(labels) + sorted(extra.items())
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in pairs) + '}'
+
+    def export_prometheus(self) -> str:
+        """
+        :return: all metrics in Prometheus text exposition format
+        """
+        lines = []
+        for name, metric_type, help, instruments in self.__items():
+            full_name = self.PREFIX + name
+            if help:
+                lines.append('# HELP {} {}'.format(full_name, help))
+            lines.append('# TYPE {} {}'.format(full_name, metric_type))
+            for labels, instrument in instruments:
+                if metric_type == self.TYPE_HISTOGRAM:
+                    accumulated = 0
+                    for bound, count in zip(instrument.buckets + ('+Inf',), list(instrument.counts)):
+                        accumulated += count
+                        lines.append('{}_bucket{} {}'.format(full_name, self.__format_labels(labels, le=bound),
+                                                             accumulated))
+                    lines.append('{}_sum{} {}'.format(full_name, self.__format_labels(labels), instrument.sum))
+                    lines.append('{}_count{} {}'.format(full_name, self.__format_labels(labels), instrument.count))
+                elif metric_type == self.TYPE_COUNTER:
+                    lines.append('{}{} {}'.format(full_name, self.__format_labels(labels), instrument.value))
+                else:
+                    value = self.__read_gauge(instrument)
+                    lines.append('{}{} {}'.format(full_name, self.__format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """
+        :return: dictionary metric name -> labels string -> value. Histograms are represented by their summary.
+                 Infinite and NaN values, e.g. gauges which failed to read, are None so snapshot is valid JSON
+        """
+        result = {}
+        for name, metric_type, _, instruments in self.__items():
+            values = result.setdefault(name, {})
+            for labels, instrument in instruments:
+                key = ','.join('{}={}'.format(k, v) for k, v in labels)
+                if metric_type == self.TYPE_HISTOGRAM:
+                    values[key] = instrument.summary()
+                elif metric_type == self.TYPE_COUNTER:
+                    values[key] = instrument.value
+                else:
+                    values[key] = utils.finite_or_none(self.__read_gauge(instrument))
+        return result
+
+    @staticmethod
+    def __read_gauge(callback: Callable):
+        try:
+            return callback()
+        except Exception:
+            return float('nan')
+
+
 class ThreadManager(object):
+    """
+    Periodic callbacks are driven by the shared timer wheel and executed by small fixed pool of executor threads, so
+    the number of threads doesn't depend on the number of callbacks. Long-running loops which block by themselves
+    (e.g. waiting on the queue) get dedicated threads.
+    """
     DEFAULT_THREAD_INTERVAL = 200
+    EXECUTOR_SIZE = 2
+    JOIN_TIMEOUT = 2  # Seconds. Max time to wait for each thread on disposal
+
+    class ManagedTask(object):
+        def __init__(self, name: str, callback: Callable, context, interval: int = 0, wakeup: Callable = None):
+            self.name = name
+            self.callback = callback
+            self.context = context
+            self.interval = interval
+            self.wakeup = wakeup
+            self.timer = None  # type: TimerWheel.Timer
+            self.thread = None  # type: Thread # Set for tasks running in dedicated thread
+            self.disposed = threading.Event()
+
+        def getName(self):
+            return self.name
 
     def __init__(self):
-        self.__managed_threads = {}
-        self.logger = logging.getLevelName(self.__class__.__name__)
+        self.__managed_tasks = {}  # type: Dict[str, ThreadManager.ManagedTask]
+        self.__lock = threading.RLock()
+        self.__wheel = None  # type: TimerWheel
+        self.__executor_queue = Queue()
+        self.__service_threads = []  # type: List[Thread]
+        self.logger = logging.getLogger(self.__class__.__name__)
 
     def request_thread(self, name, callback, context: [List, None] = None,
-                       step_interval=DEFAULT_THREAD_INTERVAL) -> Thread:
-        thread_name = 'm-' + str(name)
-        if context is None:
-            context = ()
+                       step_interval=DEFAULT_THREAD_INTERVAL) -> ManagedTask:
+        """
+        Requests callback to be invoked periodically with the given interval (milliseconds) between invocations
+        """
+        task = self.__register(ThreadManager.ManagedTask('m-' + str(name), callback, context or (), step_interval))
+        self.__ensure_wheel_started()
+        self.__executor_queue.put(task)  # The first invocation happens right away
+        return task
 
-        def on_step():
-            while not threading.currentThread().terminating:
-                try:
-                    callback(*context)
-                    time.sleep(float(step_interval) / 1000)
-                except Exception as e:
-                    self.logger.error('Thread execution failed: {}'.format(e))
-
-        thread = Thread(target=on_step, name=thread_name)
-        thread.terminating = False
-        self.__managed_threads[thread_name] = thread
-        thread.start()
-        return thread
-
-    def dispose_thread(self, thread: [Thread, str]):
-        thread_name = thread.getName()
-        # if isinstance(thread, Thread):
-        #     thread_name = thread.getName()
-        # else:
-        #     thread_name = thread
-        #     thread = self.__managed_threads.get(thread_name)
-        if thread_name in self.__managed_threads.keys():
-            thread.terminating = True
-            self.__managed_threads.pop(thread_name)
-        else:
-            raise LifecycleError("Can't dispose thread {} because it is not managed thread".format(thread_name))
+    def request_dedicated_thread(self, name, callback, context: [List, None] = None,
+                                 wakeup: Callable = None) -> ManagedTask:
+        """
+        Starts thread invoking callback in a loop until disposed. Callback is expected to block by itself.
+        :param wakeup: callable unblocking the callback, it is invoked on disposal to speed up termination
+        """
+        task = self.__register(ThreadManager.ManagedTask('m-' + str(name), callback, context or (), wakeup=wakeup))
+
+        def run():
+            while not task.disposed.is_set():
+                self.__invoke(task)
+
+        task.thread = Thread(target=run, name=task.name, daemon=True)
+        task.thread.start()
+        return task
+
+    def __register(self, task: ManagedTask) -> ManagedTask:
+        with self.__lock:
+            if task.name in self.__managed_tasks:
+                raise LifecycleError("Thread {} is already managed".format(task.name))
+            self.__managed_tasks[task.name] = task
+        return task
+
+    def __ensure_wheel_started(self):
+        with self.__lock:
+            if self.__wheel is not None:
+                return
+            self.__wheel = TimerWheel(self.__executor_queue.put)
+            self.__service_threads.append(Thread(target=self.__wheel.run, name='m-TimerWheel', daemon=True))
+            for i in range(self.EXECUTOR_SIZE):
+                self.__service_threads.append(Thread(target=self.__executor_loop, name='m-Executor-' + str(i),
+                                                     daemon=True))
+            for t in self.__service_threads:
+                t.start()
+
+    def __executor_loop(self):
+        while True:
+            task = self.__executor_queue.get()  # type: ThreadManager.ManagedTask
+            if task is None:
+                return  # Shutdown signal
+            if task.disposed.is_set():
+                continue
+            self.__invoke(task)
+            with self.__lock:
+                if not task.disposed.is_set():
+                    task.timer = self.__wheel.add(task, task.interval)
+
+    def __invoke(self, task: ManagedTask):
+        try:
+            task.callback(*task.context)
+        except Exception as e:
+            self.logger.error('Thread {} execution failed: {}'.format(task.name, e))
+
+    def dispose_thread(self, thread: ManagedTask):
+        self.__release(thread)
+        self.__join(thread, time.monotonic() + self.JOIN_TIMEOUT)
+
+    def __release(self, task: ManagedTask):
+        with self.__lock:
+            if self.__managed_tasks.get(task.getName()) is not task:
+                raise LifecycleError("Can't dispose thread {} because it is not managed thread".format(task.getName()))
+            del self.__managed_tasks[task.getName()]
+            task.disposed.set()
+            if task.timer is not None:
+                self.__wheel.cancel(task.timer)
+        if task.wakeup is not None:
+            task.wakeup()
+
+    def __join(self, task: ManagedTask, deadline: float):
+        if task.thread is not None and task.thread is not threading.current_thread():
+            task.thread.join(max(0, deadline - time.monotonic()))
+            if task.thread.is_alive():
+                self.logger.warning("Thread {} didn't terminate in time".format(task.name))
 
     def dispose_all(self):
-        threads = list(self.__managed_threads.values())
-        for t in threads:
-            self.dispose_thread(t)
+        with self.__lock:
+            tasks = list(self.__managed_tasks.values())
+        # Signal everything first so threads terminate in parallel, then wait for them within a common deadline
+        for t in tasks:
+            self.__release(t)
+        deadline = time.monotonic() + self.JOIN_TIMEOUT
+        for t in tasks:
+            self.__join(t, deadline)
+        with self.__lock:
+            if self.__wheel is None:
+                return
+            self.__wheel.stop()
+            for _ in range(self.EXECUTOR_SIZE):
+                self.__executor_queue.put(None)
+            service_threads, self.__service_threads, self.__wheel = self.__service_threads, [], None
+        for t in service_threads:
+            if t is not threading.current_thread():
+                t.join(max(0, deadline - time.monotonic()))
+
+
+class MetricsExporter(object):
+    """
+    Periodically writes metrics in Prometheus text format to the file and/or serves them over HTTP
+    """
+    DEFAULT_INTERVAL = 10000
+
+    def __init__(self, registry: MetricsRegistry, settings: dict):
+        """
+        :param settings: dictionary with optional keys prometheus_file, prometheus_port, prometheus_bind_address
+                         and interval (milliseconds between file updates)
+        """
+        self.__registry = registry
+        self.__settings = settings
+        self.__server = None
+        self.__logger = logging.getLogger('MetricsExporter')
+
+    def start(self, thread_manager: ThreadManager):
+        if self.__settings.get('prometheus_file'):
+            thread_manager.request_thread('MetricsFileExport', self.write_file,
+                                          step_interval=self.__settings.get('interval', self.DEFAULT_INTERVAL))
+        if self.__settings.get('prometheus_port'):
+            self.__start_http_server(thread_manager)
+
+    def write_file(self):
+        file_name = self.__settings['prometheus_file']
+        # Write to temporary file first so scraper never sees partially written file
+        with open(file_name + '.tmp', 'w') as f:
+            f.write(self.__registry.export_prometheus())
+        os.replace(file_name + '.tmp', file_name)
+
+    def __start_http_server(self, thread_manager: ThreadManager):
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        registry = self.__registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.export_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = HTTPServer((self.__settings.get('prometheus_bind_address', ''),
+                                    self.__settings['prometheus_port']), Handler)
+        self.__server.timeout = 1
+        thread_manager.request_dedicated_thread('MetricsHttpServer', self.__server.handle_request)
+        self.__logger.info("Serving metrics on port {}".format(self.__settings['prometheus_port']))
+
+
+class DispatchLane(object):
+    """
+    Queue of events served by dedicated dispatcher thread. Every priority class has its own lane so events
+    of different priorities never wait for each other.
+    """
+    EVENT_QUEUE_WAIT_TIMEOUT = 1  # Seconds. Dispatcher re-checks lifecycle state at least this often
+
+    def __init__(self, name: str, priority: int, dispatch: Callable, metrics: MetricsRegistry):
+        """
+        :param dispatch: callable accepting event and priority of the lane
+        """
+        self.name = name
+        self.priority = priority
+        self.__dispatch = dispatch
+        self.__dropped = {policy: metrics.counter('events_dropped_total', 'Number of events dropped or coalesced '
+                                                  'because of queue overflow', lane=name, policy=policy)
+                          for policy in OVERFLOW_POLICIES}
+        self.__queue = PriorityLaneQueue(1, on_drop=self.__on_drop)
+
+    def __on_drop(self, event: InternalEvent, policy: str):
+        self.__dropped[policy].inc()
+        event.release()
+
+    def configure(self, capacity: int, policy: str, block_timeout: int):
+        self.__queue.capacity = capacity
+        self.__queue.policy = policy
+        self.__queue.block_timeout = block_timeout
+
+    def put(self, event: InternalEvent, policy: str = None) -> bool:
+        """
+        :return: False if event was dropped because of queue overflow
+        """
+        return self.__queue.put(event, 0, policy, (event.sender.id, event.event_id))
+
+    def qsize(self) -> int:
+        return self.__queue.qsize()
+
+    def get_dropped(self) -> Dict[str, int]:
+        return {policy: counter.value for policy, counter in self.__dropped.items()}
+
+    def process_batch(self):
+        # Block until the first event arrives and then take everything accumulated in the queue as a batch
+        try:
+            batch = [self.__queue.get(timeout=self.EVENT_QUEUE_WAIT_TIMEOUT)]
+        except Empty:
+            return
+        batch.extend(self.__queue.get_all())
+        for event_task in batch:  # type: InternalEvent
+            if event_task is None:
+                continue  # Wakeup signal
+            self.__dispatch(event_task, self.priority)
+            event_task.release()
+
+    def wakeup(self):
+        self.__queue.wakeup()
+
+
+class WorkerPool(object):
+    """
+    Fixed number of threads serving the shared queue of background tasks
+    """
+    TASK_WAIT_TIMEOUT = 1  # Seconds. Worker re-checks lifecycle state at least this often
+
+    def __init__(self, name: str, size: int, metrics: MetricsRegistry, capacity: int = 0,
+                 policy: str = OVERFLOW_DROP_NEWEST, block_timeout: int = 0):
+        self.name = name
+        self.size = size
+        self.wait_time = metrics.histogram('worker_pool_wait_ms', 'Time task spent in the queue', pool=name)
+        self.execution_time = metrics.histogram('worker_pool_execution_ms', 'Task execution time', pool=name)
+        self.__dropped = {policy: metrics.counter('tasks_dropped_total', 'Number of tasks dropped or coalesced '
+                                                  'because of queue overflow', pool=name, policy=policy)
+                          for policy in OVERFLOW_POLICIES}
+        self.__queue = PriorityLaneQueue(len(PRIORITIES), capacity, policy, block_timeout, on_drop=self.__on_drop)
+        metrics.gauge('worker_pool_queue_depth', self.__queue.qsize, 'Number of pending tasks', pool=name)
+        self.__threads = []  # type: List[ThreadManager.ManagedTask]
+        self.__logger = logging.getLogger('WorkerPool-' + name)
+
+    def __on_drop(self, task: BackgroundTask, policy: str):
+        self.__dropped[policy].inc()
+        if task.on_drop is not None:
+            try:
+                task.on_drop(task)
+            except Exception as e:
+                self.__logger.error("Drop handler of background task failed: {}".format(e))
+        task.release()
+
+    def start(self, thread_manager: ThreadManager):
+        for i in range(len(self.__threads), self.size):
+            self.__threads.append(thread_manager.request_dedicated_thread('{}-worker-{}'.format(self.name, i),
+                                                                          self.process_next, wakeup=self.wakeup_one))
+
+    def submit(self, task: BackgroundTask, policy: str = None, key=None) -> bool:
+        """
+        :param policy: overflow policy, default policy of the pool is used if not set
+        :param key: coalescing key for coalesce policy
+        :return: False if task was dropped because of queue overflow
+        """
+        task.enqueued_at = utils.capture_time_ns()
+        return self.__queue.put(task, task.priority, policy, key)
+
+    def process_next(self):
+        try:
+            task = self.__queue.get(timeout=self.TASK_WAIT_TIMEOUT)  # type: BackgroundTask
+        except Empty:
+            return
+        if task is None:
+            return  # Wakeup signal
+        started_at = utils.capture_time_ns()
+        self.wait_time.observe((started_at - task.enqueued_at) / 1000000)
+        try:
+            task.run()
+        except Exception as e:
+            self.__logger.error("Unhandled error during background task execution: {}".format(e))
+        finally:
+            duration = (utils.capture_time_ns() - started_at) / 1000000
+            self.execution_time.observe(duration)
+            if task.metric is not None:
+                task.metric.observe(duration)
+            task.release()
+
+    def wakeup_one(self):
+        self.__queue.wakeup()
+
+    def get_stats(self) -> dict:
+        """
+        :return: Pool size, number of pending tasks and percentiles of queue wait and execution time in milliseconds
+        """
+        return dict(size=self.size, queue_depth=self.__queue.qsize(),
+                    dropped={policy: counter.value for policy, counter in self.__dropped.items()},
+                    wait_time=self.wait_time.summary(), execution_time=self.execution_time.summary())
 
 
 class ApplicationManager:
-    EVENT_HANDLING_LOOP_INTERVAL = 50
-    BG_TASK_HANDLING_LOOP_INTERVAL = 50
+    DEFAULT_WORKER_POOLS = {
+        WORKER_POOL_DEFAULT: 2,
+        WORKER_POOL_IO: 1,
+    }
+    DEFAULT_QUEUES = {
+        # Capacity is the max number of pending items, block timeout is in milliseconds
+        InstanceSettings.QUEUE_EVENTS: dict(capacity=10000, policy=OVERFLOW_DROP_OLDEST, block_timeout=100),
+        InstanceSettings.QUEUE_TASKS: dict(capacity=1000, policy=OVERFLOW_DROP_NEWEST, block_timeout=100),
+    }
     MAIN_LOOP_INTERVAL = 50
+    MIN_SCHEDULING_INTERVAL = 1  # Modules with smaller interval will be stepped at most once per this period
 
     def __init__(self):
         self.__instance_settings = InstanceSettings()
         self.drivers = {}  # type: Dict[int, Driver]
         self.devices = {}  # type: Dict[int, Module]
+        self.__devices_by_name = {}  # type: Dict[str, Module]
         self.thread_manager = ThreadManager()
         self.__logger = logging.getLogger('ApplicationManager')
-        self.__main_loop = []
+        self.__scheduler = Scheduler()
+        self.__in_flight_steps = {}  # type: Dict[int, bool] # Device id -> whether coalesced step is pending
+        self.__in_flight_lock = threading.Lock()
+        self.__step_stats = {}  # type: Dict[int, Dict[str, int]]
+        self.__pending_flushes = {}  # type: Dict[Any, Callable] # Key -> callback to invoke at the end of the tick
+        self.__pending_flushes_lock = threading.Lock()
+        self.__heartbeats = {}  # type: Dict[int, ThreadManager.ManagedTask]
+        self.__main_loop_ident = None
         self.__module_registry = ModuleRegistry()
         self.__terminating = False
-        self.__event_queue = Queue()
-        self.__bg_tasks_queue = Queue()
-        self.__event_map = {}  # type: Dict[int, List[PipedEvent]]
+        self.metrics = MetricsRegistry()
+        self.profiler = SamplingProfiler()
+        self.__dispatch_lanes = {priority: DispatchLane(name, priority, self._dispatch_event, self.metrics)
+                                 for name, priority in PRIORITIES.items()}  # type: Dict[int, DispatchLane]
+        self.__event_latency = {}  # type: Dict[int, Histogram]
+        for lane in self.__dispatch_lanes.values():
+            self.__event_latency[lane.priority] = self.metrics.histogram(
+                'event_latency_ms', 'Time between event emission and completion of piped action', lane=lane.name)
+            self.metrics.gauge('event_queue_depth', lane.qsize, 'Number of pending events', lane=lane.name)
+        self.__step_durations = {}  # type: Dict[int, Histogram]
+        self.__action_durations = {}  # type: Dict[Tuple[int, int], Histogram] # (device id, action id) -> histogram
+        self.__kwargs_by_sender = {}  # type: Dict[Any, dict]
+        self.__main_loop_jitter = self.metrics.histogram('main_loop_jitter_ms',
+                                                         'Delay between time step was due and actual start')
+        self.__worker_pools = {}  # type: Dict[str, WorkerPool]
+        self.__pipes = {}  # type: Dict[Tuple[int, int], List[PipedEvent]] # (sender id, event id) -> pipes
+        # (sender id, event id) -> priority -> tuple of (pre-bound action invoker, pipe, action duration histogram)
+        self.__routes = {}  # type: Dict[Tuple[int, int], Dict[int, Tuple[Tuple[Callable, PipedEvent, Histogram], ...]]]
 
     def get_instance_settings(self) -> InstanceSettings:
         return self.__instance_settings
 
+    def get_event_latency(self) -> Dict[str, dict]:
+        """
+        :return: Percentiles of time in milliseconds passed between event emission and completion of piped action
+                 for each dispatch lane
+        """
+        return {lane.name: self.__event_latency[lane.priority].summary() for lane in self.__dispatch_lanes.values()}
+
+    def get_worker_pool(self, name: str) -> WorkerPool:
+        pool = self.__worker_pools.get(name)
+        if pool is None:
+            pool_sizes = dict(self.DEFAULT_WORKER_POOLS, **self.__instance_settings.worker_pools)
+            if name not in pool_sizes:
+                self.__logger.warning("Worker pool {} is not configured. Default pool will be used".format(name))
+                return self.get_worker_pool(WORKER_POOL_DEFAULT)
+            pool = WorkerPool(name, pool_sizes[name], self.metrics,
+                              **self.get_queue_settings(InstanceSettings.QUEUE_TASKS))
+            self.__worker_pools[name] = pool
+        return pool
+
+    def get_queue_settings(self, queue: str) -> dict:
+        """
+        :param queue: one of InstanceSettings.QUEUES
+        :return: dictionary with capacity, policy and block_timeout keys
+        """
+        return dict(self.DEFAULT_QUEUES[queue], **self.__instance_settings.queues.get(queue, {}))
+
+    def get_dropped_events(self) -> Dict[str, Dict[str, int]]:
+        """
+        :return: number of dropped or coalesced events per lane and overflow policy
+        """
+        return {lane.name: lane.get_dropped() for lane in self.__dispatch_lanes.values()}
+
+    def start_worker_pools(self):
+        pool_names = set(self.DEFAULT_WORKER_POOLS.keys()) | set(self.__instance_settings.worker_pools.keys())
+        for name in pool_names:
+            self.get_worker_pool(name).start(self.thread_manager)
+
+    def get_worker_pool_stats(self) -> Dict[str, dict]:
+        return {name: pool.get_stats() for name, pool in self.__worker_pools.items()}
+
+    def get_step_stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        :return: Number of background steps which were skipped or coalesced because previous step was still running
+                 and number of steps dropped because of worker pool queue overflow
+        """
+        return {device.name: dict(self.__step_stats[device.id]) for device in self.devices.values()
+                if device.id in self.__step_stats}
+
     def get_module_registry(self) -> ModuleRegistry:
         return self.__module_registry
 
@@ -146,10 +691,7 @@ class ApplicationManager:
         raise NotImplementedError()
 
     def get_device_by_name(self, name: str) -> [Module, None]:
-        for x in self.devices.values():
-            if x.name == name:
-                return x
-        return None
+        return self.__devices_by_name.get(name)
 
     def get_driver(self, driver_type: int) -> Driver:
         driver_impl = self.drivers.get(driver_type, None)  # type: Driver
@@ -158,7 +700,7 @@ class ApplicationManager:
                 'There is no implementation for driver {} registered'.format(int_to_hex4str(driver_type)))
         return driver_impl
 
-    def register_driver(self, driver_class_name):
+    def register_driver(self, driver_class_name, options: dict = None):
         try:
             if isinstance(driver_class_name, str):
                 # Load driver
@@ -182,6 +724,7 @@ class ApplicationManager:
             # Initialization
             driver_impl = driver_impl_class()
             try:
+                driver_impl.configure(options or {})
                 driver_impl.on_initialized(self)
             except Exception as e:
                 raise InvalidDriverError("Error during initialization", e)
@@ -192,74 +735,390 @@ class ApplicationManager:
             raise InvalidDriverError('Unable to register driver {}: '.format(driver_class_name) + e.message, e)
 
     def register_device(self, device: Module):
+        self._validate_device(device)
+        if device.name in self.__devices_by_name:
+            raise LifecycleError("Device with name {} is already registered".format(device.name))
         self.devices[device.id] = device
+        self.__devices_by_name[device.name] = device
+        self.__step_durations[device.id] = self.metrics.histogram('device_step_duration_ms', 'Duration of step',
+                                                                  device=device.name)
+        # Resolved in advance, so invocations don't need to lock the metrics registry
+        for action in device.ACTIONS:
+            self.__action_durations[(device.id, action.id)] = self.metrics.histogram(
+                'action_duration_ms', 'Duration of action invocation', device=device.name, action=action.name)
         if device.IN_LOOP:
-            self.__main_loop.append(device)
+            self._schedule_device(device)
+        if isinstance(device, StateAwareModule) and device.max_silence:
+            # Checked twice per interval so heartbeat is never late by more than a half of it
+            self.__heartbeats[device.id] = self.thread_manager.request_thread(
+                'StateHeartbeat-' + device.name, device.heartbeat, step_interval=max(1, device.max_silence // 2))
+
+    def unregister_device(self, device: Module):
+        """
+        Removes device from the runtime along with all pipes it is involved in either as sender or target
+        """
+        if self.devices.get(device.id) is not device:
+            raise LifecycleError("Device {} is not registered".format(device.name))
+        self._unschedule_device(device)
+        heartbeat = self.__heartbeats.pop(device.id, None)
+        if heartbeat is not None:
+            self.thread_manager.dispose_thread(heartbeat)
+        with self.__pending_flushes_lock:
+            self.__pending_flushes.pop(device.id, None)
+        del self.devices[device.id]
+        del self.__devices_by_name[device.name]
+        self.__step_durations.pop(device.id, None)
+        for action in device.ACTIONS:
+            self.__action_durations.pop((device.id, action.id), None)
+        self.__kwargs_by_sender.pop(device, None)
+        self.metrics.remove(device=device.name)
+        for route_key, pipes in list(self.__pipes.items()):
+            remaining = [x for x in pipes if x.declared_in is not device and x.target is not device]
+            if len(remaining) != len(pipes):
+                if remaining:
+                    self.__pipes[route_key] = remaining
+                else:
+                    del self.__pipes[route_key]
+                self.__compile_route(route_key)
+
+    def _validate_device(self, device: Module):
+        if device.is_async():
+            raise InvalidModuleError("Device {} defines coroutine step or actions. This requires asyncio runtime"
+                                     .format(device.name))
+
+    def _schedule_device(self, device: Module):
+        self.__scheduler.schedule(device, utils.capture_time())
+
+    def _unschedule_device(self, device: Module):
+        self.__scheduler.cancel(device)
+
+    def request_step(self, device: Module):
+        """
+        Makes device step as soon as possible regardless of its iteration interval, e.g. once driver noticed change
+        of the input. Might be called from any thread
+        """
+        if device.IN_LOOP and self.devices.get(device.id) is device:
+            self.__scheduler.schedule(device, utils.capture_time(), keep_earlier=True)
+
+    def call_later(self, delay: int, callback: Callable, *args) -> DelayedCall:
+        """
+        Invokes callback once after delay. Callback is executed by the main loop, i.e. the same way as steps of
+        the modules which aren't IN_BACKGROUND, so it shouldn't block. Might be called from any thread
+        :param delay: delay in milliseconds
+        """
+        call = DelayedCall(callback, args, utils.capture_time() + max(0, delay))
+        self.__scheduler.schedule(call, call.due)
+        return call
+
+    def cancel_call(self, call: DelayedCall):
+        """
+        Cancels call scheduled with call_later(). Does nothing if it has already been executed
+        """
+        call.cancelled = True
+        self.__scheduler.cancel(call)
+
+    def _run_delayed_call(self, call: DelayedCall):
+        if call.cancelled:
+            return
+        call.cancelled = True  # Executed calls can't be cancelled anymore
+        try:
+            call.callback(*call.args)
+        except Exception as e:
+            self.__logger.error("Delayed call {} failed: {}".format(call.callback, e))
+
+    def supports_fd_watching(self) -> bool:
+        """
+        :return: True if runtime is able to watch file descriptors itself so drivers don't need dedicated threads
+        """
+        return False
+
+    def watch_fd(self, fd, callback: Callable):
+        """
+        Requests callback to be invoked each time file descriptor (or object having fileno() method) becomes readable
+        """
+        raise LifecycleError("File descriptor watching is not supported by {}".format(self.__class__.__name__))
+
+    def unwatch_fd(self, fd):
+        raise LifecycleError("File descriptor watching is not supported by {}".format(self.__class__.__name__))
 
     def register_pipe(self, piped_event: PipedEvent):
-        event_list = self.__event_map.get(piped_event.event.id, None)
-        if event_list is None:
-            event_list = []
-            self.__event_map[piped_event.event.id] = event_list
-        event_list.append(piped_event)
+        route_key = (piped_event.declared_in.id, piped_event.event.id)
+        self.__pipes.setdefault(route_key, []).append(piped_event)
+        self.__compile_route(route_key)
+
+    def __compile_route(self, route_key: Tuple[int, int]):
+        """
+        Builds routing table entry so dispatching of the event requires just a single lookup. Action callables are
+        bound to the target, event and sender in advance so dispatcher only needs to pass the data.
+        """
+        lanes = {}
+        for pipe in self.__pipes.get(route_key, []):
+            invoker = functools.partial(pipe.action.callable, pipe.target, event=pipe.event, sender=pipe.declared_in)
+            duration = self.__action_duration(pipe.target, pipe.action)
+            lanes.setdefault(pipe.priority, []).append((invoker, pipe, duration))
+        if lanes:
+            # Entry is replaced as a whole so dispatchers never see partially built route
+            self.__routes[route_key] = {priority: tuple(invokers) for priority, invokers in sorted(lanes.items())}
+        else:
+            self.__routes.pop(route_key, None)
+
+    def __action_duration(self, device: Module, action: ActionDef, key: Tuple[int, int] = None) -> Histogram:
+        """
+        :param key: (device id, action id) if caller has already built it
+        """
+        histogram = self.__action_durations.get(key or (device.id, action.id))
+        if histogram is None:
+            # Action isn't declared by the device class, e.g. it was added to the instance
+            histogram = self.metrics.histogram('action_duration_ms', 'Duration of action invocation',
+                                               device=device.name, action=action.name)
+        return histogram
+
+    def __sender_kwargs(self, sender) -> dict:
+        """
+        :return: keyword arguments passing the sender to the action. Dictionary is shared by all the calls from the
+                 same sender, so it should never be modified
+        """
+        kwargs = self.__kwargs_by_sender.get(sender)
+        if kwargs is None:
+            kwargs = self.__kwargs_by_sender[sender] = dict(sender=sender)
+        return kwargs
 
-    def run_async_action(self, device: Module, action: ActionDef, data=None, sender=None):
-        self.__bg_tasks_queue.put(BackgroundTask(action.callable, device, data, **dict(sender=sender)))
+    def run_async_action(self, device: Module, action: ActionDef, data=None, sender=None, policy: str = None) -> bool:
+        """
+        :param policy: overflow policy to apply if worker pool queue is full, e.g. callers which can't be trusted
+                       like remote calls might prefer to be rejected. Coalescing key is the device and action
+        :return: False if action was dropped because of queue overflow, so caller might throttle itself
+        """
+        task = BackgroundTask.acquire(action.callable, (device, data), self.__sender_kwargs(sender))
+        task.priority = resolve_priority(action.priority)
+        key = (device.id, action.id)
+        task.metric = self.__action_duration(device, action, key)
+        return self.get_worker_pool(WORKER_POOL_DEFAULT).submit(task, policy, key)
+
+    def emit_event(self, sender: Module, event_id: int, data: dict = None, policy: str = None) -> bool:
+        """
+        :param policy: overflow policy, if not set policy declared by the event or default policy of the queue is used.
+                       Coalescing key is the sender and event
+        :return: False if event was dropped from at least one of the dispatch lanes because of queue overflow
+        """
+        lanes = self.__routes.get((sender.id, event_id))
+        if lanes is None:
+            return True  # Nobody listens for this event
+        if policy is None:
+            event_def = sender.get_event_by_id(event_id)
+            policy = event_def.overflow if event_def is not None else None
+        accepted = True
+        for priority in lanes.keys():
+            # Every lane gets its own event instance, so each of them can release it independently
+            event = InternalEvent.acquire(sender, event_id, data)
+            accepted = self.__dispatch_lanes[priority].put(event, policy) and accepted
+        return accepted
+
+    def request_state_flush(self, device: StateAwareModule):
+        """
+        Schedules emission of the device state at the end of the current scheduler tick, so any number of commits made
+        within the tick result in at most one state_changed event
+        """
+        self.request_flush(device.id, device.flush_state)
+
+    def request_flush(self, key, callback: Callable):
+        """
+        Requests callback to be invoked once the current scheduler tick is over. Requests with the same key made
+        within the tick are coalesced. Might be called from any thread
+        """
+        with self.__pending_flushes_lock:
+            first = not self.__pending_flushes
+            self.__pending_flushes[key] = callback
+        if first:
+            self._wakeup_flush()
+
+    def _wakeup_flush(self):
+        # Main loop flushes after every tick anyway, other threads need to wake it up
+        if threading.get_ident() != self.__main_loop_ident:
+            self.__scheduler.wakeup()
+
+    def _flush_pending(self):
+        with self.__pending_flushes_lock:
+            if not self.__pending_flushes:
+                return
+            pending, self.__pending_flushes = self.__pending_flushes, {}
+        for key, callback in pending.items():
+            try:
+                callback()
+            except Exception as e:
+                self.__logger.error("Flush of {} failed: {}".format(key, e))
 
-    def emit_event(self, sender: Module, event_id: int, data: dict = None):
-        self.__event_queue.put(InternalEvent(sender, event_id, data))
+    def run_async(self, callable, *args, **kwargs) -> bool:
+        return self.submit(WORKER_POOL_DEFAULT, callable, *args, **kwargs)
 
-    def run_async(self, callable, *args, **kwargs):
-        self.__bg_tasks_queue.put(BackgroundTask(callable, *args, **kwargs))
+    def submit(self, pool_name: str, callable, *args, **kwargs) -> bool:
+        return self.get_worker_pool(pool_name).submit(BackgroundTask.acquire(callable, args, kwargs or None))
+
+    def start_metrics_export(self):
+        metrics_settings = self.__instance_settings.metrics
+        if metrics_settings:
+            MetricsExporter(self.metrics, metrics_settings).start(self.thread_manager)
+
+    def start_dispatching(self):
+        """
+        Starts threads responsible for event dispatching and background tasks execution
+        """
+        for lane in self.__dispatch_lanes.values():
+            lane.configure(**self.get_queue_settings(InstanceSettings.QUEUE_EVENTS))
+            self.thread_manager.request_dedicated_thread('EventLoop-' + lane.name, lane.process_batch,
+                                                         wakeup=lane.wakeup)
+        self.start_worker_pools()
 
     def main_loop(self):
+        self.__main_loop_ident = threading.get_ident()
         while not self.__terminating:
-            for device in self.__main_loop:
-                if device.last_step > 0 and utils.delta_time(device.last_step) < device.MINIMAL_ITERATION_INTERVAL:
+            self._flush_pending()
+            for device, due in self.__scheduler.wait_due():
+                self.__main_loop_jitter.observe(utils.clock.tick_time - due)
+                if device.__class__ is DelayedCall:
+                    self._run_delayed_call(device)
+                    continue
+                if device.IN_BACKGROUND:
+                    if device.SCHEDULING_MODE == Module.SCHEDULE_FIXED_RATE:
+                        self.__reschedule(device, due)
+                    if self.__acquire_in_flight(device):
+                        self.__submit_step(device, due)
                     continue
+                started_at = utils.capture_time_ns()
                 try:
-                    if device.IN_BACKGROUND:
-                        self.run_async(device.step)
-                    else:
-                        device.step()
+                    device.step()
                 except Exception as e:
                     self.__logger.error("Error in during main loop execution: " + str(e))
                 finally:
-                    # TODO: For BG task we should update time after actual execution
+                    self._observe_step(device, started_at)
                     device.last_step = utils.capture_time()
-            time.sleep(0.001)
+                    self.__reschedule(device, due)
 
-    def event_loop(self):
-        while not self.__terminating and not self.__event_queue.empty():
-            try:
-                event_task = self.__event_queue.get()  # type: InternalEvent
-                pipes = self.__event_map.get(event_task.event_id, [])
-                for pipe in pipes:
-                    try:
-                        pipe.action.callable(pipe.target, event_task.data, **dict(event=pipe.event, sender=event_task.sender))
-                    except Exception as e:
-                        self.__logger.error("Unhandled error in ${}.{}: {}".format(pipe.target, pipe.action.name, e))
-            except Exception as e:
-                self.__logger.error("Error in during event loop execution: " + str(e))
+    def __submit_step(self, device: Module, due: int):
+        task = BackgroundTask.acquire(self.__background_step, (device, due))
+        task.on_drop = self.__on_step_dropped
+        self.get_worker_pool(device.WORKER_POOL).submit(task)
 
-    def background_tasks_loop(self):
-        while not self.__terminating and not self.__bg_tasks_queue.empty():
-            task = self.__bg_tasks_queue.get() # type: BackgroundTask
-            try:
-                c = task.callable
-                c(*task.args, ** task.kwargs)
-            except Exception as e:
-                self.__logger.error("Unhandled error during background task execution: {}".format(e))
+    def __on_step_dropped(self, task: BackgroundTask):
+        """
+        Step rejected or evicted by the worker pool queue would leave device in flight and unscheduled forever, so
+        device is released and its next step is planned one iteration interval later
+        """
+        device, due = task.args
+        with self.__in_flight_lock:
+            self.__in_flight_steps.pop(device.id, None)
+            self.__step_stats.setdefault(device.id, dict(skipped=0, coalesced=0, dropped=0))['dropped'] += 1
+        if device.SCHEDULING_MODE != Module.SCHEDULE_FIXED_RATE and self.devices.get(device.id) is device:
+            # Counted from now, otherwise step would be retried right away while the queue is still full
+            interval = max(device.MINIMAL_ITERATION_INTERVAL, self.MIN_SCHEDULING_INTERVAL)
+            self.__scheduler.schedule(device, utils.capture_time() + interval, keep_earlier=True)
+
+    def __background_step(self, device: Module, due: int):
+        started_at = utils.capture_time_ns()
+        try:
+            device.step()
+        finally:
+            self._observe_step(device, started_at)
+            device.last_step = utils.capture_time()
+            if self.__release_in_flight(device):
+                # Coalesced step should run right away, it will reschedule device itself once done
+                self.__submit_step(device, due)
+            elif device.SCHEDULING_MODE != Module.SCHEDULE_FIXED_RATE:
+                self.__reschedule(device, due)
+
+    def _observe_step(self, device: Module, started_at: int):
+        """
+        :param started_at: time in nanoseconds
+        """
+        histogram = self.__step_durations.get(device.id)
+        if histogram is not None:
+            histogram.observe((utils.capture_time_ns() - started_at) / 1000000)
+
+    def _observe_jitter(self, delay: int):
+        self.__main_loop_jitter.observe(delay)
+
+    def __acquire_in_flight(self, device: Module) -> bool:
+        """
+        Marks background step of the device as in flight.
+        :return: False if previous step is not finished yet so the new one shouldn't be enqueued
+        """
+        with self.__in_flight_lock:
+            if device.id not in self.__in_flight_steps:
+                self.__in_flight_steps[device.id] = False
+                return True
+            stats = self.__step_stats.setdefault(device.id, dict(skipped=0, coalesced=0, dropped=0))
+            if device.OVERLAP_POLICY == Module.OVERLAP_COALESCE and not self.__in_flight_steps[device.id]:
+                self.__in_flight_steps[device.id] = True
+                stats['coalesced'] += 1
+            else:
+                stats['skipped'] += 1
+            return False
+
+    def __release_in_flight(self, device: Module) -> bool:
+        """
+        :return: True if coalesced step is pending. In this case device remains in flight
+        """
+        with self.__in_flight_lock:
+            if self.__in_flight_steps.get(device.id):
+                self.__in_flight_steps[device.id] = False
+                return True
+            self.__in_flight_steps.pop(device.id, None)
+            return False
+
+    def __reschedule(self, device: Module, due: int):
+        # Step might have been requested while the previous one was running, it shouldn't be postponed
+        self.__scheduler.schedule(device, self._next_due(device, due), keep_earlier=True)
+
+    def _next_due(self, device: Module, due: int) -> int:
+        """
+        :param due: time when the previous step was due
+        :return: time when the next step of the device should be executed
+        """
+        interval = max(device.MINIMAL_ITERATION_INTERVAL, self.MIN_SCHEDULING_INTERVAL)
+        if device.SCHEDULING_MODE == Module.SCHEDULE_FIXED_RATE:
+            next_due = due + interval
+            now = utils.capture_time()
+            if next_due <= now:
+                # We are behind the schedule. Skip missed iterations instead of running them back to back
+                next_due += ((now - next_due) // interval + 1) * interval
+            return next_due
+        return device.last_step + interval
+
+    def _dispatch_event(self, event_task: InternalEvent, priority: int = None):
+        """
+        Invokes actions piped to the event
+        :param priority: if set only pipes of the given priority class are invoked
+        """
+        try:
+            lanes = self.__routes.get((event_task.sender.id, event_task.event_id), {})
+            if priority is None:
+                invokers = [x for lane_invokers in lanes.values() for x in lane_invokers]
+            else:
+                invokers = lanes.get(priority, ())
+            for invoke, pipe, duration in invokers:
+                started_at = utils.capture_time_ns()
+                try:
+                    invoke(event_task.data)
+                except Exception as e:
+                    self.__logger.error("Unhandled error in ${}.{}: {}".format(pipe.target, pipe.action.name, e))
+                finished_at = utils.capture_time_ns()
+                duration.observe((finished_at - started_at) / 1000000)
+                self.__event_latency[pipe.priority].observe((finished_at - event_task.created_at) / 1000000)
+        except Exception as e:
+            self.__logger.error("Error in during event loop execution: " + str(e))
 
     def shutdown(self):
         self.__logger.info("Initiating shutdown process")
         self.__terminating = True
+        self.__scheduler.stop()
+        self._flush_pending()  # Apply everything requested within the last tick, e.g. writes to outputs
         for device in self.devices.values():
             try:
                 device.on_before_destroyed()
             except Exception as e:
                 self.__logger.error(
                     "Error while destroying device {}({}): {}".format(int_to_hex4str(device.id), device.name, e))
+        self._flush_pending()  # Devices might switch outputs off while being destroyed
         self.__logger.info("Deactivated devices")
         for driver in self.drivers.values():
             try:
@@ -1,5 +1,9 @@
-from typing import List, Callable
+import threading
 
+from typing import List, Callable, Dict, Hashable, Tuple
+
+from common import utils
+from .core import Counter
 from .model import Driver
 
 
@@ -26,6 +30,156 @@ class GPIODriver(Driver):
         def reset(self):
             self.write(False)
 
+        def subscribe(self, callback: Callable) -> bool:
+            """
+            Requests callback to be invoked on every change of the input level, so reader doesn't need to poll it.
+            Callback accepts new level and time of the change in milliseconds and is invoked from the driver thread
+            or the application event loop
+            :return: False if driver can't detect changes and channel should be polled
+            """
+            return False
+
+        def unsubscribe(self, callback: Callable):
+            pass
+
+    class LineGroup(object):
+        """
+        Channels read or written with a single call, e.g. relays switched by a scene or keypad scanned every tick.
+        Default implementation accesses channels one by one, drivers override it to access hardware once per group
+        whenever possible.
+        """
+
+        def __init__(self, channels: List['GPIODriver.Channel']):
+            self.channels = list(channels)
+
+        def read(self, reverse=False) -> List[int]:
+            """
+            :return: levels of all the lines in the order of channels
+            """
+            return [channel.read(reverse) for channel in self.channels]
+
+        def write(self, states: List[int]):
+            """
+            :param states: levels of all the lines in the order of channels
+            """
+            if len(states) != len(self.channels):
+                raise ValueError('Expected {} states, got {}'.format(len(self.channels), len(states)))
+            for channel, state in zip(self.channels, states):
+                channel.write(state)
+
+    class ShadowRegister(object):
+        """
+        Cached levels of the driver lines, so hardware is accessed only when needed. Input is read from hardware at
+        most once per scheduler tick and shared by all the readers of the line. Lines reporting edges are updated by
+        edge events and aren't read at all. Writes to outputs are collected and applied once per tick: only the last
+        level written within the tick is applied and only if line doesn't have this level already.
+        """
+        MAX_AGE = 10  # Milliseconds. Level read within the tick is not reused past this age, e.g. during long tick
+
+        def __init__(self, write_line: Callable, application=None, **labels):
+            """
+            :param write_line: callable accepting line and level which writes level to hardware
+            :param application: application to flush writes at the end of the tick and to expose counters through.
+                                Writes are applied immediately if not set
+            :type application: common.core.ApplicationManager
+            :param labels: labels of the exposed counters, e.g. driver name
+            """
+            self.__write_line = write_line
+            self.__application = application
+            self.__inputs = {}  # type: Dict[Hashable, Tuple[int, int, int]] # Line -> (level, tick id, read time)
+            self.__outputs = {}  # type: Dict[Hashable, int] # Line -> level applied to hardware
+            self.__pending = {}  # type: Dict[Hashable, int] # Line -> level to apply on flush
+            self.__lock = threading.Lock()
+            if application is not None:
+                metrics = application.metrics
+                self.hits = metrics.counter('gpio_shadow_hits_total', 'Reads served from shadow register', **labels)
+                self.misses = metrics.counter('gpio_shadow_misses_total', 'Reads which accessed hardware', **labels)
+                self.writes = metrics.counter('gpio_shadow_writes_total', 'Writes applied to hardware', **labels)
+                self.skipped_writes = metrics.counter('gpio_shadow_skipped_writes_total',
+                                                      'Writes coalesced or skipped as redundant', **labels)
+            else:
+                self.hits, self.misses, self.writes, self.skipped_writes = Counter(), Counter(), Counter(), Counter()
+
+        def read(self, line: Hashable, read_line: Callable) -> int:
+            """
+            :param read_line: callable without arguments reading level from hardware, invoked on cache miss
+            """
+            cached = self.__inputs.get(line)
+            if cached is not None and (cached[1] is None or cached[1] == utils.clock.tick_id
+                                       and utils.capture_time() - cached[2] <= self.MAX_AGE):
+                self.hits.inc()
+                return cached[0]
+            self.misses.inc()
+            level = read_line()
+            self.__inputs[line] = (level, utils.clock.tick_id, utils.capture_time())
+            return level
+
+        def read_output(self, line: Hashable, read_line: Callable) -> int:
+            """
+            :return: the last written level even if it is not applied yet
+            """
+            level = self.__pending.get(line, self.__outputs.get(line))
+            if level is not None:
+                self.hits.inc()
+                return level
+            self.misses.inc()
+            return read_line()
+
+        def update(self, line: Hashable, level: int):
+            """
+            Stores level reported by edge event. It stays valid until the next edge
+            """
+            self.__inputs[line] = (level, None, 0)
+
+        def forget(self, line: Hashable):
+            """
+            Drops cached levels of the line, e.g. once it stops reporting edges or is released
+            """
+            self.__inputs.pop(line, None)
+            self.__outputs.pop(line, None)
+
+        def written(self, line: Hashable, level: int):
+            """
+            Records level written to hardware bypassing the register, e.g. by line group accessing port registers.
+            Pending write of the line is dropped, so it doesn't override the newer level on flush
+            """
+            with self.__lock:
+                self.__pending.pop(line, None)
+            self.__outputs[line] = level
+
+        def write(self, line: Hashable, level: int):
+            with self.__lock:
+                first = not self.__pending
+                if line in self.__pending:
+                    self.skipped_writes.inc()
+                self.__pending[line] = level
+            if self.__application is None:
+                self.flush()
+            elif first:
+                self.__application.request_flush(self, self.flush)
+
+        def flush(self):
+            """
+            Applies pending writes which change level of the line
+            """
+            with self.__lock:
+                pending, self.__pending = self.__pending, {}
+            for line, level in pending.items():
+                if self.__outputs.get(line) == level:
+                    self.skipped_writes.inc()
+                    continue
+                self.__write_line(line, level)
+                self.__outputs[line] = level
+                self.writes.inc()
+
+        def get_stats(self) -> Dict[str, int]:
+            return {
+                'hits': self.hits.value,
+                'misses': self.misses.value,
+                'writes': self.writes.value,
+                'skipped_writes': self.skipped_writes.value
+            }
+
     @staticmethod
     def typeid() -> int:
         return 0x1001
@@ -43,6 +197,12 @@ class GPIODriver(Driver):
     def new_channel(self, pin: [str, int], direction: int, pullup=True) -> Channel:
         pass
 
+    def new_line_group(self, channels: List[Channel]) -> LineGroup:
+        """
+        :param channels: channels created by this driver
+        """
+        return GPIODriver.LineGroup(channels)
+
 
 class ModuleDiscoveryDriver(Driver):
     @staticmethod
@@ -1,18 +1,52 @@
+import asyncio
 import json
 
 import logging
-from typing import List, Dict, Callable
+import re
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Callable, Tuple
 
-from common.utils import int_to_hex4str
-from .errors import InvalidDriverError
+from common import validators
+from common.utils import int_to_hex4str, capture_time, capture_time_ns
+from .errors import ConfigError, InvalidDriverError
+from .queues import OVERFLOW_COALESCE
 
 EVENT_STATE_CHANGED = 0x91
 
+PRIORITY_INTERACTIVE = 0  # Direct reaction on user input e.g. button -> lamp
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2  # Telemetry, state synchronization, logging
+
+PRIORITIES = {
+    'interactive': PRIORITY_INTERACTIVE,
+    'normal': PRIORITY_NORMAL,
+    'bulk': PRIORITY_BULK,
+}
+
+WORKER_POOL_DEFAULT = 'default'
+WORKER_POOL_IO = 'io'  # Intended for tasks doing blocking I/O e.g. reading slow sensors
+
 
 class InstanceSettings:
+    RUNTIME_THREADED = 'threaded'
+    RUNTIME_ASYNCIO = 'asyncio'
+
+    RUNTIMES = (RUNTIME_THREADED, RUNTIME_ASYNCIO)
+
+    QUEUE_EVENTS = 'events'  # Dispatch lanes
+    QUEUE_TASKS = 'tasks'  # Worker pools
+
+    QUEUES = (QUEUE_EVENTS, QUEUE_TASKS)
+
     def __init__(self):
         self.id = None
+        self.runtime = InstanceSettings.RUNTIME_THREADED
         self.context_path = []
+        self.worker_pools = {}  # type: Dict[str, int]
+        self.metrics = {}  # Metrics export settings
+        self.profiler = {}  # Sampling profiler settings
+        self.queues = {}  # type: Dict[str, dict] # Queue name -> capacity, overflow policy and block timeout
 
 
 class Driver(object):
@@ -27,6 +61,12 @@ class Driver(object):
     def type_name() -> str:
         raise InvalidDriverError('Driver class should implement type_name() method')
 
+    def configure(self, options: dict):
+        """
+        Invoked before on_initialized with the driver definition from config except class name
+        """
+        pass
+
     def on_initialized(self, application):
         """
         :type application: common.core.ApplicationManager
@@ -42,22 +82,40 @@ class Driver(object):
         pass
 
 
+def resolve_priority(*declared: [int, None]) -> int:
+    """
+    :param declared: priorities declared by different parties in order of precedence, None if party doesn't
+                     declare any
+    :return: the first declared priority or PRIORITY_NORMAL if nothing is declared
+    """
+    for priority in declared:
+        if priority is not None:
+            return priority
+    return PRIORITY_NORMAL
+
+
 class EventDef:
-    def __init__(self, id: int, name: str):
+    def __init__(self, id: int, name: str, priority: int = None, overflow: str = None):
+        """
+        :param overflow: overflow policy applied when dispatch queue is full, one of common.queues.OVERFLOW_POLICIES
+        """
         super().__init__()
         self.id = id
         self.name = name
+        self.priority = priority
+        self.overflow = overflow
 
     def __repr__(self, *args, **kwargs):
         return 'EventDef({}, {})'.format(int_to_hex4str(self.id), self.name)
 
 
 class ActionDef:
-    def __init__(self, id: int, name: str, function):
+    def __init__(self, id: int, name: str, function, priority: int = None):
         super().__init__()
         self.id = id
         self.name = name
         self.callable = function
+        self.priority = priority
 
     def __repr__(self, *args, **kwargs):
         return 'ActionDef({}, {})'.format(int_to_hex4str(self.id), self.name)
@@ -102,50 +160,195 @@ class Serializer(object):
 
 class JsonSerializer(Serializer):
     def serialize(self, obj: object):
-        json.dumps(obj)
+        return json.dumps(obj)
 
     def deserialize(self, data: str):
         return json.loads(data)
 
 
 class ModelState(object):
-    __DEFAULT_FILED_NAME = '$default'
+    """
+    Base class of module state. Concrete state classes are generated for the list of fields: every field is stored
+    in its own slot and exposed as property, so reads and writes don't go through dynamic attribute lookup. Writes
+    which change the value mark the field dirty and increment the version. Calling ModelState(fields) directly
+    instantiates generated class for these fields.
+    State might be written by the module on worker thread while it is being emitted on the main loop, so writes
+    and snapshots are serialized by the lock of the state.
+    """
+    __slots__ = ('serializer', '_dirty', '_version', '_lock')
+    __DEFAULT_FIELD_NAME = '$default'
+    __classes = {}  # Tuple of fields -> generated class
+
+    fields = ()  # type: Tuple[str, ...]
+    _slots = ()  # type: Tuple[str, ...] # Slot names in the same order as fields
+
+    def __new__(cls, fields: List[str] = None, serializer: Serializer = None):
+        if cls is ModelState:
+            cls = ModelState.class_for(fields)
+        return object.__new__(cls)
+
+    def __init__(self, fields: List[str] = None, serializer: Serializer = None):
+        self.serializer = serializer if serializer is not None else _DEFAULT_SERIALIZER
+        self._dirty = 0
+        self._version = 0
+        self._lock = threading.Lock()
+        for slot in self._slots:
+            object.__setattr__(self, slot, None)
+
+    @classmethod
+    def class_for(cls, fields: [List[str], None]) -> type:
+        """
+        :return: state class for the given fields. Classes are cached, so modules with the same fields share a class
+        """
+        fields = tuple(fields) if fields else (cls.__DEFAULT_FIELD_NAME,)
+        state_class = ModelState.__classes.get(fields)
+        if state_class is None:
+            state_class = ModelState.__classes[fields] = ModelState.__generate(fields)
+        return state_class
+
+    @staticmethod
+    def __generate(fields: Tuple[str, ...]) -> type:
+        # Field names aren't necessarily valid identifiers, so slots are named by field position
+        slots = tuple('_f{}'.format(i) for i in range(len(fields)))
+        namespace = {'__slots__': slots, 'fields': fields, '_slots': slots}
+        for bit, (field, slot) in enumerate(zip(fields, slots)):
+            namespace[field] = ModelState.__field_property(slot, 1 << bit)
+        return type('State_' + '_'.join(f for f in fields if f.isidentifier()), (ModelState,), namespace)
+
+    @staticmethod
+    def __field_property(slot: str, mask: int) -> property:
+        def get(self):
+            return getattr(self, slot)
+
+        def set(self, value):
+            with self._lock:
+                if getattr(self, slot) != value:
+                    object.__setattr__(self, slot, value)
+                    self._dirty |= mask
+                    self._version += 1
+
+        return property(get, set)
+
+    @property
+    def version(self) -> int:
+        """
+        Incremented every time value of any field is changed
+        """
+        return self._version
 
-    def __init__(self, fields: List[str] = None, serializer: Serializer = JsonSerializer()):
-        self.fields = fields
-        self.__data = {}
-        self.serializer = serializer
-        if self.fields is None:
-            self.fields = [self.__DEFAULT_FILED_NAME]
+    @property
+    def is_dirty(self) -> bool:
+        return self._dirty != 0
+
+    def dirty_fields(self) -> List[str]:
+        """
+        :return: fields changed since the last clear_dirty() call
+        """
+        return [field for bit, field in enumerate(self.fields) if self._dirty & (1 << bit)]
+
+    def clear_dirty(self):
+        with self._lock:
+            self._dirty = 0
+
+    def values(self) -> tuple:
+        """
+        :return: values of all the fields in the order of fields
+        """
+        return tuple(getattr(self, slot) for slot in self._slots)
+
+    def snapshot(self, clear_dirty: bool = False) -> 'StateSnapshot':
+        """
+        :param clear_dirty: clear dirty fields atomically with taking the snapshot, so concurrent write is either
+                            captured by the snapshot or remains dirty
+        :return: immutable copy of the current state which is safe to pass to other threads
+        """
+        with self._lock:
+            if clear_dirty:
+                self._dirty = 0
+            return StateSnapshot(self.fields, self.values(), self._version, self.serializer)
 
     def read_state(self, data: str):
-        self.__data = self.serializer.deserialize(data)
+        values = self.serializer.deserialize(data)
+        for field in self.fields:
+            if field in values:
+                setattr(self, field, values[field])
 
     def serialize_state(self):
-        self.serializer.serialize(self.__data)
+        return self.serializer.serialize(self.as_dict())
 
     def as_dict(self):
-        return dict(self.__data)
+        return dict(zip(self.fields, self.values()))
+
+
+class StateSnapshot(object):
+    """
+    Immutable versioned copy of module state. Snapshot is created once per emitted state and shared by all the
+    event targets, so they never observe state being modified by the module meanwhile. Dictionary and serialized
+    representations are computed on first request and cached. Field values themselves are not copied, so they
+    should be treated as read only as well as the dictionary returned by as_dict().
+    """
+    __slots__ = ('fields', 'values', 'version', '__serializer', '__dict', '__serialized', '__encoded')
+
+    def __init__(self, fields: Tuple[str, ...], values: tuple, version: int, serializer: Serializer = None):
+        set_attr = object.__setattr__
+        set_attr(self, 'fields', fields)
+        set_attr(self, 'values', values)
+        set_attr(self, 'version', version)
+        set_attr(self, '_StateSnapshot__serializer', serializer if serializer is not None else _DEFAULT_SERIALIZER)
+        set_attr(self, '_StateSnapshot__dict', None)
+        set_attr(self, '_StateSnapshot__serialized', None)
+        set_attr(self, '_StateSnapshot__encoded', None)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('State snapshot is immutable')
+
+    def __delattr__(self, key):
+        raise AttributeError('State snapshot is immutable')
+
+    def __getattr__(self, name):
+        # Invoked only for names which aren't slots, so fields might be read the same way as from ModelState
+        try:
+            return self.values[self.fields.index(name)]
+        except ValueError:
+            raise AttributeError("State has no field '{}'".format(name))
+
+    def as_dict(self) -> dict:
+        if self.__dict is None:
+            object.__setattr__(self, '_StateSnapshot__dict', dict(zip(self.fields, self.values)))
+        return self.__dict
+
+    def serialize_state(self) -> str:
+        if self.__serialized is None:
+            object.__setattr__(self, '_StateSnapshot__serialized', self.__serializer.serialize(self.as_dict()))
+        return self.__serialized
+
+    def encode_fields(self, encoder: Callable) -> List[Tuple[str, object]]:
+        """
+        Encodes every field separately, e.g. for protocols publishing each field to its own topic. Result is cached
+        for the last used encoder, so encoder should be the same function for all the callers
+        :param encoder: callable accepting field value and returning its encoded representation
+        :return: list of (field, encoded value)
+        """
+        cached = self.__encoded
+        if cached is None or cached[0] is not encoder:
+            cached = (encoder, [(field, encoder(value)) for field, value in zip(self.fields, self.values)])
+            object.__setattr__(self, '_StateSnapshot__encoded', cached)
+        return cached[1]
 
-    def __getattr__(self, item):
-        if item == 'fields':
-            return object.__getattribute__(self, item)
-        if item in self.fields:
-            return self.__data.get(item, None)
-        else:
-            return self.__getattribute__(item)
+    def __repr__(self):
+        return 'StateSnapshot(version={}, {})'.format(self.version, self.as_dict())
 
-    def __setattr__(self, name, value):
-        if name != 'fields':
-            if name in self.fields:
-                self.__data[name] = value
-            else:
-                return object.__setattr__(self, name, value)
-        else:
-            return object.__setattr__(self, name, value)
+
+_DEFAULT_SERIALIZER = JsonSerializer()
 
 
 class Module:
+    SCHEDULE_FIXED_DELAY = 'fixed_delay'  # Next step is planned relatively to the end of the previous one
+    SCHEDULE_FIXED_RATE = 'fixed_rate'  # Next step is planned relatively to the time previous one was due
+
+    OVERLAP_SKIP = 'skip'  # Step which becomes due while previous one is still running is dropped
+    OVERLAP_COALESCE = 'coalesce'  # All such steps are merged into a single one executed after the running step
+
     EVENTS = []
     ACTIONS = []  # type: List[ActionDef]
     PARAMS = []  # type: List[ParameterDef]
@@ -153,6 +356,9 @@ class Module:
     IN_LOOP = True  # Indicates that instance of of this module will be queried (step method) in main application loop
     IN_BACKGROUND = False
     MINIMAL_ITERATION_INTERVAL = 0  # Minimum interval between iterations in milliseconds
+    SCHEDULING_MODE = SCHEDULE_FIXED_DELAY
+    WORKER_POOL = WORKER_POOL_DEFAULT  # Pool used to run step of IN_BACKGROUND module
+    OVERLAP_POLICY = OVERLAP_SKIP  # Defines what to do with IN_BACKGROUND step if previous one is not finished yet
 
     def __init__(self, application, drivers: Dict[int, Driver]):
         """
@@ -179,10 +385,16 @@ class Module:
     def type_name() -> str:
         raise InvalidDriverError('Module class should implement type_name() method')
 
-    def emit(self, event_id, data=None):
-        self.__application.emit_event(self, event_id, data)
+    def emit(self, event_id, data=None) -> bool:
+        """
+        :return: False if event was dropped because application is overloaded
+        """
+        return self.__application.emit_event(self, event_id, data)
 
     def step(self):
+        """
+        Might be defined as coroutine. In this case module can be used only with asyncio runtime
+        """
         pass
 
     def on_initialized(self):
@@ -194,63 +406,338 @@ class Module:
     def validate(self):
         pass
 
+    @classmethod
+    def is_async(cls) -> bool:
+        """
+        :return: True if step or any of actions is defined as coroutine
+        """
+        return asyncio.iscoroutinefunction(cls.step) \
+            or any(asyncio.iscoroutinefunction(x.callable) for x in cls.ACTIONS)
+
+    @classmethod
+    def get_events(cls) -> List[EventDef]:
+        return cls.EVENTS
+
+    @classmethod
+    def get_params(cls) -> List[ParameterDef]:
+        return cls.PARAMS
+
+    @classmethod
+    def build_index(cls):
+        """
+        Builds lookup tables for events and actions declared by the module class. Normally it is done when module is
+        registered, otherwise tables are built on first lookup.
+        """
+        events_by_name, events_by_id, actions_by_name, actions_by_id = {}, {}, {}, {}
+        for x in cls.get_events():
+            events_by_name.setdefault(x.name, x)
+            events_by_id.setdefault(x.id, x)
+        for x in cls.ACTIONS:
+            actions_by_name.setdefault(x.name, x)
+            actions_by_id.setdefault(x.id, x)
+        cls._events_by_name, cls._events_by_id = events_by_name, events_by_id
+        cls._actions_by_name, cls._actions_by_id = actions_by_name, actions_by_id
+
+    @classmethod
+    def __ensure_index(cls):
+        # Index attributes are looked up in class own dict since subclass must not reuse index of its parent
+        if '_actions_by_id' not in cls.__dict__:
+            cls.build_index()
+
     @classmethod
     def get_event_by_name(cls, event_name: str) -> [EventDef, None]:
-        for x in cls.EVENTS:
-            if x.name == event_name:
-                return x
-        return None
+        cls.__ensure_index()
+        return cls._events_by_name.get(event_name)
+
+    @classmethod
+    def get_event_by_id(cls, event_id: int) -> [EventDef, None]:
+        cls.__ensure_index()
+        return cls._events_by_id.get(event_id)
 
     @classmethod
     def get_action_by_name(cls, action_name: str) -> [ActionDef, None]:
-        for x in cls.ACTIONS:
-            if x.name == action_name:
-                return x
-        return None
+        cls.__ensure_index()
+        return cls._actions_by_name.get(action_name)
+
+    @classmethod
+    def get_action_by_id(cls, action_id: int) -> [ActionDef, None]:
+        cls.__ensure_index()
+        return cls._actions_by_id.get(action_id)
 
     def __str__(self, *args, **kwargs):
         return '{}({})'.format(self.type_name(), int_to_hex4str(self.typeid()))
 
 
 class StateAwareModule(Module):
+    """
+    Module publishing its state with state_changed event. Event is emitted only if state differs from the last
+    emitted one: numeric fields might define deadband, so the change is considered significant only if it exceeds
+    absolute value or percentage of the last emitted value. All the commits made within one scheduler tick are
+    coalesced into a single event. If max_silence is set, state is emitted at least once per this interval even if
+    nothing has changed.
+    """
     STATE_FIELDS = None
 
     def __init__(self, application, drivers: Dict[int, Driver]):
         super().__init__(application, drivers)
-        self.EVENTS += StateAwareModule.EVENTS
-        self.state = ModelState(self.STATE_FIELDS)
+        self.state = self.get_state_class()()
+        self.max_silence = 0  # Milliseconds, 0 disables heartbeat
+        self.__deadband = {}  # type: Dict[str, Tuple[float, float]] # Field -> (absolute, relative)
+        self.__deadband_by_index = [None] * len(self.state.fields)  # type: List[Tuple[float, float]]
+        self.__emitted = None  # type: StateSnapshot # The last emitted state
+        self.__emitted_at = 0
+
+    @classmethod
+    def get_events(cls) -> List[EventDef]:
+        events = list(cls.EVENTS)
+        for x in StateAwareModule.EVENTS:
+            if x not in events:
+                events.append(x)
+        return events
+
+    @classmethod
+    def get_params(cls) -> List[ParameterDef]:
+        params = list(cls.PARAMS)
+        for x in StateAwareModule.STATE_PARAMS:
+            if not any(p.name == x.name for p in params):
+                params.append(x)
+        return params
+
+    @classmethod
+    def build_index(cls):
+        super().build_index()
+        cls._state_class = ModelState.class_for(cls.STATE_FIELDS)
+
+    @classmethod
+    def get_state_class(cls) -> type:
+        """
+        :return: ModelState subclass generated for STATE_FIELDS. Normally it is generated when module is registered
+        """
+        # Looked up in class own dict since subclass might declare different fields
+        if '_state_class' not in cls.__dict__:
+            cls._state_class = ModelState.class_for(cls.STATE_FIELDS)
+        return cls._state_class
+
+    @property
+    def deadband(self) -> Dict[str, Tuple[float, float]]:
+        return self.__deadband
+
+    @deadband.setter
+    def deadband(self, value: dict):
+        """
+        :param value: dictionary of field name to absolute deadband (0.5) or relative one as percentage ('2%')
+        """
+        if not isinstance(value, dict):
+            raise ConfigError('deadband should be dictionary of state field to absolute value or percentage')
+        deadband = {}
+        for field, band in value.items():
+            if field not in self.state.fields:
+                raise ConfigError('Unknown state field {}. Available: {}'.format(field, list(self.state.fields)))
+            deadband[field] = self.__parse_deadband(field, band)
+        self.__deadband = deadband
+        self.__deadband_by_index = [deadband.get(field) for field in self.state.fields]
+
+    @staticmethod
+    def __parse_deadband(field: str, band: [int, float, str]) -> Tuple[float, float]:
+        try:
+            if isinstance(band, str) and band.strip().endswith('%'):
+                absolute, relative = 0.0, float(band.strip()[:-1]) / 100
+            elif isinstance(band, (int, float)) and not isinstance(band, bool):
+                absolute, relative = float(band), 0.0
+            else:
+                raise ValueError(band)
+        except ValueError:
+            raise ConfigError('Deadband of {} should be number or percentage string like \'2%\', got {}'
+                              .format(field, band))
+        if absolute < 0 or relative < 0:
+            raise ConfigError('Deadband of {} should not be negative'.format(field))
+        return absolute, relative
 
     def commit_state(self):
-        self.emit(EVENT_STATE_CHANGED, self.state)
+        """
+        Requests state to be emitted once the current scheduler tick is over
+        """
+        self.get_application_manager().request_state_flush(self)
+
+    def flush_state(self, force: bool = False) -> bool:
+        """
+        Emits state_changed event if state changed significantly since the last emission or heartbeat is due.
+        Normally it is invoked by the application at the end of the tick in which state was committed.
+        :param force: emit even if state didn't change
+        :return: True if event was emitted
+        """
+        state = self.state
+        now = capture_time()
+        if not (force or self.__emitted is None or (state.is_dirty and self.__is_significant(state.values()))
+                or (self.max_silence and now - self.__emitted_at >= self.max_silence)):
+            return False
+        # Targets receive immutable snapshot, so they can read it on other threads while state is being modified
+        snapshot = state.snapshot(clear_dirty=True)
+        self.__emitted = snapshot
+        self.__emitted_at = now
+        self.emit(EVENT_STATE_CHANGED, snapshot)
+        return True
+
+    def heartbeat(self):
+        """
+        Emits state if nothing was emitted for max_silence. Invoked periodically by the application
+        """
+        if self.max_silence and capture_time() - self.__emitted_at >= self.max_silence:
+            self.commit_state()
+
+    def __is_significant(self, values: tuple) -> bool:
+        for value, emitted, band in zip(values, self.__emitted.values, self.__deadband_by_index):
+            if value == emitted:
+                continue
+            if band is None or not isinstance(value, (int, float)) or not isinstance(emitted, (int, float)):
+                return True
+            absolute, relative = band
+            if abs(value - emitted) >= max(absolute, relative * abs(emitted)):
+                return True
+        return False
 
     EVENTS = [
-        EventDef(EVENT_STATE_CHANGED, 'state_changed')
+        # Only the latest state matters, so pending notification is replaced by the newer one
+        EventDef(EVENT_STATE_CHANGED, 'state_changed', priority=PRIORITY_BULK, overflow=OVERFLOW_COALESCE)
+    ]
+    STATE_PARAMS = [
+        ParameterDef('deadband'),
+        ParameterDef('max_silence', validators=(validators.integer,)),
     ]
 
 
 class PipedEvent(object):
+    __slots__ = ('declared_in', 'event', 'target', 'args', 'action', 'priority')
+
     def __init__(self, declared_in: Module = None, target: Module = None, event: EventDef = None,
                  action: ActionDef = None,
-                 args: dict = None):
+                 args: dict = None, priority: int = None):
         self.declared_in = declared_in
         self.event = event
         self.target = target
         self.args = args
         self.action = action
+        self.priority = priority
+        if self.priority is None:
+            # Action knows best how expensive it is, e.g. bulk action stays in bulk lane even if it is piped to
+            # interactive event, so it doesn't delay interactive pipes of other targets
+            self.priority = resolve_priority(action.priority if action else None, event.priority if event else None)
+
+
+class Freelist(object):
+    """
+    Bounded stack of released objects ready for reuse. Relies on atomicity of list append and pop, so doesn't need
+    locking. Counters are statistics only and might be slightly off under contention.
+    """
+    __slots__ = ('capacity', 'items', 'allocated', 'reused')
+
+    def __init__(self, capacity: int):
+        """
+        :param capacity: max number of objects kept for reuse, 0 disables reuse
+        """
+        self.capacity = capacity
+        self.items = []
+        self.allocated = 0
+        self.reused = 0
+
+    def pop(self):
+        """
+        :return: released object or None if there is nothing to reuse
+        """
+        try:
+            obj = self.items.pop()
+        except IndexError:
+            self.allocated += 1
+            return None
+        self.reused += 1
+        return obj
+
+    def push(self, obj):
+        if len(self.items) < self.capacity:
+            self.items.append(obj)
+
+    def get_stats(self) -> Dict[str, int]:
+        return dict(allocated=self.allocated, reused=self.reused, free=len(self.items))
 
 
 class InternalEvent(object):
+    """
+    Event on its way from the sender to the dispatcher. Instances obtained with acquire() are recycled once released,
+    so dispatcher shouldn't keep references to the event after release()
+    """
+    __slots__ = ('sender', 'event_id', 'data', 'created_at')
+
+    freelist = Freelist(1024)
+
     def __init__(self, sender: Module = None, event_id: int = None, data: dict = None):
         self.sender = sender
         self.event_id = event_id
         self.data = data
+        self.created_at = capture_time_ns()
+
+    @classmethod
+    def acquire(cls, sender: Module, event_id: int, data=None) -> 'InternalEvent':
+        event = cls.freelist.pop()
+        if event is None:
+            return cls(sender, event_id, data)
+        event.sender = sender
+        event.event_id = event_id
+        event.data = data
+        event.created_at = capture_time_ns()
+        return event
+
+    def release(self):
+        # Drop references so recycled event doesn't keep sender's data alive
+        self.sender = None
+        self.data = None
+        InternalEvent.freelist.push(self)
 
 
 class BackgroundTask(object):
+    """
+    Callable with arguments waiting for execution in the worker pool. Instances obtained with acquire() are recycled
+    once released
+    """
+    __slots__ = ('callable', 'args', 'kwargs', 'enqueued_at', 'priority', 'metric', 'on_drop')
+
+    freelist = Freelist(256)
+
     def __init__(self, callable: Callable, *args, **kwargs):
+        self.__reset(callable, args, kwargs)
+
+    def __reset(self, callable: Callable, args: tuple, kwargs: [dict, None]):
         self.callable = callable
-        self.kwargs = kwargs
         self.args = args
+        self.kwargs = kwargs  # None if there are no keyword arguments, so no empty dict is created per task
+        self.enqueued_at = None
+        self.priority = PRIORITY_NORMAL
+        self.metric = None  # Histogram to record execution time to, e.g. per action histogram
+        self.on_drop = None  # Callable accepting the task, invoked if task is rejected or evicted by worker pool queue
+
+    @classmethod
+    def acquire(cls, callable: Callable, args: tuple = (), kwargs: dict = None) -> 'BackgroundTask':
+        """
+        :param kwargs: keyword arguments. Dictionary is never modified so it might be shared between tasks
+        """
+        task = cls.freelist.pop()
+        if task is None:
+            task = cls.__new__(cls)
+        task.__reset(callable, args, kwargs)
+        return task
+
+    def run(self):
+        if self.kwargs:
+            self.callable(*self.args, **self.kwargs)
+        else:
+            self.callable(*self.args)
+
+    def release(self):
+        self.callable = None
+        self.args = None
+        self.kwargs = None
+        self.metric = None
+        self.on_drop = None
+        BackgroundTask.freelist.push(self)
 
 
 class ACL(object):
@@ -264,6 +751,9 @@ class ACL(object):
 
     SUPPORTED_TARGET_TYPES = (TARGET_TYPE_ACTION, TARGET_TYPE_EVENT)
 
+    WILDCARD = '*'
+    DECISION_CACHE_SIZE = 4096
+
     class Entry(object):
         def __init__(self, device_name: str = None,
                      target_type: str = None,
@@ -284,19 +774,97 @@ class ACL(object):
                 raise ValueError("ACL.Entry.target type should be one of: " + str(ACL.SUPPORTED_TARGET_TYPES))
             self.__target_type = val
 
+    class RuleSet(object):
+        """
+        Compiled collection of ACL entries. Every entry is indexed by the literal part of its names, so lookup
+        hashes the checked names instead of scanning the rules:
+        - exact entries, e.g. '#lamp.toggle', are kept in hash set;
+        - entries with exact device name, e.g. '#lamp.*', are found by device name;
+        - entries with wildcard device and exact target name, e.g. '#*.toggle', are found by target name;
+        - remaining entries, e.g. '#bedroom_*.set_*', are found by the literal prefix of device name. Lookup probes
+          one bucket per distinct prefix length.
+        Only patterns of the found buckets are matched.
+        """
+
+        def __init__(self):
+            self.entries = []  # type: List[ACL.Entry]
+            self.__exact = set()  # (target type, device, target)
+            self.__by_device = {}  # type: Dict[Tuple[str, str], List] # (target type, device) -> target patterns
+            self.__by_target = {}  # type: Dict[Tuple[str, str], List] # (target type, target) -> device patterns
+            self.__by_prefix = {}  # type: Dict[Tuple[str, str], List] # (target type, device prefix) -> patterns
+            self.__prefix_lengths = []  # Distinct lengths of device prefixes, longest first
+            self.__target_types = set()
+
+        def add(self, entry):
+            """
+            :type entry: ACL.Entry
+            """
+            self.entries.append(entry)
+            if entry.target_name is None:
+                return  # Entry without target name doesn't match anything
+            target_type, device, target = entry.target_type, entry.device_name, entry.target_name
+            self.__target_types.add(target_type)
+            if ACL.WILDCARD not in device:
+                if ACL.WILDCARD not in target:
+                    self.__exact.add((target_type, device, target))
+                else:
+                    self.__by_device.setdefault((target_type, device), []).append(self.__compile(target))
+            elif ACL.WILDCARD not in target:
+                self.__by_target.setdefault((target_type, target), []).append(self.__compile(device))
+            else:
+                prefix = device[:device.index(ACL.WILDCARD)]
+                self.__by_prefix.setdefault((target_type, prefix), []).append(
+                    self.__compile(device + '\x00' + target))
+                if len(prefix) not in self.__prefix_lengths:
+                    self.__prefix_lengths = sorted(self.__prefix_lengths + [len(prefix)], reverse=True)
+
+        def has_rules(self, target_type: str) -> bool:
+            return target_type in self.__target_types
+
+        def matches(self, device_name: str, target_name: str, target_type: str) -> bool:
+            if (target_type, device_name, target_name) in self.__exact:
+                return True
+            for pattern in self.__by_device.get((target_type, device_name), ()):
+                if pattern.match(target_name):
+                    return True
+            for pattern in self.__by_target.get((target_type, target_name), ()):
+                if pattern.match(device_name):
+                    return True
+            if self.__by_prefix:
+                name = None
+                for length in self.__prefix_lengths:
+                    if length > len(device_name):
+                        continue
+                    patterns = self.__by_prefix.get((target_type, device_name[:length]))
+                    if patterns:
+                        name = name or device_name + '\x00' + target_name
+                        for pattern in patterns:
+                            if pattern.match(name):
+                                return True
+            return False
+
+        @staticmethod
+        def __compile(pattern: str):
+            # Wildcard never crosses the separator of device and target names
+            return re.compile('[^\x00]*'.join(re.escape(x) for x in pattern.split(ACL.WILDCARD)) + '\\Z')
+
     def __init__(self):
         super().__init__()
-        self.__allowed = []
-        self.__denied = []
+        self.__allowed = ACL.RuleSet()
+        self.__denied = ACL.RuleSet()
         self.__mode = ACL.MODE_RESTRICTIVE
+        # Least recently used decisions are evicted first, so names which are checked once don't wipe the cache
+        self.__decisions = OrderedDict()  # type: Dict[Tuple[str, str, str], bool]
+        self.__decisions_lock = threading.Lock()
+        self.__rules_version = 0  # Decision made while rules were changing isn't cached
 
     @property
     def allowed(self) -> List[Entry]:
-        return self.__allowed
+        return self.__allowed.entries
 
     @property
     def denied(self) -> List[Entry]:
-        return self.__denied
+        return self.__denied.entries
 
     @property
     def mode(self) -> str:
@@ -307,25 +875,56 @@ class ACL(object):
         if val not in ACL.SUPPORTED_MODES:
             raise ValueError("ACL mode should be one of: " + str(ACL.SUPPORTED_MODES))
         self.__mode = val
+        self.__invalidate()
 
     def allow(self, device_name: str, target_name: str, target_type: str):
-        self.__allowed.append(ACL.Entry(device_name, target_type, target_name))
+        """
+        Device and target names might contain * wildcard matching any sequence of characters
+        """
+        self.__allowed.add(ACL.Entry(device_name, target_type, target_name))
+        self.__invalidate()
 
     def deny(self, device_name: str, target_name: str, target_type: str):
-        self.__denied.append(ACL.Entry(device_name, target_type, target_name))
+        """
+        Device and target names might contain * wildcard matching any sequence of characters
+        """
+        self.__denied.add(ACL.Entry(device_name, target_type, target_name))
+        self.__invalidate()
 
-    def __has_entry(self, collection:List[Entry], device_name: str, target_name: str, target_type: str):
-        for entry in collection:
-            if entry.device_name == device_name and entry.target_name == target_name and entry.target_type == target_type:
-                return True
-        return False
+    def has_rules(self, target_type: str) -> bool:
+        """
+        :return: True if any rule refers to targets of the given type
+        """
+        return self.__allowed.has_rules(target_type) or self.__denied.has_rules(target_type)
 
     def validate_operation(self, device_name: str, target_name: str, target_type: str = TARGET_TYPE_ACTION):
+        key = (device_name, target_name, target_type)
+        with self.__decisions_lock:
+            decision = self.__decisions.get(key)
+            if decision is not None:
+                self.__decisions.move_to_end(key)
+                return decision
+            version = self.__rules_version
+        decision = self.__decide(device_name, target_name, target_type)
+        with self.__decisions_lock:
+            if version != self.__rules_version:
+                return decision
+            self.__decisions[key] = decision
+            if len(self.__decisions) > self.DECISION_CACHE_SIZE:
+                self.__decisions.popitem(last=False)
+        return decision
+
+    def __invalidate(self):
+        with self.__decisions_lock:
+            self.__decisions.clear()
+            self.__rules_version += 1
+
+    def __decide(self, device_name: str, target_name: str, target_type: str) -> bool:
         if self.mode == self.MODE_RESTRICTIVE:
-            if self.__has_entry(self.denied, device_name, target_name, target_type):
+            if self.__denied.matches(device_name, target_name, target_type):
                 return False
-            return self.__has_entry(self.allowed, device_name, target_name, target_type)
+            return self.__allowed.matches(device_name, target_name, target_type)
         elif self.mode == self.MODE_PERMISSIVE:
-            return not self.__has_entry(self.denied, device_name, target_name, target_type)
+            return not self.__denied.matches(device_name, target_name, target_type)
         else:
-            return False
\ No newline at end of file
+            return False
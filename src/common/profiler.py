@@ -0,0 +1,133 @@
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from threading import Thread
+
+from typing import Callable, List
+
+from common import utils
+
+
+class SamplingProfiler(object):
+    """
+    Statistical profiler sampling stacks of all threads. Nothing is running until profiling is requested, so idle
+    overhead is zero. Result is written in collapsed stack format (one line per unique stack: frames separated by ';'
+    followed by number of samples) which can be rendered by flamegraph.pl or speedscope.
+    """
+    DEFAULT_DURATION = 10000
+    DEFAULT_INTERVAL = 10
+    TOP_FUNCTIONS_COUNT = 10
+    IDLE_MODULES = ('threading.py', 'selectors.py', 'queue.py')  # Leaf frames of threads blocked in waiting
+
+    def __init__(self, output_dir: str = None, duration: int = DEFAULT_DURATION, interval: int = DEFAULT_INTERVAL):
+        """
+        :param output_dir: directory to write profiles to. Temporary directory is used if not set
+        :param duration: default profiling window in milliseconds
+        :param interval: sampling interval in milliseconds
+        """
+        self.output_dir = output_dir
+        self.duration = duration
+        self.interval = interval
+        self.__listeners = []  # type: List[Callable]
+        self.__lock = threading.Lock()
+        self.__thread = None  # type: Thread
+        self.__logger = logging.getLogger('SamplingProfiler')
+
+    def subscribe(self, listener: Callable):
+        """
+        :param listener: callable accepting summary dictionary. Invoked from profiler thread once profile is written
+        """
+        self.__listeners.append(listener)
+
+    def unsubscribe(self, listener: Callable):
+        if listener in self.__listeners:
+            self.__listeners.remove(listener)
+
+    def is_running(self) -> bool:
+        return self.__thread is not None
+
+    def start(self, duration: int = None) -> bool:
+        """
+        Starts profiling in background. Safe to call from signal handler
+        :param duration: profiling window in milliseconds, default duration is used if not set
+        :return: False if profiling is already in progress
+        """
+        with self.__lock:
+            if self.__thread is not None:
+                return False
+            self.__thread = Thread(target=self.__run, args=(duration or self.duration,), name='Profiler', daemon=True)
+            self.__thread.start()
+            return True
+
+    def __run(self, duration: int):
+        try:
+            stacks, samples = self.__sample(duration)
+            file_name = self.__write(stacks)
+            summary = self.__summarize(stacks, samples, duration, file_name)
+            self.__logger.info("Profile with {} samples written to {}".format(samples, file_name))
+            for listener in list(self.__listeners):
+                try:
+                    listener(summary)
+                except Exception as e:
+                    self.__logger.error("Unable to deliver profile summary: {}".format(e))
+        except Exception as e:
+            self.__logger.error("Profiling failed: {}".format(e))
+        finally:
+            with self.__lock:
+                self.__thread = None
+
+    def __sample(self, duration: int):
+        stacks = Counter()
+        samples = 0
+        own_ident = threading.get_ident()
+        deadline = utils.capture_time() + duration
+        while utils.capture_time() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stacks[self.__collapse(names.get(ident, str(ident)), frame)] += 1
+            samples += 1
+            time.sleep(self.interval / 1000)
+        return stacks, samples
+
+    @staticmethod
+    def __collapse(thread_name: str, frame) -> str:
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        frames.append(thread_name)
+        return ';'.join(reversed(frames))
+
+    def __write(self, stacks: Counter) -> str:
+        output_dir = self.output_dir or tempfile.gettempdir()
+        file_name = os.path.join(output_dir, 'profile-{}.folded'.format(time.strftime('%Y%m%d-%H%M%S')))
+        with open(file_name, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        return file_name
+
+    def __summarize(self, stacks: Counter, samples: int, duration: int, file_name: str) -> dict:
+        # Leaf frame is the function which was actually executing at the moment of sampling
+        self_time = Counter()
+        idle = 0
+        for stack, count in stacks.items():
+            leaf = stack.rsplit(';', 1)[-1]
+            if leaf.split('(', 1)[-1].split(':', 1)[0] in self.IDLE_MODULES:
+                idle += count
+            else:
+                self_time[leaf] += count
+        return {
+            'file': file_name,
+            'duration': duration,
+            'samples': samples,
+            'idle': idle,
+            'top': [{'function': function, 'samples': count}
+                    for function, count in self_time.most_common(self.TOP_FUNCTIONS_COUNT)]
+        }
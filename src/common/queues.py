@@ -0,0 +1,144 @@
+import threading
+from collections import deque
+from queue import Empty
+
+from typing import List, Callable, Hashable
+
+OVERFLOW_DROP_OLDEST = 'drop_oldest'  # Evict the oldest item of the least urgent lane to make room for the new one
+OVERFLOW_DROP_NEWEST = 'drop_newest'  # Reject the new item
+OVERFLOW_COALESCE = 'coalesce'  # Replace queued item with the same key, otherwise behave as drop_oldest
+OVERFLOW_BLOCK = 'block'  # Wait for free space up to block timeout, then reject the new item
+
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_COALESCE, OVERFLOW_BLOCK)
+
+
+class PriorityLaneQueue(object):
+    """
+    Thread-safe queue consisting of FIFO lanes, one per priority class. Consumer always gets item from the most
+    urgent non-empty lane (lane 0 is the most urgent one) so items of lower priority can't delay urgent ones.
+    Queue might be bounded. In this case overflow policy defines what happens to the item which doesn't fit.
+    """
+
+    class Entry(object):
+        __slots__ = ('item', 'key')
+
+        def __init__(self, item, key):
+            self.item = item
+            self.key = key
+
+    def __init__(self, lanes_count: int, capacity: int = 0, policy: str = OVERFLOW_DROP_NEWEST,
+                 block_timeout: int = 0, on_drop: Callable = None):
+        """
+        :param capacity: max number of items in all the lanes, 0 means unbounded
+        :param policy: default overflow policy
+        :param block_timeout: time in milliseconds producer waits for free space with block policy
+        :param on_drop: callable accepting dropped item and policy which caused drop
+        """
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError('Overflow policy should be one of {}'.format(OVERFLOW_POLICIES))
+        self.capacity = capacity
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.__on_drop = on_drop
+        self.__lanes = [deque() for _ in range(lanes_count)]  # type: List[deque]
+        self.__keys = {}  # Coalescing key -> queued entry
+        self.__lock = threading.Lock()
+        self.__not_empty = threading.Condition(self.__lock)
+        self.__not_full = threading.Condition(self.__lock)
+        self.__size = 0
+        self.__wakeups = 0  # Number of consumers to be woken up
+
+    def put(self, item, priority: int = 0, policy: str = None, key: Hashable = None) -> bool:
+        """
+        :param policy: overflow policy for this item, default policy of the queue is used if not set
+        :param key: coalescing key, items with the same key replace each other with coalesce policy
+        :return: False if item was rejected
+        """
+        policy = policy or self.policy
+        with self.__lock:
+            if policy == OVERFLOW_COALESCE and key is not None:
+                queued = self.__keys.get(key)
+                if queued is not None:
+                    self.__notify_drop(queued.item, policy)
+                    queued.item = item
+                    return True
+            if self.capacity and self.__size >= self.capacity:
+                if policy == OVERFLOW_BLOCK:
+                    if not self.__not_full.wait_for(lambda: self.__size < self.capacity, self.block_timeout / 1000):
+                        self.__notify_drop(item, policy)
+                        return False
+                elif policy == OVERFLOW_DROP_NEWEST or not self.__evict(priority, policy):
+                    self.__notify_drop(item, policy)
+                    return False
+            entry = PriorityLaneQueue.Entry(item, key if policy == OVERFLOW_COALESCE else None)
+            if entry.key is not None:
+                self.__keys[key] = entry
+            self.__lanes[priority].append(entry)
+            self.__size += 1
+            self.__not_empty.notify()
+            return True
+
+    def __evict(self, priority: int, policy: str) -> bool:
+        """
+        Drops the oldest item of the least urgent lane which isn't more urgent than the new item
+        """
+        for lane in reversed(self.__lanes[priority:]):
+            if lane:
+                self.__notify_drop(self.__pop(lane), policy)
+                return True
+        return False
+
+    def __pop(self, lane: deque):
+        entry = lane.popleft()
+        self.__size -= 1
+        if entry.key is not None and self.__keys.get(entry.key) is entry:
+            del self.__keys[entry.key]
+        return entry.item
+
+    def __notify_drop(self, item, policy: str):
+        if self.__on_drop is not None:
+            self.__on_drop(item, policy)
+
+    def get(self, timeout: float = None):
+        """
+        :return: the most urgent item or None if consumer was woken up by wakeup()
+        :raises Empty: if no item became available within timeout
+        """
+        with self.__lock:
+            if not self.__size and not self.__not_empty.wait_for(lambda: self.__size or self.__wakeups, timeout):
+                raise Empty()
+            return self.__get()
+
+    def get_all(self) -> list:
+        """
+        Takes all the queued items without blocking, the most urgent first
+        """
+        with self.__lock:
+            items = []
+            for lane in self.__lanes:
+                while lane:
+                    items.append(self.__pop(lane))
+            self.__not_full.notify_all()
+            return items
+
+    def __get(self):
+        for lane in self.__lanes:
+            if lane:
+                item = self.__pop(lane)
+                self.__not_full.notify()  # Producer might be waiting for free space
+                return item
+        self.__wakeups -= 1
+        return None
+
+    def wakeup(self):
+        """
+        Makes one of the consumers blocked in get() return None. Unlike regular items it ignores capacity. Wakeups
+        aren't merged, so calling it N times wakes up N consumers
+        """
+        with self.__lock:
+            self.__wakeups += 1
+            self.__not_empty.notify()
+
+    def qsize(self, priority: int = None) -> int:
+        with self.__lock:
+            return self.__size if priority is None else len(self.__lanes[priority])
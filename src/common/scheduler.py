@@ -0,0 +1,202 @@
+import heapq
+import itertools
+import threading
+
+from typing import List, Tuple, Any
+
+from common import utils
+
+
+class Scheduler(object):
+    """
+    Deadline-ordered scheduler. Items are kept in a binary heap ordered by the time they are due so consumer
+    doesn't need to scan all of them on every iteration. Consumer thread sleeps until the earliest deadline
+    or until it is explicitly woken up.
+    """
+
+    def __init__(self):
+        self.__heap = []
+        self.__counter = itertools.count()
+        self.__entries = {}  # Item -> heap entry. Used to invalidate entry when item is rescheduled or cancelled
+        self.__condition = threading.Condition()
+        self.__woken = False
+        self.__terminating = False
+
+    def schedule(self, item, due: int, keep_earlier: bool = False):
+        """
+        Schedules item to be returned by wait_due() once due time is reached. If item was already scheduled previous
+        deadline is discarded.
+        :param due: time in milliseconds
+        :param keep_earlier: keep previous deadline if it is earlier than the new one
+        """
+        with self.__condition:
+            existing = self.__entries.get(item)
+            if keep_earlier and existing is not None and existing[0] <= due:
+                return
+            self.__invalidate(item)
+            entry = [due, next(self.__counter), item]
+            self.__entries[item] = entry
+            heapq.heappush(self.__heap, entry)
+            # Consumer needs to recalculate sleep interval only if the earliest deadline has changed
+            if self.__heap[0] is entry:
+                self.__condition.notify()
+
+    def cancel(self, item):
+        with self.__condition:
+            self.__invalidate(item)
+
+    def is_scheduled(self, item) -> bool:
+        with self.__condition:
+            return item in self.__entries
+
+    def wakeup(self):
+        """
+        Forces consumer blocked in wait_due() to return even if nothing is due yet
+        """
+        with self.__condition:
+            self.__woken = True
+            self.__condition.notify()
+
+    def stop(self):
+        with self.__condition:
+            self.__terminating = True
+            self.__condition.notify_all()
+
+    def wait_due(self) -> List[Tuple[Any, int]]:
+        """
+        Blocks until at least one item is due, wakeup() is called or scheduler is stopped.
+        :return: list of (item, due time) pairs for all items which are due, ordered by deadline
+        """
+        with self.__condition:
+            while not self.__terminating:
+                now = utils.clock.tick()
+                if self.__heap and self.__heap[0][0] <= now:
+                    return self.__pop_due(now)
+                if self.__woken:
+                    self.__woken = False
+                    return []
+                timeout = (self.__heap[0][0] - now) / 1000 if self.__heap else None
+                self.__condition.wait(timeout)
+            return []
+
+    def __pop_due(self, now: int) -> List[Tuple[Any, int]]:
+        result = []
+        while self.__heap and self.__heap[0][0] <= now:
+            due, _, item = heapq.heappop(self.__heap)
+            if item is None:
+                continue  # Entry was invalidated
+            del self.__entries[item]
+            result.append((item, due))
+        return result
+
+    def __invalidate(self, item):
+        entry = self.__entries.pop(item, None)
+        if entry is not None:
+            # Heap doesn't support removal so we just mark entry as invalid. It will be dropped once popped
+            entry[2] = None
+        # Drop invalidated entries from the top so they don't affect sleep interval
+        while self.__heap and self.__heap[0][2] is None:
+            heapq.heappop(self.__heap)
+
+
+class TimerWheel(object):
+    """
+    Hashed timer wheel. Timers are distributed across fixed number of slots by the tick they expire at, so adding and
+    cancelling timer takes constant time regardless of the number of timers. Single thread drives the wheel and
+    sleeps until the nearest occupied slot. Expired timers are passed to the callback supplied by the owner.
+    """
+
+    class Timer(object):
+        def __init__(self, payload):
+            self.payload = payload
+            self.deadline_tick = 0
+            self.slot = None  # type: List[TimerWheel.Timer]
+
+    def __init__(self, on_expired, tick_interval: int = 10, slots_count: int = 512):
+        """
+        :param on_expired: callable accepting payload of expired timer. Invoked from the wheel thread so should be fast
+        :param tick_interval: wheel resolution in milliseconds
+        """
+        self.tick_interval = tick_interval
+        self.__on_expired = on_expired
+        self.__slots = [[] for _ in range(slots_count)]  # type: List[List[TimerWheel.Timer]]
+        self.__timers_count = 0
+        self.__started_at = utils.capture_time()
+        self.__processed_tick = 0
+        self.__condition = threading.Condition()
+        self.__terminating = False
+
+    def __current_tick(self) -> int:
+        return (utils.capture_time() - self.__started_at) // self.tick_interval
+
+    def add(self, payload, delay: int) -> Timer:
+        """
+        :param delay: delay in milliseconds
+        """
+        timer = TimerWheel.Timer(payload)
+        with self.__condition:
+            # Rounding up guarantees that timer never fires earlier than requested
+            timer.deadline_tick = self.__current_tick() + max(1, -(-delay // self.tick_interval))
+            timer.slot = self.__slots[timer.deadline_tick % len(self.__slots)]
+            timer.slot.append(timer)
+            self.__timers_count += 1
+            self.__condition.notify()
+        return timer
+
+    def cancel(self, timer: Timer):
+        with self.__condition:
+            if timer.slot is not None:
+                timer.slot.remove(timer)
+                timer.slot = None
+                self.__timers_count -= 1
+
+    def stop(self):
+        with self.__condition:
+            self.__terminating = True
+            self.__condition.notify_all()
+
+    def run(self):
+        """
+        Drives the wheel until stop() is called. Should be executed in dedicated thread
+        """
+        while True:
+            with self.__condition:
+                if self.__terminating:
+                    return
+                expired = self.__advance(self.__current_tick())
+                if not expired:
+                    self.__condition.wait(self.__time_to_next_timer())
+            for timer in expired:
+                self.__on_expired(timer.payload)
+
+    def __advance(self, current_tick: int) -> List[Timer]:
+        expired = []
+        # There is no need to visit the same slot twice even if we've been sleeping for more than one revolution
+        first_tick = max(self.__processed_tick + 1, current_tick - len(self.__slots) + 1)
+        for tick in range(first_tick, current_tick + 1):
+            slot = self.__slots[tick % len(self.__slots)]
+            if not slot:
+                continue
+            remaining = []
+            for timer in slot:
+                if timer.deadline_tick <= current_tick:
+                    timer.slot = None
+                    expired.append(timer)
+                else:
+                    remaining.append(timer)  # Timer is due on one of the next revolutions
+            slot[:] = remaining
+        self.__processed_tick = max(self.__processed_tick, current_tick)
+        self.__timers_count -= len(expired)
+        return expired
+
+    def __time_to_next_timer(self) -> [float, None]:
+        """
+        :return: time in seconds until the nearest occupied slot or None if there are no timers
+        """
+        if not self.__timers_count:
+            return None
+        for offset in range(1, len(self.__slots) + 1):
+            if self.__slots[(self.__processed_tick + offset) % len(self.__slots)]:
+                break
+        wake_at = self.__started_at + (self.__processed_tick + offset) * self.tick_interval
+        return max(0, wake_at - utils.capture_time()) / 1000
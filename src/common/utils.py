@@ -1,3 +1,4 @@
+import math
 import time
 
 
@@ -5,11 +6,43 @@ def int_to_hex4str(val: int) -> str:
     return hex(val)
 
 
+# Python < 3.7 doesn't provide integer nanosecond clock
+_monotonic_ns = getattr(time, 'monotonic_ns', None) or (lambda: int(time.monotonic() * 1000000000))
+
+
+class Clock(object):
+    """
+    Monotonic clock which is not affected by system time adjustments (e.g. NTP sync on boot). Scheduler calls tick()
+    once per iteration so modules might cheaply read the same timestamp during the tick instead of querying the clock
+    over and over.
+    """
+
+    def __init__(self):
+        self.tick_id = 0
+        self.tick_time = capture_time()
+
+    def tick(self) -> int:
+        """
+        Captures timestamp shared by everything executed within the current scheduler tick
+        :return: Time in milliseconds
+        """
+        self.tick_time = capture_time()
+        self.tick_id += 1
+        return self.tick_time
+
+
 def capture_time() -> int:
     """
-    :return: Time in milliseconds
+    :return: Monotonic time in milliseconds. Meaningful only for measuring intervals
+    """
+    return _monotonic_ns() // 1000000
+
+
+def capture_time_ns() -> int:
+    """
+    :return: Monotonic time in nanoseconds. Meaningful only for measuring intervals
     """
-    return int(time.time() * 1000)  # Fractional seconds to millis
+    return _monotonic_ns()
 
 
 def delta_time(point_in_time: int, now: int = None) -> int:
@@ -20,4 +53,16 @@ def delta_time(point_in_time: int, now: int = None) -> int:
     """
     if now is None:
         now = capture_time()
-    return now - point_in_time
\ No newline at end of file
+    return now - point_in_time
+
+
+def finite_or_none(value):
+    """
+    :return: the value itself unless it is infinite or NaN float, which have no JSON representation
+    """
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+clock = Clock()
@@ -1,11 +1,14 @@
 import logging
+from collections import deque
 
-from typing import List, Dict
+from typing import Dict, Callable, Tuple
 
+from common import utils
+from common.core import DelayedCall
 from common.drivers import GPIODriver
-from common.utils import capture_time
 from common import validators
-from common.model import Module, EventDef, ActionDef, ParameterDef, StateAwareModule, Driver
+from common.queues import OVERFLOW_DROP_OLDEST
+from common.model import Module, EventDef, ActionDef, ParameterDef, StateAwareModule, Driver, PRIORITY_INTERACTIVE
 
 RELEASED = 0
 PRESSED = 1
@@ -16,6 +19,16 @@ EVENT_DOUBLE_CLICK = 0x03
 
 
 class ButtonModule(Module):
+    """
+    Recognizes gestures from timestamped transitions of the input. Transitions come from edge notifications of the
+    channel or, if driver can't detect edges, from sampling of the input every poll_interval. All the decisions are
+    made using timestamps of transitions rather than time they were processed at, and timeouts of long click,
+    double click and debounce window are one-shot timers, so idle button doesn't consume anything.
+
+    Debouncing: the first transition is accepted right away and the input is ignored during debounce window after it.
+    Level at the end of the window is accepted as a new transition if it differs.
+    """
+
     def __init__(self, application, drivers: Dict[int, Driver]):
         super().__init__(application, drivers)
         self.__logger = logging.getLogger('ButtonModule')
@@ -25,13 +38,21 @@ class ButtonModule(Module):
         self.handle_double_click = False
         self.long_click_duration = 1000
         self.double_click_duration = 400
+        self.debounce = 20
+        self.poll_interval = self.MINIMAL_ITERATION_INTERVAL
         self.pullup = True
         self.__channel = None  # type: GPIODriver.Channel
-        self.__wait_until_released = False
-        self.__prev_state = RELEASED
-        self.__click_time = 0
-        self.__pressed_time = 0
-        self.__released_time = 0
+        self.__edge_driven = False
+        self.__edges = deque()  # Transitions reported by the driver thread: (level, time in milliseconds)
+        self.__raw_level = RELEASED  # The latest level of the input, might be bouncing
+        self.__level = RELEASED  # Debounced level
+        self.__processed_at = 0  # Time everything before which is already processed, transitions can't go back
+        self.__settle_at = 0  # End of the current debounce window
+        self.__pressed_at = 0
+        self.__long_clicked = False  # Long click is already emitted for the current press
+        self.__click_at = 0  # Release time of the click which might become double click
+        self.__timer = None  # type: DelayedCall
+        self.__timer_due = 0
 
     @staticmethod
     def typeid() -> int:
@@ -47,51 +68,119 @@ class ButtonModule(Module):
 
     def on_initialized(self):
         self.__channel = self.__gpioDriver.new_channel(self.gpio, GPIODriver.GPIO_MODE_READ, pullup=self.pullup)
+        self.__edge_driven = self.__channel.subscribe(self.__on_edge)
+        # Steps of edge driven button only apply reported edges, periodic step is a safety net for missed ones
+        self.MINIMAL_ITERATION_INTERVAL = self.EDGE_IDLE_INTERVAL if self.__edge_driven else self.poll_interval
 
-    def __register_new_state(self, state):
-        if state != self.__prev_state:
-            if self.__prev_state == RELEASED:
-                self.__pressed_time = capture_time()
-            else:
-                self.__released_time = capture_time()
+    def on_before_destroyed(self):
+        if self.__edge_driven:
+            self.__channel.unsubscribe(self.__on_edge)
+        self.__cancel_timer()
+
+    def __on_edge(self, level: int, timestamp: int):
+        self.__edges.append((level ^ 1 if self.pullup else level, timestamp))
+        self.get_application_manager().request_step(self)
 
     def step(self):
-        state = self.__channel.read(self.pullup)
-        if self.__wait_until_released:
-            if state == RELEASED:
-                self.__wait_until_released = False
-            else:
-                return
-        self.__register_new_state(state)
-        if self.handle_long_click and state == PRESSED:
-            if self.__pressed_time > 0 and capture_time() - self.__pressed_time >= self.long_click_duration:
-                self.__pressed_time = 0
-                self.__released_time = 0
-                self.__prev_state = RELEASED
-                self.__wait_until_released = True
-                self.emit(EVENT_LONG_CLICK)
+        self.__update(utils.clock.tick_time, sample=not self.__edge_driven or not self.__edges)
+
+    def __on_timer(self):
+        self.__timer = None
+        self.__update(utils.clock.tick_time, sample=not self.__edge_driven)
+
+    def __update(self, now: int, sample: bool):
+        """
+        Feeds pending transitions to the state machine, fires timeouts which are due and arms timer for the next one
+        :param sample: read the input in case its transition wasn't reported
+        """
+        edges = self.__edges
+        while edges:
+            self.__on_transition(*edges.popleft())
+        if sample:
+            level = self.__channel.read(self.pullup)
+            if level != self.__raw_level:
+                self.__on_transition(level, now)
+        self.__advance(now)
+        self.__arm_timer(now)
+
+    def __on_transition(self, level: int, timestamp: int):
+        # Timeouts which had expired before the transition happened are applied first
+        timestamp = max(timestamp, self.__processed_at)
+        self.__advance(timestamp)
+        self.__raw_level = level
+        if not self.__settle_at and level != self.__level:
+            self.__accept(level, timestamp)
+
+    def __next_timeout(self) -> Tuple[int, Callable]:
+        """
+        :return: time of the earliest timeout and its handler, (0, None) if nothing is pending
+        """
+        timeouts = []
+        if self.__settle_at:
+            timeouts.append((self.__settle_at, self.__on_settled))
+        if self.__click_at:
+            timeouts.append((self.__click_at + self.double_click_duration, self.__on_double_click_timeout))
+        if self.handle_long_click and self.__level == PRESSED and not self.__long_clicked:
+            timeouts.append((self.__pressed_at + self.long_click_duration, self.__on_long_click_timeout))
+        return min(timeouts, key=lambda x: x[0]) if timeouts else (0, None)
+
+    def __advance(self, now: int):
+        while True:
+            due, handler = self.__next_timeout()
+            if handler is None or due > now:
+                break
+            self.__processed_at = max(self.__processed_at, due)
+            handler(due)
+        self.__processed_at = max(self.__processed_at, now)
+
+    def __arm_timer(self, now: int):
+        due, _ = self.__next_timeout()
+        if self.__timer is not None:
+            if self.__timer_due == due:
                 return
-        if self.__prev_state == PRESSED and state == RELEASED:
-            if self.handle_double_click:
-                if self.__click_time > 0 and capture_time() - self.__click_time <= self.double_click_duration:
-                    self.__pressed_time = 0
-                    self.__released_time = 0
-                    self.__prev_state = RELEASED
-                    self.__click_time = 0
-                    self.emit(EVENT_DOUBLE_CLICK)
-                    return
-                elif self.__click_time == 0:
-                    self.__click_time = capture_time()
-                else:
-                    self.emit(EVENT_CLICK)
-            else:
-                self.emit(EVENT_CLICK)
-        # Reset click counter on timeout
-        if state == RELEASED and self.handle_double_click and self.__click_time > 0 \
-                and capture_time() - self.__click_time > self.double_click_duration:
-            self.__click_time = 0
+            self.__cancel_timer()
+        if due:
+            self.__timer = self.get_application_manager().call_later(due - now, self.__on_timer)
+            self.__timer_due = due
+
+    def __cancel_timer(self):
+        if self.__timer is not None:
+            self.get_application_manager().cancel_call(self.__timer)
+            self.__timer = None
+
+    def __accept(self, level: int, timestamp: int):
+        self.__level = level
+        if self.debounce > 0:
+            self.__settle_at = timestamp + self.debounce
+        if level == PRESSED:
+            self.__pressed_at = timestamp
+            self.__long_clicked = False
+        elif self.__long_clicked:
+            self.__long_clicked = False  # Release of the long click isn't a gesture itself
+        elif not self.handle_double_click:
+            self.emit(EVENT_CLICK)
+        elif self.__click_at:
+            self.__click_at = 0
+            self.emit(EVENT_DOUBLE_CLICK)
+        else:
+            self.__click_at = timestamp
+
+    def __on_settled(self, now: int):
+        self.__settle_at = 0
+        if self.__raw_level != self.__level:
+            self.__accept(self.__raw_level, now)
+
+    def __on_double_click_timeout(self, now: int):
+        self.__click_at = 0
+        self.emit(EVENT_CLICK)
+
+    def __on_long_click_timeout(self, now: int):
+        self.__long_clicked = True
+        if self.__click_at:
+            # Pending click can't become double click anymore
+            self.__click_at = 0
             self.emit(EVENT_CLICK)
-        self.__prev_state = state
+        self.emit(EVENT_LONG_CLICK)
 
     PARAMS = [
         ParameterDef('gpio', is_required=True),
@@ -100,11 +189,15 @@ class ButtonModule(Module):
         ParameterDef('handle_double_click', validators=(validators.boolean,)),
         ParameterDef('long_click_duration', validators=(validators.integer,)),
         ParameterDef('double_click_duration', validators=(validators.integer,)),
+        ParameterDef('debounce', validators=(validators.integer,)),
+        ParameterDef('poll_interval', validators=(validators.integer,)),
     ]
     EVENTS = [
-        EventDef(EVENT_CLICK, 'click'),
-        EventDef(EVENT_LONG_CLICK, 'long_click'),
-        EventDef(EVENT_DOUBLE_CLICK, 'double_click'),
+        # Gestures are emitted from the main loop which mustn't block, so room is made by evicting less urgent events
+        EventDef(EVENT_CLICK, 'click', priority=PRIORITY_INTERACTIVE, overflow=OVERFLOW_DROP_OLDEST),
+        EventDef(EVENT_LONG_CLICK, 'long_click', priority=PRIORITY_INTERACTIVE, overflow=OVERFLOW_DROP_OLDEST),
+        EventDef(EVENT_DOUBLE_CLICK, 'double_click', priority=PRIORITY_INTERACTIVE, overflow=OVERFLOW_DROP_OLDEST),
     ]
     MINIMAL_ITERATION_INTERVAL = 50
+    EDGE_IDLE_INTERVAL = 60000  # Safety polling of idle button if channel notifies about edges
     REQUIRED_DRIVERS = [GPIODriver.typeid()]
@@ -3,8 +3,9 @@ from typing import Dict
 from common.config_parser import ACLParser
 from common.drivers import DataChannelDriver
 from common.errors import RPCError
-from common.model import Module, ParameterDef, ActionDef, Driver, EventDef, ModelState, ACL
+from common.model import Module, ParameterDef, ActionDef, Driver, EventDef, StateSnapshot, ACL, PRIORITY_BULK
 from common import validators
+from common.queues import OVERFLOW_DROP_NEWEST
 
 ACTION_PUSH = 0x01
 ACTION_PUSH_STATE = 0x02
@@ -15,6 +16,9 @@ class CommunicationBusModule(Module):
     TOPIC_STATE_SUFFIX = '/state'
     TOPIC_ACTION_SUFFIX = '/action'
     TOPIC_CMD_SUFFIX = '/_cmd'
+    TOPIC_METRICS = '/_metrics'
+    SYSTEM_DEVICE_NAME = '_system'  # Pseudo device receiving instance-wide commands, e.g. _cmd/_system/profile
+    SYSTEM_CMD_PROFILE = 'profile'
     DEFAULT_BROKER_PORT = 2131
 
     @staticmethod
@@ -38,6 +42,9 @@ class CommunicationBusModule(Module):
             self.logger.debug(
                 'Got new message: topic: {}, payload: {}'.format(msg.topic, payload_str))
             device_name, action_name = msg.topic[len(self._rpc_topic_prefix) + 1:].split('/', 1)
+            if device_name == self.SYSTEM_DEVICE_NAME:
+                self.__on_system_command(action_name, payload_str, msg)
+                return
             device = self.get_application_manager().get_device_by_name(device_name)
             if device is None:
                 raise RPCError("Unknown device {}.".format(device_name), cmd=msg)
@@ -46,7 +53,29 @@ class CommunicationBusModule(Module):
                 raise RPCError("Unknown action #{}.{}.".format(device_name, action_name), cmd=msg)
             if not self.acl.validate_operation(device_name, action_name):
                 raise RPCError("Access denied for RPC call #{}.{}".format(device_name, action_name))
-            self.get_application_manager().run_async_action(device, action_def, payload_str, self)
+            # Remote callers shouldn't be able to push out already accepted work, so calls over capacity are rejected
+            if not self.get_application_manager().run_async_action(device, action_def, payload_str, self,
+                                                                   policy=OVERFLOW_DROP_NEWEST):
+                raise RPCError("RPC call #{}.{} is rejected because application is overloaded"
+                               .format(device_name, action_name), cmd=msg)
+
+    def __on_system_command(self, command: str, payload: str, msg):
+        if not self.acl.validate_operation(self.SYSTEM_DEVICE_NAME, command):
+            raise RPCError("Access denied for system command {}".format(command))
+        if command == self.SYSTEM_CMD_PROFILE:
+            # Payload is optional profiling window in milliseconds
+            try:
+                duration = int(payload) if payload.strip() else None
+            except ValueError as e:
+                raise RPCError("Profiling duration should be integer number of milliseconds", e, cmd=msg)
+            if not self.get_application_manager().profiler.start(duration):
+                self.logger.warning("Profiling is already in progress")
+        else:
+            raise RPCError("Unknown system command {}.".format(command), cmd=msg)
+
+    def __publish_profile(self, summary: dict):
+        if self.channel.is_connected():
+            self.channel.send('/{}/{}'.format(self.SYSTEM_DEVICE_NAME, self.SYSTEM_CMD_PROFILE), summary)
 
     def __init__(self, application, drivers: Dict[int, Driver]):
         """
@@ -63,20 +92,43 @@ class CommunicationBusModule(Module):
         self.channel = None  # type: DataChannelDriver.Channel
         self.acl = ACL()
         self._rpc_topic_prefix = self.TOPIC_PREFIX + self.TOPIC_CMD_SUFFIX
+        self.metrics_interval = 0  # Milliseconds. Metrics are not published if 0
+        self.__metrics_thread = None
+
+    def __is_published(self, sender: Module, event: EventDef) -> bool:
+        """
+        Events are published unless ACL defines event rules, so configurations without them keep publishing state
+        """
+        if sender is None or event is None or not self.acl.has_rules(ACL.TARGET_TYPE_EVENT):
+            return True
+        return self.acl.validate_operation(sender.name, event.name, ACL.TARGET_TYPE_EVENT)
 
-    def push(self, data=None, **kwargs):
+    def push(self, data=None, event: EventDef = None, sender: Module = None, **kwargs):
+        if not self.__is_published(sender, event):
+            return
         if self.channel.is_connected():
             self.channel.send('TODO', data)
 
-    def push_state(self, data: ModelState = None, event: EventDef = None, sender: Module = None, **kwargs):
+    def push_state(self, data: StateSnapshot = None, event: EventDef = None, sender: Module = None, **kwargs):
         if not self.channel.is_connected():
             return  # We can't sync message until establish connection
+        if not self.__is_published(sender, event):
+            return
         try:
-            assert isinstance(data, ModelState), "push_state action expects StateModel, got " + str(data)
-            self.channel.send('/{}/state'.format(sender.name), data.as_dict())
+            assert isinstance(data, StateSnapshot), "push_state action expects StateSnapshot, got " + str(data)
+            # Snapshot is passed as is, so channel might reuse encoding cached by another subscriber
+            self.channel.send('/{}/state'.format(sender.name), data)
         except Exception as e:
             self.logger.error("Unable to push device state: " + str(e))
 
+    def publish_metrics(self):
+        if not self.channel.is_connected():
+            return
+        try:
+            self.channel.send(self.TOPIC_METRICS, self.get_application_manager().metrics.snapshot())
+        except Exception as e:
+            self.logger.error("Unable to publish metrics: " + str(e))
+
     def on_initialized(self):
         self.channel = self._channel_driver.new_channel({
             "server_address": self.server_address,
@@ -86,6 +138,10 @@ class CommunicationBusModule(Module):
         })
         self.channel.on_data_received = self.__on_message_received
         self.channel.on_connect_first_time = self.__on_connect_first_time
+        self.get_application_manager().profiler.subscribe(self.__publish_profile)
+        if self.metrics_interval:
+            self.__metrics_thread = self.get_application_manager().thread_manager.request_thread(
+                'metrics-' + self.name, self.publish_metrics, step_interval=self.metrics_interval)
 
     def step(self):
         # We just need to check if connection is alive. If not - reconnect
@@ -96,19 +152,24 @@ class CommunicationBusModule(Module):
                 pass  # We will try to reconnect a bit later
 
     def on_before_destroyed(self):
+        self.get_application_manager().profiler.unsubscribe(self.__publish_profile)
+        if self.__metrics_thread is not None:
+            self.get_application_manager().thread_manager.dispose_thread(self.__metrics_thread)
+            self.__metrics_thread = None
         self.channel.disconnect()
         self.channel.dispose()
 
     ACTIONS = [
-        ActionDef(ACTION_PUSH, 'push', push),
-        ActionDef(ACTION_PUSH_STATE, 'push_state', push_state)
+        ActionDef(ACTION_PUSH, 'push', push, priority=PRIORITY_BULK),
+        ActionDef(ACTION_PUSH_STATE, 'push_state', push_state, priority=PRIORITY_BULK)
     ]
 
     PARAMS = [
         ParameterDef(name='server_address', is_required=True),
         ParameterDef(name='server_port', is_required=False, validators=[validators.integer]),
         ParameterDef(name='bind_address', is_required=False),
-        ParameterDef(name='acl', is_required=False, parser=ACLParser())
+        ParameterDef(name='acl', is_required=False, parser=ACLParser()),
+        ParameterDef(name='metrics_interval', is_required=False, validators=[validators.integer])
     ]
     IN_LOOP = True
     REQUIRED_DRIVERS = [DataChannelDriver.typeid()]
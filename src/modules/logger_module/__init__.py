@@ -2,7 +2,7 @@ import logging
 
 from typing import Dict
 
-from common.model import Module, Driver, ActionDef, EventDef
+from common.model import Module, Driver, ActionDef, EventDef, PRIORITY_BULK
 
 ACTION_LOG = 0x01
 
@@ -28,5 +28,5 @@ class LoggerModule(Module):
         return 0x0101
 
     ACTIONS = [
-        ActionDef(ACTION_LOG, 'log', log),
+        ActionDef(ACTION_LOG, 'log', log, priority=PRIORITY_BULK),
     ]
@@ -4,7 +4,7 @@ from typing import Dict
 
 from common.drivers import OneWireDriver
 from common.errors import InvalidModuleError
-from common.model import StateAwareModule, ParameterDef, Driver
+from common.model import StateAwareModule, ParameterDef, Driver, WORKER_POOL_IO
 
 
 class OneWireThermometerModule(StateAwareModule):
@@ -49,3 +49,4 @@ class OneWireThermometerModule(StateAwareModule):
     MINIMAL_ITERATION_INTERVAL = 5 * 60 * 1000
     REQUIRED_DRIVERS = [OneWireDriver.typeid()]
     IN_BACKGROUND = True
+    WORKER_POOL = WORKER_POOL_IO
@@ -1,32 +1,112 @@
+import functools
 import logging
+import mmap
+import os
+import threading
+
+from typing import List, Dict, Tuple
+
 from common.drivers import GPIODriver
 from common.errors import SimpleException
 
 
 class OpiH3GPIODriver(GPIODriver):
+    # Allwinner H3 PIO controller. Every port (PA..PG) has 0x24 bytes of registers, data register holds one bit per pin
+    PIO_BASE_ADDRESS = 0x01C20800
+    PORT_REGISTERS_SIZE = 0x24
+    DATA_REGISTER_OFFSET = 0x10
+    PINS_PER_PORT = 32
+    PIO_PORTS_COUNT = 7  # Port L belongs to separate R_PIO controller and isn't supported by line groups
+
     class OpiH3Channel(GPIODriver.Channel):
+        """
+        Reads and writes go through the shadow register of the driver. Register keeps levels of the pins as they are
+        in hardware, i.e. written levels are inverted before they get there.
+        """
 
-        def __init__(self, gpio, pin, mode, pullup=True):
+        def __init__(self, driver, gpio, pin, mode, pullup=True):
+            """
+            :type driver: OpiH3GPIODriver
+            """
+            self.__driver = driver
             self.__gpio = gpio
             self.pin = pin
+            self.__mode = mode
+            self.__read_pin = functools.partial(gpio.input, pin)
             self.__gpio.setcfg(pin, self.__gpio.INPUT if mode == GPIODriver.GPIO_MODE_READ else self.__gpio.OUTPUT)
             if pullup is not None:
                 self.__gpio.pullup(pin, self.__gpio.PULLUP if pullup else self.__gpio.PULLDOWN)
 
         def write(self, state: [int, bool]):
-            self.__gpio.output(self.pin, not state)
+            self.__driver.shadow.write(self.pin, 0 if state else 1)
+
+        def mode(self):
+            return self.__mode
 
         def read(self, reverse=False) -> int:
-            if reverse:
-                return int(not self.__gpio.input(self.pin))
+            if self.__mode == GPIODriver.GPIO_MODE_READ:
+                value = self.__driver.shadow.read(self.pin, self.__read_pin)
             else:
-                return self.__gpio.input(self.pin)
+                value = self.__driver.shadow.read_output(self.pin, self.__read_pin)
+            return int(not value) if reverse else value
+
+    class OpiH3LineGroup(GPIODriver.LineGroup):
+        """
+        Accesses data registers of PIO ports directly: all the lines of the same port are read or written with one
+        register access, so they change simultaneously. Read-modify-write of the register is serialized by the driver
+        lock. Written levels are inverted the same way as OpiH3Channel does. Writes bypass the shadow register, so they
+        are recorded there afterwards.
+        """
+
+        def __init__(self, channels: list, registers: memoryview, lock: threading.Lock,
+                     shadow: GPIODriver.ShadowRegister):
+            super().__init__(channels)
+            self.__registers = registers
+            self.__lock = lock
+            self.__shadow = shadow
+            # Register index -> list of (bit, position of the line in the group)
+            ports = {}  # type: Dict[int, List[Tuple[int, int]]]
+            for position, channel in enumerate(channels):
+                port, bit = divmod(channel.pin, OpiH3GPIODriver.PINS_PER_PORT)
+                index = (port * OpiH3GPIODriver.PORT_REGISTERS_SIZE + OpiH3GPIODriver.DATA_REGISTER_OFFSET) // 4
+                ports.setdefault(index, []).append((bit, position))
+            self.__ports = [(index, lines, sum(1 << bit for bit, _ in lines)) for index, lines in ports.items()]
+
+        def read(self, reverse=False) -> List[int]:
+            levels = [0] * len(self.channels)
+            registers = self.__registers
+            for index, lines, _ in self.__ports:
+                value = registers[index]
+                for bit, position in lines:
+                    levels[position] = ((value >> bit) & 1) ^ reverse
+            return levels
+
+        def write(self, states: List[int]):
+            if len(states) != len(self.channels):
+                raise ValueError('Expected {} states, got {}'.format(len(self.channels), len(states)))
+            registers = self.__registers
+            with self.__lock:
+                for index, lines, mask in self.__ports:
+                    value = registers[index] | mask
+                    for bit, position in lines:
+                        if states[position]:
+                            value &= ~(1 << bit)
+                    registers[index] = value
+            for channel, state in zip(self.channels, states):
+                self.__shadow.written(channel.pin, 0 if state else 1)
 
     def __init__(self):
         self.__logger = logging.getLogger(self.__class__.__name__)
+        self.__registers = None  # type: memoryview # PIO registers as 32-bit words, mapped on first use
+        self.__registers_lock = threading.Lock()
+        self.__gpio = None
+        # Writes are applied immediately until driver is attached to application which flushes them once per tick
+        self.shadow = GPIODriver.ShadowRegister(self.__write_pin)
 
     def on_initialized(self, application):
         super().on_initialized(application)
+        if application is not None:
+            self.shadow = GPIODriver.ShadowRegister(self.__write_pin, application, driver='opi')
         try:
             from pyA20.gpio import gpio
             from pyA20.gpio import port
@@ -42,5 +122,33 @@ class OpiH3GPIODriver(GPIODriver):
             pin = getattr(self.__port, pin)
         except Exception as e:
             raise SimpleException("Unable to use pin " + str(pin), e)
-        channel = OpiH3GPIODriver.OpiH3Channel(self.__gpio, pin, mode, pullup)
+        channel = OpiH3GPIODriver.OpiH3Channel(self, self.__gpio, pin, mode, pullup)
         return channel
+
+    def new_line_group(self, channels: List[OpiH3Channel]) -> GPIODriver.LineGroup:
+        if any(channel.pin // self.PINS_PER_PORT >= self.PIO_PORTS_COUNT for channel in channels):
+            self.__logger.warning("Lines of port L can't be accessed through PIO registers, they will be accessed "
+                                  "one by one")
+            return GPIODriver.LineGroup(channels)
+        return OpiH3GPIODriver.OpiH3LineGroup(channels, self.__map_registers(), self.__registers_lock, self.shadow)
+
+    def __write_pin(self, pin: int, level: int):
+        self.__gpio.output(pin, level)
+
+    def __map_registers(self) -> memoryview:
+        with self.__registers_lock:
+            if self.__registers is None:
+                page_address = self.PIO_BASE_ADDRESS & ~(mmap.PAGESIZE - 1)
+                try:
+                    fd = os.open('/dev/mem', os.O_RDWR | os.O_SYNC)
+                    try:
+                        memory = mmap.mmap(fd, mmap.PAGESIZE, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE,
+                                           offset=page_address)
+                    finally:
+                        os.close(fd)
+                except OSError as e:
+                    raise SimpleException("Unable to map GPIO registers. Most likely this is because you need "
+                                          "administrative permissions.", e)
+                # Word-sized view makes every register access a single 32-bit load or store
+                self.__registers = memoryview(memory)[self.PIO_BASE_ADDRESS - page_address:].cast('I')
+            return self.__registers
@@ -0,0 +1,132 @@
+import unittest
+
+from common.config_parser import ACLParser
+from common.errors import ConfigError
+from common.model import ACL
+
+
+def parse(**section) -> ACL:
+    return ACLParser().parse(section, None, 'devices.bus.acl')
+
+
+class ACLTest(unittest.TestCase):
+    def test_restrictive_mode_allows_only_listed_actions(self):
+        acl = parse(allow=['#lamp.toggle'])
+        self.assertTrue(acl.validate_operation('lamp', 'toggle'))
+        self.assertFalse(acl.validate_operation('lamp', 'off'))
+        self.assertFalse(acl.validate_operation('lamp_2', 'toggle'))
+
+    def test_deny_wins_over_allow(self):
+        acl = parse(allow=['#lamp.*'], deny=['#lamp.off'])
+        self.assertTrue(acl.validate_operation('lamp', 'on'))
+        self.assertFalse(acl.validate_operation('lamp', 'off'))
+
+    def test_permissive_mode_allows_everything_not_denied(self):
+        acl = parse(mode=ACL.MODE_PERMISSIVE, deny=['#*.reboot'])
+        self.assertTrue(acl.validate_operation('lamp', 'toggle'))
+        self.assertFalse(acl.validate_operation('router', 'reboot'))
+
+    def test_wildcards_in_device_and_action_names(self):
+        acl = parse(allow=['#bedroom_*.toggle', '#*.set_*'])
+        self.assertTrue(acl.validate_operation('bedroom_lamp', 'toggle'))
+        self.assertTrue(acl.validate_operation('bedroom_', 'toggle'))
+        self.assertFalse(acl.validate_operation('kitchen_lamp', 'toggle'))
+        self.assertTrue(acl.validate_operation('heater', 'set_temperature'))
+        self.assertFalse(acl.validate_operation('heater', 'reset_temperature'))
+
+    def test_wildcard_doesnt_cross_device_and_action_boundary(self):
+        acl = parse(allow=['#lamp*.on'])
+        self.assertTrue(acl.validate_operation('lamp_1', 'on'))
+        # Device pattern can't swallow the action part of the name
+        self.assertFalse(acl.validate_operation('lamp_1', 'off'))
+
+    def test_regex_characters_are_literal(self):
+        acl = parse(allow=['#lamp(1)*.on'])
+        self.assertTrue(acl.validate_operation('lamp(1)_x', 'on'))
+        self.assertFalse(acl.validate_operation('lamp1', 'on'))
+
+    def test_rule_without_action_matches_nothing(self):
+        acl = parse(allow=['#lamp', '#bedroom_*'])
+        self.assertFalse(acl.validate_operation('lamp', 'toggle'))
+        self.assertFalse(acl.validate_operation('bedroom_lamp', 'toggle'))
+        self.assertEqual(2, len(acl.allowed))
+
+    def test_decisions_are_recomputed_once_rules_change(self):
+        acl = parse(allow=['#lamp.*'])
+        self.assertTrue(acl.validate_operation('lamp', 'off'))
+        acl.deny('lamp', 'off', ACL.TARGET_TYPE_ACTION)
+        self.assertFalse(acl.validate_operation('lamp', 'off'))
+        acl.mode = ACL.MODE_PERMISSIVE
+        self.assertTrue(acl.validate_operation('heater', 'off'))
+
+    def test_action_rules_dont_apply_to_events(self):
+        acl = parse(allow=['#lamp.*'])
+        self.assertFalse(acl.validate_operation('lamp', 'state_changed', ACL.TARGET_TYPE_EVENT))
+
+    def test_event_rules(self):
+        acl = parse(allow=[{'event': '#lamp_*.state_changed'}, '#lamp_1.state_changed'])
+        self.assertTrue(acl.validate_operation('lamp_2', 'state_changed', ACL.TARGET_TYPE_EVENT))
+        self.assertFalse(acl.validate_operation('lamp_2', 'state_changed'))
+        self.assertTrue(acl.validate_operation('lamp_1', 'state_changed'))
+        self.assertFalse(acl.validate_operation('kitchen', 'state_changed', ACL.TARGET_TYPE_EVENT))
+        self.assertTrue(acl.has_rules(ACL.TARGET_TYPE_EVENT))
+        self.assertFalse(parse(allow=['#lamp.*']).has_rules(ACL.TARGET_TYPE_EVENT))
+
+    def test_invalid_rules(self):
+        with self.assertRaises(ConfigError):
+            parse(allow=[{'state': '#lamp.state_changed'}])
+        with self.assertRaises(ConfigError):
+            parse(allow=[{'event': '#lamp.state_changed', 'action': '#lamp.toggle'}])
+        with self.assertRaises(ConfigError):
+            parse(allow=[{'event': 1}])
+        with self.assertRaises(ConfigError):
+            parse(allow=['lamp.toggle'])
+
+    def test_patterns_sharing_device_prefix(self):
+        acl = parse(allow=['#bedroom_*.set_*', '#bed*.on', '#bedroom_*_lamp.toggle', '#*room*.off'])
+        self.assertTrue(acl.validate_operation('bedroom_1', 'set_level'))
+        self.assertTrue(acl.validate_operation('bedside', 'on'))
+        self.assertTrue(acl.validate_operation('bedroom_2_lamp', 'toggle'))
+        self.assertTrue(acl.validate_operation('kitchen_room', 'off'))
+        self.assertFalse(acl.validate_operation('bedroom_2_fan', 'toggle'))
+        self.assertFalse(acl.validate_operation('be', 'on'))
+        self.assertFalse(acl.validate_operation('kitchen', 'off'))
+
+
+class DecisionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.acl = parse(allow=['#lamp_*.on'])
+        self.decisions = []
+        decide = self.acl._ACL__decide
+
+        def counting_decide(*args):
+            self.decisions.append(args)
+            return decide(*args)
+
+        self.acl._ACL__decide = counting_decide
+
+    def test_decisions_are_cached(self):
+        for _ in range(3):
+            self.assertTrue(self.acl.validate_operation('lamp_1', 'on'))
+        self.assertEqual(1, len(self.decisions))
+
+    def test_least_recently_used_decision_is_evicted(self):
+        self.acl.DECISION_CACHE_SIZE = 3
+        for name in ('lamp_1', 'lamp_2', 'lamp_3'):
+            self.acl.validate_operation(name, 'on')
+        self.acl.validate_operation('lamp_1', 'on')  # The least recently used is lamp_2 now
+        self.acl.validate_operation('lamp_4', 'on')
+        del self.decisions[:]
+        for name in ('lamp_1', 'lamp_3', 'lamp_4'):
+            self.acl.validate_operation(name, 'on')
+        self.assertEqual([], self.decisions)
+        self.acl.validate_operation('lamp_2', 'on')
+        self.assertEqual([('lamp_2', 'on', ACL.TARGET_TYPE_ACTION)], self.decisions)
+
+    def test_stream_of_unique_names_doesnt_wipe_the_cache(self):
+        self.acl.DECISION_CACHE_SIZE = 10
+        self.acl.validate_operation('lamp_1', 'on')
+        for i in range(100):
+            self.acl.validate_operation('lamp_1', 'on')
+            self.acl.validate_operation('unknown_{}'.format(i), 'on')
+        self.assertEqual(1, sum(1 for args in self.decisions if args[0] == 'lamp_1'))
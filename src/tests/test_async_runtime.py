@@ -0,0 +1,140 @@
+import threading
+import time
+import unittest
+
+from common.async_runtime import AsyncApplicationManager
+from common.model import Module, ActionDef, EventDef, PipedEvent, InstanceSettings
+from common.model import WORKER_POOL_DEFAULT, WORKER_POOL_IO
+from common.queues import OVERFLOW_COALESCE, OVERFLOW_DROP_OLDEST
+
+
+class Sleeper(Module):
+    def __init__(self, application):
+        super().__init__(application, {})
+        self.calls = 0
+
+    @staticmethod
+    def type_name() -> str:
+        return 'Sleeper'
+
+    def sleep(self, data, **kwargs):
+        time.sleep(0.3)
+        self.calls += 1
+
+    ACTIONS = [ActionDef(0x01, 'sleep', sleep)]
+    EVENTS = [EventDef(0x01, 'tick')]
+
+
+class Counter(Module):
+    def __init__(self, application):
+        super().__init__(application, {})
+        self.values = []
+
+    @staticmethod
+    def type_name() -> str:
+        return 'Counter'
+
+    async def count(self, data, **kwargs):
+        self.values.append(data)
+
+    ACTIONS = [ActionDef(0x01, 'count', count)]
+
+
+class BackgroundReader(Module):
+    IN_BACKGROUND = True
+    WORKER_POOL = WORKER_POOL_IO
+    MINIMAL_ITERATION_INTERVAL = 5
+
+    def __init__(self, application):
+        super().__init__(application, {})
+        self.threads = set()
+
+    @staticmethod
+    def type_name() -> str:
+        return 'BackgroundReader'
+
+    def step(self):
+        self.threads.add(threading.current_thread().name)
+
+
+class RuntimeTestCase(unittest.TestCase):
+    """
+    Runs the main loop of asyncio runtime with single worker in each pool
+    """
+    QUEUES = {}
+
+    def setUp(self):
+        self.application = AsyncApplicationManager()
+        settings = self.application.get_instance_settings()
+        settings.worker_pools = {WORKER_POOL_DEFAULT: 1, WORKER_POOL_IO: 1}
+        settings.queues = self.QUEUES
+        self.application.start_dispatching()
+        thread = threading.Thread(target=self.application.main_loop, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 2)
+        self.addCleanup(self.application.shutdown)
+
+    def register(self, device: Module, device_id: int, name: str) -> Module:
+        device.id, device.name = device_id, name
+        self.application.register_device(device)
+        return device
+
+    @staticmethod
+    def wait_for(condition, timeout: float = 1):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+
+class AsyncRuntimeTest(RuntimeTestCase):
+    def assert_loop_is_responsive(self):
+        fired = threading.Event()
+        self.application.call_later(10, fired.set)
+        self.assertTrue(fired.wait(0.2), 'Delayed call was stalled by blocking action')
+
+    def test_blocking_action_does_not_stall_loop(self):
+        sleeper = self.register(Sleeper(self.application), 1, 'sleeper')
+        self.assertTrue(self.application.run_async_action(sleeper, Sleeper.ACTIONS[0]))
+        self.assert_loop_is_responsive()
+
+    def test_blocking_piped_action_does_not_stall_loop(self):
+        sleeper = self.register(Sleeper(self.application), 1, 'sleeper')
+        self.application.register_pipe(PipedEvent(declared_in=sleeper, target=sleeper, event=Sleeper.EVENTS[0],
+                                                  action=Sleeper.ACTIONS[0]))
+        self.assertTrue(self.application.emit_event(sleeper, 0x01))
+        self.assert_loop_is_responsive()
+        self.wait_for(lambda: sleeper.calls)
+        self.assertEqual(1, sleeper.calls)
+
+    def test_background_step_runs_in_pool_of_module(self):
+        reader = self.register(BackgroundReader(self.application), 2, 'reader')
+        self.wait_for(lambda: reader.threads)
+        self.assertEqual({'m-io-worker-0'}, reader.threads)
+
+
+class AsyncOverflowTest(RuntimeTestCase):
+    QUEUES = {InstanceSettings.QUEUE_TASKS: dict(capacity=2, policy=OVERFLOW_DROP_OLDEST)}
+
+    def run_counter(self, policy: str = None) -> Counter:
+        """
+        Invokes coroutine action of the counter while the only worker is busy with blocking action
+        """
+        sleeper = self.register(Sleeper(self.application), 1, 'sleeper')
+        counter = self.register(Counter(self.application), 3, 'counter')
+        self.application.run_async_action(sleeper, Sleeper.ACTIONS[0])
+        time.sleep(0.1)  # Worker took the action from the queue
+        for value in range(3):
+            self.assertTrue(self.application.run_async_action(counter, Counter.ACTIONS[0], value, policy=policy))
+        self.wait_for(lambda: sleeper.calls)
+        time.sleep(0.1)  # Spawned coroutines are done
+        return counter
+
+    def test_oldest_coroutine_action_is_evicted(self):
+        counter = self.run_counter()
+        self.assertEqual([1, 2], counter.values)
+        self.assertEqual(1, self.application.get_worker_pool_stats()[WORKER_POOL_DEFAULT]['dropped'][
+            OVERFLOW_DROP_OLDEST])
+
+    def test_coroutine_actions_are_coalesced(self):
+        counter = self.run_counter(OVERFLOW_COALESCE)
+        self.assertEqual([2], counter.values)
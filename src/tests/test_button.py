@@ -0,0 +1,266 @@
+import unittest
+from unittest import mock
+
+from common import utils
+from common.drivers import GPIODriver
+from common.queues import OVERFLOW_BLOCK
+from modules.button import ButtonModule, EVENT_CLICK, EVENT_LONG_CLICK, EVENT_DOUBLE_CLICK
+
+PRESS, RELEASE = 1, 0
+
+
+class FakeTime(object):
+    def __init__(self, now: int = 1000):
+        self.now = now
+
+    def __call__(self) -> int:
+        return self.now
+
+
+class FakeChannel(GPIODriver.Channel):
+    def __init__(self, edge_driven: bool):
+        self.level = 0  # Raw level of the line
+        self.edge_driven = edge_driven
+        self.callback = None
+
+    def read(self, reverse=False) -> int:
+        return self.level ^ 1 if reverse else self.level
+
+    def subscribe(self, callback) -> bool:
+        if self.edge_driven:
+            self.callback = callback
+        return self.edge_driven
+
+    def unsubscribe(self, callback):
+        self.callback = None
+
+
+class FakeGPIODriver(GPIODriver):
+    def __init__(self, channel: FakeChannel):
+        super().__init__()
+        self.channel = channel
+
+    def new_channel(self, pin, direction, pullup=True):
+        return self.channel
+
+
+class StubApplication(object):
+    """
+    Runs one-shot timers and requested steps by hand against the fake clock
+    """
+
+    def __init__(self, time: FakeTime):
+        self.time = time
+        self.timers = []  # [due, callback]
+        self.events = []  # (event id, time)
+        self.step_requested = False
+
+    def emit_event(self, sender, event_id, data=None, policy=None) -> bool:
+        self.events.append((event_id, self.time.now))
+        return True
+
+    def request_step(self, device):
+        self.step_requested = True
+
+    def call_later(self, delay, callback):
+        timer = [self.time.now + delay, callback]
+        self.timers.append(timer)
+        return timer
+
+    def cancel_call(self, timer):
+        self.timers.remove(timer)
+
+
+class ButtonTest(unittest.TestCase):
+    EDGE_DRIVEN = True
+
+    def setUp(self):
+        self.time = FakeTime()
+        patcher = mock.patch('common.utils.capture_time', self.time)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.application = StubApplication(self.time)
+        self.channel = FakeChannel(self.EDGE_DRIVEN)
+
+    def create(self, **params) -> ButtonModule:
+        button = ButtonModule(self.application, {GPIODriver.typeid(): FakeGPIODriver(self.channel)})
+        button.gpio = 1
+        button.pullup = False
+        for name, value in params.items():
+            setattr(button, name, value)
+        button.on_initialized()
+        self.button = button
+        return button
+
+    def run_until(self, now: int):
+        """
+        Fires timers due before the given time in order of their deadlines
+        """
+        while self.application.timers:
+            timer = min(self.application.timers, key=lambda t: t[0])
+            if timer[0] > now:
+                break
+            self.application.timers.remove(timer)
+            self.time.now = timer[0]
+            utils.clock.tick()
+            timer[1]()
+        self.time.now = now
+
+    def step(self):
+        """
+        Steps the button within a new tick like the scheduler does
+        """
+        utils.clock.tick()
+        self.button.step()
+
+    def transition(self, at: int, level: int):
+        """
+        Changes level of the line at the given time and runs step processing it
+        """
+        self.run_until(at)
+        self.change_level(at, level)
+        self.step()
+        self.application.step_requested = False
+
+    def change_level(self, at: int, level: int):
+        self.channel.level = level
+        if self.channel.callback is not None:
+            self.channel.callback(level, at)
+
+    def assert_events(self, *expected):
+        self.assertEqual(list(expected), self.application.events)
+
+    def test_click(self):
+        self.create()
+        self.transition(1000, PRESS)
+        self.transition(1100, RELEASE)
+        self.assert_events((EVENT_CLICK, 1100))
+        self.run_until(3000)
+        self.assertEqual([], self.application.timers)
+
+    def test_edge_requests_step(self):
+        self.create()
+        self.channel.callback(PRESS, 1000)
+        self.assertTrue(self.application.step_requested)
+
+    def test_pullup_inverts_level(self):
+        self.create(pullup=True)
+        self.transition(1000, 0)
+        self.transition(1100, 1)
+        self.assert_events((EVENT_CLICK, 1100))
+
+    def test_bounces_within_debounce_window_are_ignored(self):
+        self.create(debounce=20)
+        self.transition(1000, PRESS)
+        self.transition(1005, RELEASE)
+        self.transition(1010, PRESS)
+        self.transition(1100, RELEASE)
+        self.transition(1110, PRESS)
+        self.transition(1115, RELEASE)
+        self.run_until(2000)
+        self.assert_events((EVENT_CLICK, 1100))
+
+    def test_level_at_the_end_of_debounce_window_is_accepted(self):
+        self.create(debounce=20)
+        self.transition(1000, PRESS)
+        self.transition(1010, RELEASE)  # Short pulse is swallowed by the window, release is applied once it ends
+        self.assert_events()
+        self.run_until(1020)
+        self.assert_events((EVENT_CLICK, 1020))
+
+    def test_double_click(self):
+        self.create(handle_double_click=True)
+        self.transition(1000, PRESS)
+        self.transition(1100, RELEASE)
+        self.transition(1200, PRESS)
+        self.transition(1300, RELEASE)
+        self.run_until(3000)
+        self.assert_events((EVENT_DOUBLE_CLICK, 1300))
+
+    def test_click_is_emitted_once_double_click_times_out(self):
+        self.create(handle_double_click=True, double_click_duration=400)
+        self.transition(1000, PRESS)
+        self.transition(1100, RELEASE)
+        self.assert_events()
+        self.run_until(1499)
+        self.assert_events()
+        self.run_until(1500)
+        self.assert_events((EVENT_CLICK, 1500))
+        self.transition(1600, PRESS)
+        self.transition(1700, RELEASE)
+        self.run_until(3000)
+        self.assert_events((EVENT_CLICK, 1500), (EVENT_CLICK, 2100))
+
+    def test_long_click(self):
+        self.create(handle_long_click=True, long_click_duration=1000)
+        self.transition(1000, PRESS)
+        self.run_until(1999)
+        self.assert_events()
+        self.run_until(2000)
+        self.assert_events((EVENT_LONG_CLICK, 2000))
+        self.transition(2500, RELEASE)
+        self.assert_events((EVENT_LONG_CLICK, 2000))
+        self.run_until(3000)
+        self.assertEqual([], self.application.timers)
+
+    def test_timeouts_are_ordered_by_transition_time_when_processed_late(self):
+        # Main loop was busy: the second press is processed after both timeouts would have expired. Click timeout
+        # had expired before the press happened, so the press starts a new gesture rather than double click
+        self.create(handle_double_click=True, handle_long_click=True, double_click_duration=400,
+                    long_click_duration=1000)
+        self.transition(1000, PRESS)
+        self.transition(1100, RELEASE)
+        self.change_level(1600, PRESS)
+        self.time.now = 2700  # Neither timers nor step could run meanwhile
+        self.step()
+        self.assert_events((EVENT_CLICK, 2700), (EVENT_LONG_CLICK, 2700))
+        self.transition(2800, RELEASE)
+        self.assert_events((EVENT_CLICK, 2700), (EVENT_LONG_CLICK, 2700))
+
+    def test_long_press_cancels_pending_double_click(self):
+        self.create(handle_double_click=True, handle_long_click=True, double_click_duration=400,
+                    long_click_duration=200)
+        self.transition(1000, PRESS)
+        self.transition(1050, RELEASE)
+        self.transition(1100, PRESS)
+        self.run_until(1300)
+        self.assert_events((EVENT_CLICK, 1300), (EVENT_LONG_CLICK, 1300))
+
+    def test_timeouts_are_counted_from_tick_time(self):
+        self.create(handle_long_click=True, long_click_duration=1000, debounce=0)
+        self.run_until(1000)
+        utils.clock.tick()
+        self.change_level(1000, PRESS)
+        self.time.now = 1050  # Clock moved on within the tick
+        self.button.step()
+        self.assertEqual([2050], [due for due, _ in self.application.timers])
+
+    def test_destroy_cancels_timer(self):
+        self.create(handle_long_click=True)
+        self.transition(1000, PRESS)
+        self.assertEqual(1, len(self.application.timers))
+        self.button.on_before_destroyed()
+        self.assertEqual([], self.application.timers)
+        self.assertIsNone(self.channel.callback)
+
+    def test_gestures_are_not_waiting_for_room_in_queue(self):
+        # Gestures are emitted from the main loop
+        for event in ButtonModule.EVENTS:
+            self.assertNotEqual(OVERFLOW_BLOCK, event.overflow)
+
+
+class PolledButtonTest(ButtonTest):
+    """
+    The same gestures recognized from sampling of the input. Transitions are seen at the time of the step
+    """
+    EDGE_DRIVEN = False
+
+    def test_edge_requests_step(self):
+        self.skipTest('Polled channel does not report edges')
+
+    def test_timeouts_are_ordered_by_transition_time_when_processed_late(self):
+        self.skipTest('Time of the transition is known only for edges')
+
+    def test_poll_interval_is_step_interval(self):
+        button = self.create(poll_interval=25)
+        self.assertEqual(25, button.MINIMAL_ITERATION_INTERVAL)
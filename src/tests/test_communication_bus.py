@@ -0,0 +1,92 @@
+import json
+import unittest
+
+from common.config_parser import ACLParser
+from common.core import MetricsRegistry
+from common.model import InstanceSettings, Module, StateSnapshot, EventDef, EVENT_STATE_CHANGED
+from modules.communication_bus import CommunicationBusModule
+from unix.drivers import MQTTDriver
+
+
+class StubApplication(object):
+    def __init__(self):
+        self.metrics = MetricsRegistry()
+
+    def get_instance_settings(self):
+        return InstanceSettings()
+
+
+class FakeChannel(object):
+    def __init__(self):
+        self.sent = []
+
+    def is_connected(self) -> bool:
+        return True
+
+    def send(self, topic, data):
+        self.sent.append((topic, data))
+
+
+class Lamp(Module):
+    def __init__(self, application, name: str):
+        super().__init__(application, {})
+        self.name = name
+
+
+STATE_CHANGED = EventDef(EVENT_STATE_CHANGED, 'state_changed')
+
+
+class BusTest(unittest.TestCase):
+    def setUp(self):
+        self.application = StubApplication()
+        self.bus = CommunicationBusModule(self.application, {})
+        self.bus.channel = FakeChannel()
+
+    def push_state(self, device_name: str):
+        snapshot = StateSnapshot(('on',), (True,), 1)
+        self.bus.push_state(snapshot, event=STATE_CHANGED, sender=Lamp(self.application, device_name))
+
+    def published(self) -> list:
+        return [topic for topic, _ in self.bus.channel.sent]
+
+    def test_state_is_published_if_acl_has_no_event_rules(self):
+        self.bus.acl = ACLParser().parse({'allow': ['#lamp.toggle']}, None)
+        self.push_state('lamp')
+        self.assertEqual(['/lamp/state'], self.published())
+
+    def test_event_rules_filter_published_state(self):
+        self.bus.acl = ACLParser().parse({'allow': [{'event': '#lamp_*.state_changed'}]}, None)
+        self.push_state('lamp_1')
+        self.push_state('lock')
+        self.assertEqual(['/lamp_1/state'], self.published())
+
+    def test_published_metrics_are_valid_json(self):
+        metrics = self.application.metrics
+        metrics.histogram('step_ms', device='lamp').observe(10 ** 6)  # Falls into +Inf bucket
+        metrics.gauge('broken', lambda: 1 / 0)
+        metrics.gauge('ratio', lambda: float('inf'))
+        self.bus.publish_metrics()
+        _, snapshot = self.bus.channel.sent[0]
+
+        def reject(constant):
+            raise ValueError('{} is not JSON'.format(constant))
+
+        published = {name: json.loads(MQTTDriver.MQTTChannel.encode_value(values), parse_constant=reject)
+                     for name, values in snapshot.items()}
+        self.assertEqual({'count': 1, 'p50': None, 'p99': None}, published['step_ms']['device=lamp'])
+        self.assertEqual({'': None}, published['broken'])
+        self.assertEqual({'': None}, published['ratio'])
+
+
+class MQTTEncodingTest(unittest.TestCase):
+    def test_scalars_are_sent_as_is(self):
+        self.assertEqual('kitchen', MQTTDriver.MQTTChannel.encode_value('kitchen'))
+        self.assertEqual('42', MQTTDriver.MQTTChannel.encode_value(42))
+        self.assertEqual('20.5', MQTTDriver.MQTTChannel.encode_value(20.5))
+
+    def test_other_values_are_sent_as_json(self):
+        self.assertEqual('true', MQTTDriver.MQTTChannel.encode_value(True))
+        self.assertEqual('null', MQTTDriver.MQTTChannel.encode_value(None))
+        self.assertEqual('[1, 2]', MQTTDriver.MQTTChannel.encode_value([1, 2]))
+        self.assertEqual('[1, 2]', MQTTDriver.MQTTChannel.encode_value((1, 2)))
+        self.assertEqual({'p50': 1.5}, json.loads(MQTTDriver.MQTTChannel.encode_value({'p50': 1.5})))
@@ -0,0 +1,102 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from common.core import ApplicationManager
+from common.model import Module, InstanceSettings, ActionDef, WORKER_POOL_DEFAULT
+from common.queues import OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST
+
+
+class BackgroundCounter(Module):
+    IN_BACKGROUND = True
+    MINIMAL_ITERATION_INTERVAL = 5
+
+    def __init__(self, application):
+        super().__init__(application, {})
+        self.steps = 0
+
+    @staticmethod
+    def type_name() -> str:
+        return 'BackgroundCounter'
+
+    def step(self):
+        self.steps += 1
+
+
+class Recorder(Module):
+    def __init__(self, application):
+        super().__init__(application, {})
+        self.calls = 0
+
+    @staticmethod
+    def type_name() -> str:
+        return 'Recorder'
+
+    def record(self, data, **kwargs):
+        self.calls += 1
+
+    ACTIONS = [ActionDef(0x01, 'record', record)]
+
+
+def start(application: ApplicationManager) -> threading.Thread:
+    thread = threading.Thread(target=application.main_loop, daemon=True)
+    thread.start()
+    return thread
+
+
+def stop(application: ApplicationManager, thread: threading.Thread):
+    application.shutdown()
+    thread.join(2)
+
+
+class BackgroundStepOverflowTest(unittest.TestCase):
+    def run_flood(self, policy: str):
+        application = ApplicationManager()
+        settings = application.get_instance_settings()
+        settings.worker_pools = {WORKER_POOL_DEFAULT: 1}
+        settings.queues = {InstanceSettings.QUEUE_TASKS: dict(capacity=5, policy=policy)}
+        device = BackgroundCounter(application)
+        device.id, device.name = 1, 'counter'
+        application.register_device(device)
+        application.start_worker_pools()
+        thread = start(application)
+        try:
+            flood_until = time.monotonic() + 0.3
+            while time.monotonic() < flood_until:
+                application.run_async(time.sleep, 0.001)
+            self.assertGreater(application.get_step_stats()['counter']['dropped'], 0)
+            time.sleep(0.1)  # Let worker drain the queue
+            steps = device.steps
+            time.sleep(0.2)
+            self.assertGreater(device.steps, steps, 'Device stopped stepping after its step was dropped')
+        finally:
+            stop(application, thread)
+
+    def test_rejected_step_is_rescheduled(self):
+        self.run_flood(OVERFLOW_DROP_NEWEST)
+
+    def test_evicted_step_is_rescheduled(self):
+        self.run_flood(OVERFLOW_DROP_OLDEST)
+
+
+class ActionDurationTest(unittest.TestCase):
+    def test_histogram_is_resolved_at_registration(self):
+        application = ApplicationManager()
+        application.get_instance_settings().worker_pools = {WORKER_POOL_DEFAULT: 1}
+        device = Recorder(application)
+        device.id, device.name = 1, 'recorder'
+        application.register_device(device)
+        application.start_worker_pools()
+        try:
+            with mock.patch.object(application.metrics, 'histogram', side_effect=AssertionError('registry is hit')):
+                for _ in range(3):
+                    self.assertTrue(application.run_async_action(device, Recorder.ACTIONS[0]))
+                deadline = time.monotonic() + 1
+                while device.calls < 3 and time.monotonic() < deadline:
+                    time.sleep(0.01)
+            self.assertEqual(3, device.calls)
+            histogram = application.metrics.histogram('action_duration_ms', '', device='recorder', action='record')
+            self.assertEqual(3, histogram.count)
+        finally:
+            application.shutdown()
@@ -0,0 +1,215 @@
+import unittest
+from unittest import mock
+
+from common import utils
+from common.core import MetricsRegistry, ApplicationManager
+from common.drivers import GPIODriver
+from common.model import Module
+from opi.drivers import OpiH3GPIODriver
+
+
+class StubApplication(object):
+    def __init__(self):
+        self.metrics = MetricsRegistry()
+        self.flush_requests = []
+
+    def request_flush(self, key, callback):
+        self.flush_requests.append((key, callback))
+
+    def end_tick(self):
+        requests, self.flush_requests = self.flush_requests, []
+        for _, callback in requests:
+            callback()
+
+
+class FakeTime(object):
+    def __init__(self, now: int = 1000):
+        self.now = now
+
+    def __call__(self) -> int:
+        return self.now
+
+
+class Hardware(object):
+    def __init__(self):
+        self.levels = {}
+        self.reads = 0
+        self.writes = []
+
+    def reader(self, line):
+        def read():
+            self.reads += 1
+            return self.levels.get(line, 0)
+
+        return read
+
+    def write(self, line, level):
+        self.writes.append((line, level))
+        self.levels[line] = level
+
+
+class ShadowRegisterTest(unittest.TestCase):
+    def setUp(self):
+        self.time = FakeTime()
+        patcher = mock.patch('common.utils.capture_time', self.time)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        utils.clock.tick()
+        self.hardware = Hardware()
+        self.application = StubApplication()
+        self.register = GPIODriver.ShadowRegister(self.hardware.write, self.application, driver='test')
+
+    def test_input_is_read_once_per_tick(self):
+        self.hardware.levels[5] = 1
+        self.assertEqual(1, self.register.read(5, self.hardware.reader(5)))
+        self.hardware.levels[5] = 0
+        self.assertEqual(1, self.register.read(5, self.hardware.reader(5)))
+        self.assertEqual(1, self.hardware.reads)
+        utils.clock.tick()
+        self.assertEqual(0, self.register.read(5, self.hardware.reader(5)))
+        self.assertEqual(2, self.hardware.reads)
+        stats = self.register.get_stats()
+        self.assertEqual((1, 2), (stats['hits'], stats['misses']))
+
+    def test_cached_input_expires_within_long_tick(self):
+        self.register.read(5, self.hardware.reader(5))
+        self.time.now += GPIODriver.ShadowRegister.MAX_AGE
+        self.register.read(5, self.hardware.reader(5))
+        self.assertEqual(1, self.hardware.reads)
+        self.time.now += 1
+        self.register.read(5, self.hardware.reader(5))
+        self.assertEqual(2, self.hardware.reads)
+
+    def test_edge_updates_are_valid_until_forgotten(self):
+        self.register.update(5, 1)
+        for _ in range(3):
+            utils.clock.tick()
+            self.time.now += 1000
+            self.assertEqual(1, self.register.read(5, self.hardware.reader(5)))
+        self.assertEqual(0, self.hardware.reads)
+        self.register.forget(5)
+        self.assertEqual(0, self.register.read(5, self.hardware.reader(5)))
+        self.assertEqual(1, self.hardware.reads)
+
+    def test_writes_are_coalesced_until_the_end_of_tick(self):
+        self.register.write(7, 1)
+        self.register.write(7, 0)
+        self.register.write(7, 1)
+        self.register.write(8, 1)
+        self.assertEqual([], self.hardware.writes)
+        self.assertEqual(1, len(self.application.flush_requests))
+        self.assertEqual(1, self.register.read_output(7, self.hardware.reader(7)))
+        self.application.end_tick()
+        self.assertEqual([(7, 1), (8, 1)], self.hardware.writes)
+        self.assertEqual(2, self.register.get_stats()['writes'])
+        self.assertEqual(2, self.register.get_stats()['skipped_writes'])
+
+    def test_redundant_write_is_skipped(self):
+        self.register.write(7, 1)
+        self.application.end_tick()
+        self.register.write(7, 1)
+        self.application.end_tick()
+        self.assertEqual([(7, 1)], self.hardware.writes)
+        self.assertEqual(1, self.register.read_output(7, self.hardware.reader(7)))
+        self.assertEqual(0, self.hardware.reads)
+
+    def test_unknown_output_is_read_from_hardware(self):
+        self.hardware.levels[7] = 1
+        self.assertEqual(1, self.register.read_output(7, self.hardware.reader(7)))
+        self.assertEqual(1, self.hardware.reads)
+
+    def test_writes_without_application_are_applied_immediately(self):
+        register = GPIODriver.ShadowRegister(self.hardware.write)
+        register.write(7, 1)
+        self.assertEqual([(7, 1)], self.hardware.writes)
+        register.write(7, 1)
+        self.assertEqual([(7, 1)], self.hardware.writes)
+        self.assertEqual(dict(hits=0, misses=0, writes=1, skipped_writes=1), register.get_stats())
+
+
+class Relay(Module):
+    def __init__(self, application, register: GPIODriver.ShadowRegister):
+        super().__init__(application, {})
+        self.register = register
+
+    @staticmethod
+    def type_name() -> str:
+        return 'Relay'
+
+    def on_before_destroyed(self):
+        self.register.write(3, 0)
+
+
+class ShutdownFlushTest(unittest.TestCase):
+    def test_writes_made_while_devices_are_destroyed_reach_hardware(self):
+        application = ApplicationManager()
+        hardware = Hardware()
+        register = GPIODriver.ShadowRegister(hardware.write, application)
+        relay = Relay(application, register)
+        relay.id, relay.name = 1, 'relay'
+        application.register_device(relay)
+        register.write(3, 1)
+        application.shutdown()
+        self.assertEqual([(3, 1), (3, 0)], hardware.writes)
+
+
+class FakePyA20(object):
+    INPUT, OUTPUT = 0, 1
+    PULLUP, PULLDOWN = 1, 2
+
+    def __init__(self):
+        self.levels = {}
+        self.reads = 0
+        self.writes = []
+
+    def setcfg(self, pin, mode):
+        pass
+
+    def pullup(self, pin, mode):
+        pass
+
+    def input(self, pin):
+        self.reads += 1
+        return self.levels.get(pin, 0)
+
+    def output(self, pin, level):
+        self.writes.append((pin, level))
+        self.levels[pin] = level
+
+
+class OpiChannelTest(unittest.TestCase):
+    def setUp(self):
+        self.gpio = FakePyA20()
+        self.driver = OpiH3GPIODriver()
+        self.driver._OpiH3GPIODriver__gpio = self.gpio  # pyA20 is loaded on initialization otherwise
+        self.application = StubApplication()
+        self.driver.shadow = GPIODriver.ShadowRegister(self.driver._OpiH3GPIODriver__write_pin, self.application)
+
+    def channel(self, pin: int, mode: int) -> OpiH3GPIODriver.OpiH3Channel:
+        return OpiH3GPIODriver.OpiH3Channel(self.driver, self.gpio, pin, mode)
+
+    def test_writes_are_inverted_and_flushed_once_per_tick(self):
+        relay = self.channel(3, GPIODriver.GPIO_MODE_WRITE)
+        relay.write(True)
+        relay.write(False)
+        relay.write(True)
+        self.assertEqual([], self.gpio.writes)
+        self.application.end_tick()
+        self.assertEqual([(3, 0)], self.gpio.writes)
+        self.assertEqual(0, relay.read())
+        self.assertEqual(1, relay.read(reverse=True))
+        self.assertEqual(0, self.gpio.reads)
+
+    def test_input_is_read_once_per_tick(self):
+        button = self.channel(5, GPIODriver.GPIO_MODE_READ)
+        self.gpio.levels[5] = 1
+        self.assertEqual(1, button.read())
+        self.assertEqual(0, button.read(reverse=True))
+        self.assertEqual(1, self.gpio.reads)
+
+    def test_line_group_write_replaces_pending_channel_write(self):
+        self.driver.shadow.write(3, 1)
+        self.driver.shadow.written(3, 0)
+        self.application.end_tick()
+        self.assertEqual([], self.gpio.writes)
+        self.assertEqual(0, self.driver.shadow.read_output(3, lambda: self.fail('Level is known')))
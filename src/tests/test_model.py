@@ -0,0 +1,135 @@
+import json
+import threading
+import unittest
+
+from common.model import ModelState, StateSnapshot, JsonSerializer
+
+
+class CountingSerializer(JsonSerializer):
+    def __init__(self):
+        self.calls = 0
+
+    def serialize(self, obj: object):
+        self.calls += 1
+        return super().serialize(obj)
+
+
+class StateSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.serializer = CountingSerializer()
+        self.state = ModelState(['temperature', 'label'], self.serializer)
+        self.state.temperature = 20.5
+        self.state.label = 'kitchen'
+
+    def test_snapshot_is_immutable(self):
+        snapshot = self.state.snapshot()
+        with self.assertRaises(AttributeError):
+            snapshot.temperature = 10
+        with self.assertRaises(AttributeError):
+            snapshot.version = 0
+        with self.assertRaises(AttributeError):
+            del snapshot.values
+        with self.assertRaises(AttributeError):
+            snapshot.unknown = 1
+        self.assertEqual(20.5, snapshot.temperature)
+
+    def test_snapshot_is_not_affected_by_later_writes(self):
+        snapshot = self.state.snapshot()
+        self.state.temperature = 25
+        self.assertEqual(20.5, snapshot.temperature)
+        self.assertEqual({'temperature': 20.5, 'label': 'kitchen'}, snapshot.as_dict())
+        self.assertEqual(2, snapshot.version)
+        self.assertEqual(3, self.state.snapshot().version)
+
+    def test_unknown_field(self):
+        with self.assertRaises(AttributeError):
+            getattr(self.state.snapshot(), 'humidity')
+
+    def test_representations_are_cached(self):
+        snapshot = self.state.snapshot()
+        self.assertIs(snapshot.as_dict(), snapshot.as_dict())
+        serialized = snapshot.serialize_state()
+        self.assertIs(serialized, snapshot.serialize_state())
+        self.assertEqual(1, self.serializer.calls)
+        self.assertEqual({'temperature': 20.5, 'label': 'kitchen'}, json.loads(serialized))
+
+    def test_encoded_fields_are_cached_per_encoder(self):
+        snapshot = self.state.snapshot()
+        calls = []
+
+        def encoder(value):
+            calls.append(value)
+            return str(value)
+
+        encoded = snapshot.encode_fields(encoder)
+        self.assertEqual([('temperature', '20.5'), ('label', 'kitchen')], encoded)
+        self.assertIs(encoded, snapshot.encode_fields(encoder))
+        self.assertEqual(2, len(calls))
+        self.assertEqual([('temperature', b'20.5'), ('label', b'kitchen')],
+                         snapshot.encode_fields(lambda value: str(value).encode()))
+
+    def test_snapshot_is_shared_between_threads(self):
+        snapshot = self.state.snapshot()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(snapshot.serialize_state())) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(4, len(results))
+        self.assertEqual(1, len(set(results)))
+
+    def test_direct_construction(self):
+        snapshot = StateSnapshot(('a',), (1,), 7)
+        self.assertEqual('{"a": 1}', snapshot.serialize_state())
+        self.assertEqual('StateSnapshot(version=7, {\'a\': 1})', repr(snapshot))
+
+
+class ModelStateTest(unittest.TestCase):
+    def test_classes_are_shared_by_fields(self):
+        state = ModelState(['on', 'brightness'])
+        self.assertIs(type(state), type(ModelState(['on', 'brightness'])))
+        self.assertIsNot(type(state), type(ModelState(['on'])))
+        self.assertEqual(('$default',), ModelState().fields)
+        with self.assertRaises(AttributeError):
+            state.color = 'red'  # Fields are slots, so typo doesn't silently create an attribute
+
+    def test_changed_fields_are_dirty(self):
+        state = ModelState(['on', 'brightness', 'color'])
+        self.assertFalse(state.is_dirty)
+        state.on = True
+        state.color = 'red'
+        self.assertTrue(state.is_dirty)
+        self.assertEqual(['on', 'color'], state.dirty_fields())
+        self.assertEqual(2, state.version)
+        state.clear_dirty()
+        self.assertFalse(state.is_dirty)
+        self.assertEqual(2, state.version)
+
+    def test_writing_the_same_value_is_not_a_change(self):
+        state = ModelState(['on'])
+        state.on = True
+        state.clear_dirty()
+        state.on = True
+        self.assertFalse(state.is_dirty)
+        self.assertEqual(1, state.version)
+
+    def test_snapshot_clears_dirty_fields_on_request(self):
+        state = ModelState(['on'])
+        state.on = True
+        state.snapshot()
+        self.assertTrue(state.is_dirty)
+        self.assertEqual((True,), state.snapshot(clear_dirty=True).values)
+        self.assertFalse(state.is_dirty)
+
+    def test_field_names_which_are_not_identifiers(self):
+        state = ModelState(['$default', 'max-level'])
+        setattr(state, 'max-level', 5)
+        self.assertEqual({'$default': None, 'max-level': 5}, state.as_dict())
+        self.assertEqual(['max-level'], state.dirty_fields())
+
+    def test_read_state(self):
+        state = ModelState(['on', 'brightness'])
+        state.read_state(state.serializer.serialize({'brightness': 40, 'unknown': 1}))
+        self.assertEqual({'on': None, 'brightness': 40}, state.as_dict())
+        self.assertEqual(json.loads(state.serialize_state()), state.as_dict())
@@ -0,0 +1,83 @@
+import threading
+import time
+import unittest
+
+from common.core import ApplicationManager
+from common.model import Module, EventDef, ActionDef, PipedEvent, PRIORITY_INTERACTIVE, PRIORITY_NORMAL, \
+    PRIORITY_BULK
+
+EVENT_PRESSED = 0x01
+
+
+class Sender(Module):
+    IN_LOOP = False
+    EVENTS = [EventDef(EVENT_PRESSED, 'pressed', priority=PRIORITY_INTERACTIVE)]
+
+    @staticmethod
+    def type_name() -> str:
+        return 'Sender'
+
+
+class Target(Module):
+    IN_LOOP = False
+
+    def __init__(self, application):
+        super().__init__(application, {})
+        self.fast_done = threading.Event()
+        self.slow_done = threading.Event()
+        self.fast_done_at = None
+
+    @staticmethod
+    def type_name() -> str:
+        return 'Target'
+
+    def fast(self, data=None, **kwargs):
+        self.fast_done_at = time.monotonic()
+        self.fast_done.set()
+
+    def slow(self, data=None, **kwargs):
+        time.sleep(0.3)
+        self.slow_done.set()
+
+    ACTIONS = [
+        ActionDef(0x01, 'fast', fast),
+        ActionDef(0x02, 'slow', slow, priority=PRIORITY_BULK),
+    ]
+
+
+class PipePriorityTest(unittest.TestCase):
+    def test_action_without_priority_follows_event(self):
+        pipe = PipedEvent(event=Sender.EVENTS[0], action=Target.ACTIONS[0])
+        self.assertEqual(PRIORITY_INTERACTIVE, pipe.priority)
+
+    def test_bulk_action_keeps_its_lane(self):
+        pipe = PipedEvent(event=Sender.EVENTS[0], action=Target.ACTIONS[1])
+        self.assertEqual(PRIORITY_BULK, pipe.priority)
+
+    def test_pipe_override_wins(self):
+        pipe = PipedEvent(event=Sender.EVENTS[0], action=Target.ACTIONS[1], priority=PRIORITY_NORMAL)
+        self.assertEqual(PRIORITY_NORMAL, pipe.priority)
+
+    def test_normal_priority_by_default(self):
+        pipe = PipedEvent(event=EventDef(0x02, 'other'), action=ActionDef(0x03, 'other', None))
+        self.assertEqual(PRIORITY_NORMAL, pipe.priority)
+
+    def test_slow_bulk_action_doesnt_delay_interactive_pipe(self):
+        application = ApplicationManager()
+        sender, target = Sender(application, {}), Target(application)
+        sender.id, sender.name, target.id, target.name = 1, 'button', 2, 'logger'
+        application.register_device(sender)
+        application.register_device(target)
+        # Slow pipe is registered first, so it would be dispatched first within the same lane
+        for action in reversed(Target.ACTIONS):
+            application.register_pipe(PipedEvent(declared_in=sender, target=target, event=Sender.EVENTS[0],
+                                                 action=action))
+        application.start_dispatching()
+        try:
+            emitted_at = time.monotonic()
+            sender.emit(EVENT_PRESSED)
+            self.assertTrue(target.fast_done.wait(2))
+            self.assertLess(target.fast_done_at - emitted_at, 0.2)
+            self.assertTrue(target.slow_done.wait(2))
+        finally:
+            application.shutdown()
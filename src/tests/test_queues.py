@@ -0,0 +1,98 @@
+import threading
+import unittest
+from queue import Empty
+
+from common.queues import PriorityLaneQueue, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_COALESCE, \
+    OVERFLOW_BLOCK
+
+
+class PriorityLaneQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.dropped = []
+
+    def new_queue(self, capacity: int = 0, policy: str = OVERFLOW_DROP_NEWEST, block_timeout: int = 0):
+        return PriorityLaneQueue(3, capacity, policy, block_timeout,
+                                 on_drop=lambda item, policy: self.dropped.append((item, policy)))
+
+    def test_most_urgent_lane_first(self):
+        queue = self.new_queue()
+        queue.put('bulk', 2)
+        queue.put('normal', 1)
+        queue.put('interactive', 0)
+        queue.put('interactive-2', 0)
+        self.assertEqual(['interactive', 'interactive-2', 'normal', 'bulk'], [queue.get(0) for _ in range(4)])
+
+    def test_drop_newest_rejects_item_over_capacity(self):
+        queue = self.new_queue(2, OVERFLOW_DROP_NEWEST)
+        self.assertTrue(queue.put('a'))
+        self.assertTrue(queue.put('b'))
+        self.assertFalse(queue.put('c'))
+        self.assertEqual([('c', OVERFLOW_DROP_NEWEST)], self.dropped)
+        self.assertEqual(['a', 'b'], queue.get_all())
+
+    def test_drop_oldest_evicts_least_urgent_lane(self):
+        queue = self.new_queue(2, OVERFLOW_DROP_OLDEST)
+        queue.put('urgent', 0)
+        queue.put('bulk', 2)
+        self.assertTrue(queue.put('normal', 1))
+        self.assertEqual([('bulk', OVERFLOW_DROP_OLDEST)], self.dropped)
+        self.assertEqual(['urgent', 'normal'], queue.get_all())
+
+    def test_drop_oldest_never_evicts_more_urgent_item(self):
+        queue = self.new_queue(1, OVERFLOW_DROP_OLDEST)
+        queue.put('urgent', 0)
+        self.assertFalse(queue.put('bulk', 2))
+        self.assertEqual([('bulk', OVERFLOW_DROP_OLDEST)], self.dropped)
+        self.assertEqual(['urgent'], queue.get_all())
+
+    def test_coalesce_replaces_item_with_the_same_key(self):
+        queue = self.new_queue(10, OVERFLOW_COALESCE)
+        queue.put('first', key='k')
+        queue.put('other', key='x')
+        queue.put('second', key='k')
+        self.assertEqual([('first', OVERFLOW_COALESCE)], self.dropped)
+        self.assertEqual(['second', 'other'], queue.get_all())
+        # Key is forgotten once item is taken
+        queue.put('third', key='k')
+        self.assertEqual(['third'], queue.get_all())
+
+    def test_block_waits_for_free_space(self):
+        queue = self.new_queue(1, OVERFLOW_BLOCK, block_timeout=2000)
+        queue.put('a')
+        consumer = threading.Timer(0.05, queue.get)
+        consumer.start()
+        self.assertTrue(queue.put('b'))
+        consumer.join()
+        self.assertEqual(['b'], queue.get_all())
+        self.assertEqual([], self.dropped)
+
+    def test_block_rejects_item_after_timeout(self):
+        queue = self.new_queue(1, OVERFLOW_BLOCK, block_timeout=10)
+        queue.put('a')
+        self.assertFalse(queue.put('b'))
+        self.assertEqual([('b', OVERFLOW_BLOCK)], self.dropped)
+
+    def test_get_raises_empty_on_timeout(self):
+        with self.assertRaises(Empty):
+            self.new_queue().get(0.01)
+
+    def test_every_wakeup_releases_one_consumer(self):
+        queue = self.new_queue()
+        results = []
+        consumers = [threading.Thread(target=lambda: results.append(queue.get(5))) for _ in range(3)]
+        for consumer in consumers:
+            consumer.start()
+        for _ in consumers:
+            queue.wakeup()
+        for consumer in consumers:
+            consumer.join(1)
+        self.assertEqual([None, None, None], results)
+
+    def test_wakeup_does_not_count_against_capacity(self):
+        queue = self.new_queue(1)
+        queue.put('a')
+        queue.wakeup()
+        self.assertEqual('a', queue.get(0))
+        self.assertIsNone(queue.get(0))
+        with self.assertRaises(Empty):
+            queue.get(0)
@@ -0,0 +1,162 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from common import utils
+from common.scheduler import Scheduler, TimerWheel
+
+
+class FakeTime(object):
+    def __init__(self, now: int = 1000):
+        self.now = now
+
+    def __call__(self) -> int:
+        return self.now
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.time = FakeTime()
+        patcher = mock.patch('common.utils.capture_time', self.time)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scheduler = Scheduler()
+
+    def test_due_items_are_ordered_by_deadline(self):
+        self.scheduler.schedule('c', 1030)
+        self.scheduler.schedule('a', 1010)
+        self.scheduler.schedule('b', 1020)
+        self.scheduler.schedule('later', 2000)
+        self.time.now = 1030
+        self.assertEqual([('a', 1010), ('b', 1020), ('c', 1030)], self.scheduler.wait_due())
+        self.assertFalse(self.scheduler.is_scheduled('a'))
+        self.assertTrue(self.scheduler.is_scheduled('later'))
+
+    def test_items_with_the_same_deadline_keep_scheduling_order(self):
+        for item in ('x', 'y', 'z'):
+            self.scheduler.schedule(item, 1000)
+        self.assertEqual(['x', 'y', 'z'], [item for item, _ in self.scheduler.wait_due()])
+
+    def test_reschedule_discards_previous_deadline(self):
+        self.scheduler.schedule('a', 1000)
+        self.scheduler.schedule('a', 1050)
+        self.scheduler.wakeup()
+        self.assertEqual([], self.scheduler.wait_due())
+        self.time.now = 1050
+        self.assertEqual([('a', 1050)], self.scheduler.wait_due())
+
+    def test_keep_earlier(self):
+        self.scheduler.schedule('a', 1000)
+        self.scheduler.schedule('a', 1050, keep_earlier=True)
+        self.assertEqual([('a', 1000)], self.scheduler.wait_due())
+        self.scheduler.schedule('b', 1100)
+        self.scheduler.schedule('b', 1000, keep_earlier=True)
+        self.assertEqual([('b', 1000)], self.scheduler.wait_due())
+
+    def test_cancelled_item_is_not_returned(self):
+        self.scheduler.schedule('a', 1000)
+        self.scheduler.schedule('b', 1000)
+        self.scheduler.cancel('a')
+        self.assertFalse(self.scheduler.is_scheduled('a'))
+        self.assertEqual([('b', 1000)], self.scheduler.wait_due())
+
+    def test_wakeup_and_stop_return_nothing(self):
+        self.scheduler.schedule('a', 5000)
+        self.scheduler.wakeup()
+        self.assertEqual([], self.scheduler.wait_due())
+        self.scheduler.stop()
+        self.assertEqual([], self.scheduler.wait_due())
+        self.assertTrue(self.scheduler.is_scheduled('a'))
+
+
+class SchedulerWaitTest(unittest.TestCase):
+    def test_earlier_deadline_wakes_consumer(self):
+        scheduler = Scheduler()
+        scheduler.schedule('late', utils.capture_time() + 10000)
+        result = []
+        consumer = threading.Thread(target=lambda: result.extend(scheduler.wait_due()), daemon=True)
+        consumer.start()
+        time.sleep(0.05)
+        started_at = time.monotonic()
+        scheduler.schedule('early', utils.capture_time() + 20)
+        consumer.join(2)
+        self.assertEqual(['early'], [item for item, _ in result])
+        self.assertLess(time.monotonic() - started_at, 1)
+
+
+class TimerWheelTest(unittest.TestCase):
+    """
+    Wheel is advanced by hand against the fake clock, so tests don't depend on scheduling of the wheel thread
+    """
+
+    def setUp(self):
+        self.time = FakeTime()
+        patcher = mock.patch('common.utils.capture_time', self.time)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.expired = []
+        self.wheel = TimerWheel(self.expired.append, tick_interval=10, slots_count=8)
+
+    def advance_to(self, now: int) -> list:
+        self.time.now = now
+        tick = (now - 1000) // self.wheel.tick_interval
+        return [timer.payload for timer in self.wheel._TimerWheel__advance(tick)]
+
+    def test_timer_never_fires_early(self):
+        self.wheel.add('a', 25)
+        self.assertEqual([], self.advance_to(1020))
+        self.assertEqual(['a'], self.advance_to(1030))
+        self.assertEqual([], self.advance_to(1040))
+
+    def test_zero_delay_fires_on_the_next_tick(self):
+        self.wheel.add('a', 0)
+        self.assertEqual([], self.advance_to(1000))
+        self.assertEqual(['a'], self.advance_to(1010))
+
+    def test_timer_longer_than_revolution_waits_for_its_revolution(self):
+        # 8 slots of 10ms make 80ms revolution, both timers share the slot
+        self.wheel.add('short', 30)
+        self.wheel.add('long', 190)
+        self.assertEqual(['short'], self.advance_to(1030))
+        self.assertEqual([], self.advance_to(1110))
+        self.assertEqual([], self.advance_to(1180))
+        self.assertEqual(['long'], self.advance_to(1190))
+
+    def test_timers_expired_while_sleeping_over_revolutions(self):
+        self.wheel.add('a', 10)
+        self.wheel.add('b', 50)
+        self.wheel.add('c', 170)
+        self.wheel.add('d', 400)
+        self.assertEqual(['a', 'b', 'c'], sorted(self.advance_to(1300)))
+        self.assertEqual(['d'], self.advance_to(1400))
+
+    def test_cancelled_timer_does_not_fire(self):
+        timer = self.wheel.add('a', 20)
+        self.wheel.add('b', 20)
+        self.wheel.cancel(timer)
+        self.wheel.cancel(timer)  # Repeated cancellation is harmless
+        self.assertEqual(['b'], self.advance_to(1020))
+
+    def test_sleep_interval_follows_the_nearest_occupied_slot(self):
+        self.assertIsNone(self.wheel._TimerWheel__time_to_next_timer())
+        self.wheel.add('a', 50)
+        self.time.now = 1020
+        self.assertAlmostEqual(0.03, self.wheel._TimerWheel__time_to_next_timer())
+
+
+class TimerWheelThreadTest(unittest.TestCase):
+    def test_run_delivers_expired_timers(self):
+        fired = threading.Event()
+        wheel = TimerWheel(lambda payload: fired.set(), tick_interval=5)
+        thread = threading.Thread(target=wheel.run, daemon=True)
+        thread.start()
+        try:
+            started_at = time.monotonic()
+            wheel.add('a', 30)
+            self.assertTrue(fired.wait(2))
+            self.assertGreaterEqual(time.monotonic() - started_at, 0.02)
+        finally:
+            wheel.stop()
+            thread.join(2)
+        self.assertFalse(thread.is_alive())
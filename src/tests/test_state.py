@@ -0,0 +1,160 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from common.core import ApplicationManager
+from common.errors import ConfigError
+from common.model import StateAwareModule, StateSnapshot, EVENT_STATE_CHANGED
+
+
+class StubApplication(object):
+    def __init__(self):
+        self.flush_requests = []
+
+    def request_state_flush(self, device):
+        self.flush_requests.append(device)
+
+
+class Thermometer(StateAwareModule):
+    STATE_FIELDS = ['temperature', 'label']
+    IN_LOOP = False
+
+    def __init__(self, application):
+        super().__init__(application, {})
+        self.emitted = []
+
+    @staticmethod
+    def type_name() -> str:
+        return 'Thermometer'
+
+    def emit(self, event_id, data=None) -> bool:
+        if event_id == EVENT_STATE_CHANGED:
+            self.emitted.append(data)
+        return True
+
+
+class CommittingThermometer(Thermometer):
+    IN_LOOP = True
+    MINIMAL_ITERATION_INTERVAL = 60000
+
+    def step(self):
+        for value in (20.0, 20.5, 21.0):
+            self.state.temperature = value
+            self.commit_state()
+
+
+class DeadbandTest(unittest.TestCase):
+    def setUp(self):
+        self.device = Thermometer(StubApplication())
+
+    def update(self, **values) -> bool:
+        for field, value in values.items():
+            setattr(self.device.state, field, value)
+        return self.device.flush_state()
+
+    def test_first_state_is_always_emitted(self):
+        self.assertTrue(self.device.flush_state())
+        self.assertEqual(1, len(self.device.emitted))
+
+    def test_unchanged_state_is_not_emitted(self):
+        self.update(temperature=20.0)
+        self.assertFalse(self.device.flush_state())
+        self.assertFalse(self.update(temperature=20.0))
+
+    def test_absolute_deadband(self):
+        self.device.deadband = {'temperature': 0.5}
+        self.update(temperature=20.0)
+        self.assertFalse(self.update(temperature=20.4))
+        # Change is measured against the last emitted value, not the previous one
+        self.assertTrue(self.update(temperature=20.5))
+        self.assertEqual([20.0, 20.5], [x.temperature for x in self.device.emitted])
+
+    def test_relative_deadband(self):
+        self.device.deadband = {'temperature': '10%'}
+        self.update(temperature=20.0)
+        self.assertFalse(self.update(temperature=21.9))
+        self.assertTrue(self.update(temperature=17.9))
+
+    def test_field_without_deadband_is_emitted_on_any_change(self):
+        self.device.deadband = {'temperature': 5}
+        self.update(temperature=20.0, label='a')
+        self.assertTrue(self.update(label='b'))
+
+    def test_force(self):
+        self.update(temperature=20.0)
+        self.assertTrue(self.device.flush_state(force=True))
+
+    def test_invalid_deadband(self):
+        with self.assertRaises(ConfigError):
+            self.device.deadband = {'pressure': 1}
+        with self.assertRaises(ConfigError):
+            self.device.deadband = {'temperature': 'a lot'}
+
+    def test_commit_requests_flush(self):
+        application = StubApplication()
+        device = Thermometer(application)
+        device.commit_state()
+        self.assertEqual([device], application.flush_requests)
+
+
+class HeartbeatTest(unittest.TestCase):
+    def test_state_is_emitted_after_max_silence(self):
+        application = StubApplication()
+        device = Thermometer(application)
+        device.max_silence = 20
+        device.flush_state()
+        device.heartbeat()
+        self.assertEqual([], application.flush_requests)
+        self.assertFalse(device.flush_state())
+        time.sleep(0.03)
+        device.heartbeat()
+        self.assertEqual([device], application.flush_requests)
+        self.assertTrue(device.flush_state())
+        self.assertEqual(2, len(device.emitted))
+
+
+class ConcurrentWriteTest(unittest.TestCase):
+    def test_write_racing_with_flush_is_emitted_later(self):
+        device = Thermometer(StubApplication())
+        device.state.temperature = 1
+        writers = []
+
+        class RacingSnapshot(StateSnapshot):
+            """
+            Writes the state from another thread while flush is taking the snapshot
+            """
+
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                writer = threading.Thread(target=setattr, args=(device.state, 'temperature', 2))
+                writer.start()
+                writer.join(0.05)  # Writer is expected to wait for the flush to finish
+                writers.append(writer)
+
+        with mock.patch('common.model.StateSnapshot', RacingSnapshot):
+            self.assertTrue(device.flush_state())
+        writers[0].join()
+        self.assertEqual(1, device.emitted[-1].temperature)
+        self.assertTrue(device.state.is_dirty)
+        self.assertTrue(device.flush_state())
+        self.assertEqual(2, device.emitted[-1].temperature)
+
+
+class CoalescedFlushTest(unittest.TestCase):
+    def test_commits_within_tick_produce_single_event(self):
+        application = ApplicationManager()
+        device = CommittingThermometer(application)
+        device.id, device.name = 1, 'thermometer'
+        application.register_device(device)
+        thread = threading.Thread(target=application.main_loop, daemon=True)
+        thread.start()
+        try:
+            deadline = time.monotonic() + 2
+            while not device.emitted and time.monotonic() < deadline:
+                time.sleep(0.01)
+            time.sleep(0.05)
+        finally:
+            application.shutdown()
+            thread.join(2)
+        self.assertEqual([21.0], [x.temperature for x in device.emitted])
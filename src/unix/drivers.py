@@ -1,21 +1,58 @@
+import functools
 import json
 import logging
-import paho.mqtt.client as mqtt
 import random
+import time
 from typing import List
 
 from common.core import ApplicationManager
 from common.drivers import GPIODriver, DataChannelDriver, OneWireDriver
 from common.errors import ConfigError
+from common.model import StateSnapshot
 
 
 class FakeGPIODriver(GPIODriver):
+    """
+    Keeps levels of the lines in memory. Lines are accessed through the shadow register the same way hardware drivers
+    do, so its counters are meaningful without hardware
+    """
+
+    class FakeChannel(GPIODriver.Channel):
+        def __init__(self, driver, pin: [str, int], direction: int):
+            """
+            :type driver: FakeGPIODriver
+            """
+            self.__driver = driver
+            self.pin = pin
+            self.__direction = direction
+            self.__read_pin = functools.partial(driver.levels.get, pin, 0)
+
+        def write(self, state: [int, bool]):
+            self.__driver.shadow.write(self.pin, 1 if state else 0)
+
+        def mode(self):
+            return self.__direction
+
+        def read(self, reverse=False) -> int:
+            if self.__direction == GPIODriver.GPIO_MODE_READ:
+                value = self.__driver.shadow.read(self.pin, self.__read_pin)
+            else:
+                value = self.__driver.shadow.read_output(self.pin, self.__read_pin)
+            return value ^ 1 if reverse else value
+
     def __init__(self):
         super().__init__()
         self.__logger = logging.getLogger('FakeGPIODriver')
+        self.levels = {}  # Pin -> level
+        self.shadow = GPIODriver.ShadowRegister(self.levels.__setitem__)
+
+    def on_initialized(self, application):
+        super().on_initialized(application)
+        if application is not None:
+            self.shadow = GPIODriver.ShadowRegister(self.levels.__setitem__, application, driver='fake')
 
     def new_channel(self, pin: [str, int], direction: int, pullup=True) -> GPIODriver.Channel:
-        return GPIODriver.Channel()
+        return FakeGPIODriver.FakeChannel(self, pin, direction)
 
 
 class FakeWireDriver(OneWireDriver):
@@ -29,6 +66,10 @@ class FakeWireDriver(OneWireDriver):
 
 
 class MQTTDriver(DataChannelDriver):
+    HOUSEKEEPING_INTERVAL = 1000
+    LOOP_TIMEOUT = 1.0  # Seconds step() waits for incoming packets
+    RETRY_INTERVAL = 0.2  # Seconds step() pauses if client isn't connected, loop returns immediately in this case
+
     class MQTTChannel(DataChannelDriver.Channel):
 
         class Callback:
@@ -64,6 +105,7 @@ class MQTTDriver(DataChannelDriver):
                 def cb(client, userdata, rc):
                     channel.logger.info("Disconnected from MQTT server: Code: " + str(rc))
                     channel._connected = False
+                    channel._unwatch_socket()
 
                 return cb
 
@@ -94,6 +136,8 @@ class MQTTDriver(DataChannelDriver):
             self._connected = False
             self._was_connected = False
             self._thread = None
+            self._application = None  # Set if socket is served by application event loop instead of step()
+            self._watched_socket = None
             try:
                 self.bind_address = connection_options.get('bind_address', '0.0.0.0')
                 self.server_address = connection_options.get('server_address', '127.0.0.1')
@@ -102,27 +146,35 @@ class MQTTDriver(DataChannelDriver):
             except KeyError as e:
                 raise ConfigError("Unable to build MQTT communication channel because of configuration error: "
                                   + str(e))
+            import paho.mqtt.client as mqtt  # Imported lazily so fake drivers are usable without paho installed
             self._mqtt_client = mqtt.Client()
             self._mqtt_client.on_connect = self.Callback.create_on_connect_callback(self)
             self._mqtt_client.on_disconnect = self.Callback.create_on_disconnect_callback(self)
             self._mqtt_client.on_message = self.Callback.create_on_message_callback(self)
 
-        def __encode_value(self, value):
-            if isinstance(value, dict):
-                return json.dumps(value)
-            else:
+        @staticmethod
+        def encode_value(value):
+            """
+            Strings and numbers are sent as is, anything else including booleans and None is sent as JSON
+            """
+            if isinstance(value, str):
+                return value
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
                 return str(value)
+            else:
+                return json.dumps(value, default=str)
 
         def send(self, destination: str, data):
-            raw_data = None
-            if isinstance(data, dict):
-                raw_data = data
+            if isinstance(data, StateSnapshot):
+                payloads = data.encode_fields(self.encode_value)  # Encoded once for all the channels
+            elif isinstance(data, dict):
+                payloads = [(key, self.encode_value(value)) for key, value in data.items()]
             else:
-                raise ValueError("MQTTChannel supports only dictionary data")
-            for key, value in raw_data.items():
+                raise ValueError("MQTTChannel supports only dictionary data and state snapshots")
+            for key, payload in payloads:
                 try:
                     result, msg_id = self._mqtt_client.publish('{}{}/{}'.format(self.topic_prefix, destination, key),
-                                                               self.__encode_value(value))
+                                                               payload)
                 except Exception as e:
                     self.logger.error("Unable to send MQTT message: " + str(e))
 
@@ -134,19 +186,62 @@ class MQTTDriver(DataChannelDriver):
                 self._mqtt_client.connect_async(self.server_address, port=self.server_port,
                                                 bind_address=self.bind_address)
             self._mqtt_client.reconnect()
+            if self._application is not None:
+                self._watch_socket()
 
-        def step(self):
+        def attach(self, application):
+            """
+            Makes channel rely on application runtime to watch MQTT socket instead of polling it in step()
+            :type application: common.core.ApplicationManager
+            """
+            self._application = application
+
+        def _watch_socket(self):
+            sock = self._mqtt_client.socket()
+            if sock is None or sock is self._watched_socket:
+                return
+            self._unwatch_socket()
+            self._application.watch_fd(sock, self.__on_socket_readable)
+            self._watched_socket = sock
+
+        def _unwatch_socket(self):
+            if self._watched_socket is not None:
+                self._application.unwatch_fd(self._watched_socket)
+                self._watched_socket = None
+
+        def __on_socket_readable(self):
+            self._mqtt_client.loop_read()
+            self.housekeeping()
+
+        def housekeeping(self):
+            """
+            Non-blocking part of the MQTT loop: keepalive pings and flushing of pending outgoing packets
+            """
             try:
-                self._mqtt_client.loop()
+                self._mqtt_client.loop_misc()
+                if self._mqtt_client.want_write():
+                    self._mqtt_client.loop_write()
             except Exception as e:
                 pass
 
+        def step(self):
+            """
+            Blocks for up to LOOP_TIMEOUT waiting for incoming packets, so it should be invoked by dedicated thread
+            """
+            try:
+                result = self._mqtt_client.loop(MQTTDriver.LOOP_TIMEOUT)
+            except Exception as e:
+                result = None
+            if result != 0:
+                time.sleep(MQTTDriver.RETRY_INTERVAL)
+
         def disconnect(self):
             self._mqtt_client.disconnect()
 
     def __init__(self):
         super().__init__()
         self.__thread_manager = None  # type: common.core.ThreadManager
+        self.__application = None  # type: common.core.ApplicationManager
         self.__channel_counter = 0
 
     def on_initialized(self, application):
@@ -155,13 +250,19 @@ class MQTTDriver(DataChannelDriver):
         :return:
         """
         self.__thread_manager = application.thread_manager
+        self.__application = application
 
     def new_channel(self, connection_options: dict) -> MQTTChannel:
-        def do_step(channel):
-            channel.step()
-
         channel = MQTTDriver.MQTTChannel(self, connection_options)
         self.__channel_counter += 1
-        thread = self.__thread_manager.request_thread('MQTTDriver-ch' + str(self.__channel_counter), channel.step, [])
+        if self.__application.supports_fd_watching():
+            # Socket reads are triggered by the runtime so we only need periodic housekeeping
+            channel.attach(self.__application)
+            thread = self.__thread_manager.request_thread('MQTTDriver-ch' + str(self.__channel_counter),
+                                                          channel.housekeeping, [], self.HOUSEKEEPING_INTERVAL)
+        else:
+            # Loop blocks in select, so it can't be served by the shared executor of periodic callbacks
+            thread = self.__thread_manager.request_dedicated_thread('MQTTDriver-ch' + str(self.__channel_counter),
+                                                                    channel.step, [])
         channel.dispose = lambda: self.__thread_manager.dispose_thread(thread)
         return channel
@@ -0,0 +1,369 @@
+import bisect
+import random
+import threading
+
+from typing import List, Tuple, Dict, Callable
+
+from common import utils
+from common.drivers import GPIODriver
+from common.core import ApplicationManager, DelayedCall
+from common.errors import ConfigError
+
+RELEASED = 0
+PRESSED = 1
+
+GESTURE_CLICK = 'click'
+GESTURE_DOUBLE_CLICK = 'double_click'
+GESTURE_LONG_CLICK = 'long_click'
+
+
+class Waveform(object):
+    """
+    Input signal of the single pin defined as the sequence of transitions. Levels are logical: PRESSED means
+    that input is active regardless of whether pin is pulled up or down. Gesture helpers remember which gesture
+    is expected to be recognized, so the accuracy of recognition can be verified.
+    """
+    DEFAULT_PRESS = 80
+    DEFAULT_RELEASE = 500
+    DEFAULT_DOUBLE_CLICK_GAP = 150
+    DEFAULT_LONG_PRESS = 1500
+    DEFAULT_LONG_CLICK_THRESHOLD = 1000  # Matches default long_click_duration of the Button
+
+    def __init__(self, start: int = 0, loop: bool = False, seed=None):
+        """
+        :param start: time in milliseconds input stays released before the first transition
+        :param loop: repeat waveform once it is over
+        :param seed: seed for bounce noise generator to make waveform reproducible
+        """
+        self.loop = loop
+        self.duration = start
+        self.__offsets = [0]  # Offsets of transitions in milliseconds, ordered
+        self.__levels = [RELEASED]
+        self.expected = []  # type: List[Tuple[int, str]] # (offset when gesture is completed, gesture)
+        self.__random = random.Random(seed)
+
+    def hold(self, level: int, duration: int, bounce: int = 0) -> 'Waveform':
+        """
+        Switches input to the given level and holds it for duration
+        :param bounce: time in milliseconds during which contact bounces between levels before settling
+        """
+        start = self.duration
+        if bounce > 0 and self.__levels[-1] != level:
+            flips = self.__random.randint(1, 3) * 2  # Even number of extra flips so input settles at the target level
+            offsets = sorted(self.__random.randint(1, bounce) for _ in range(flips))
+            self.__append(start, level)
+            for i, offset in enumerate(offsets):
+                self.__append(start + offset, self.__levels[-1] ^ 1 if i % 2 == 0 else level)
+        else:
+            self.__append(start, level)
+        self.duration = start + duration
+        return self
+
+    def __append(self, offset: int, level: int):
+        if self.__offsets[-1] == offset:
+            # Several transitions at the same moment collapse into the last one
+            self.__levels[-1] = level
+            if len(self.__levels) > 1 and self.__levels[-2] == level:
+                self.__offsets.pop()
+                self.__levels.pop()
+        elif self.__levels[-1] != level:
+            self.__offsets.append(offset)
+            self.__levels.append(level)
+
+    def idle(self, duration: int) -> 'Waveform':
+        return self.hold(RELEASED, duration)
+
+    def press(self, duration: int, bounce: int = 0) -> 'Waveform':
+        return self.hold(PRESSED, duration, bounce)
+
+    def release(self, duration: int, bounce: int = 0) -> 'Waveform':
+        return self.hold(RELEASED, duration, bounce)
+
+    def click(self, press: int = DEFAULT_PRESS, release: int = DEFAULT_RELEASE, bounce: int = 0) -> 'Waveform':
+        self.press(press, bounce)
+        self.expected.append((self.duration, GESTURE_CLICK))
+        return self.release(release, bounce)
+
+    def double_click(self, press: int = DEFAULT_PRESS, gap: int = DEFAULT_DOUBLE_CLICK_GAP,
+                     release: int = DEFAULT_RELEASE, bounce: int = 0) -> 'Waveform':
+        self.press(press, bounce).release(gap, bounce).press(press, bounce)
+        self.expected.append((self.duration, GESTURE_DOUBLE_CLICK))
+        return self.release(release, bounce)
+
+    def long_click(self, press: int = DEFAULT_LONG_PRESS, release: int = DEFAULT_RELEASE, bounce: int = 0,
+                   threshold: int = DEFAULT_LONG_CLICK_THRESHOLD) -> 'Waveform':
+        """
+        :param threshold: hold time after which long click is expected to be recognized
+        """
+        self.expected.append((self.duration + threshold, GESTURE_LONG_CLICK))
+        self.press(press, bounce)
+        return self.release(release, bounce)
+
+    def level_at(self, offset: int) -> int:
+        """
+        :param offset: time in milliseconds since waveform start
+        """
+        if self.loop and self.duration > 0:
+            offset %= self.duration
+        return self.__levels[bisect.bisect_right(self.__offsets, offset) - 1]
+
+    def next_transition(self, offset: int) -> [Tuple[int, int], None]:
+        """
+        :param offset: time in milliseconds since waveform start
+        :return: (offset, level) of the first transition after the given offset or None if level won't change anymore
+        """
+        if not self.loop or self.duration <= 0:
+            index = bisect.bisect_right(self.__offsets, offset)
+            return (self.__offsets[index], self.__levels[index]) if index < len(self.__offsets) else None
+        cycle, offset = divmod(offset, self.duration)
+        index = bisect.bisect_right(self.__offsets, offset)
+        if index < len(self.__offsets):
+            return cycle * self.duration + self.__offsets[index], self.__levels[index]
+        # Waveform restarts from its first level, so there might be no transition at the beginning of the next cycle
+        current = self.__levels[-1]
+        for transition_offset, level in zip(self.__offsets, self.__levels):
+            if level != current:
+                return (cycle + 1) * self.duration + transition_offset, level
+        return None
+
+    @property
+    def transitions(self) -> List[Tuple[int, int]]:
+        return list(zip(self.__offsets, self.__levels))
+
+    SCRIPT_STEPS = ('idle', 'press', 'release', GESTURE_CLICK, GESTURE_DOUBLE_CLICK, GESTURE_LONG_CLICK)
+
+    @classmethod
+    def from_config(cls, config: dict, seed=None) -> 'Waveform':
+        """
+        :param config: dictionary with keys start, loop and script. Script is the list of steps: gesture name with
+                       default timings ('click'), gesture with parameters ({click: {press: 60, bounce: 5}}) or raw
+                       level with duration ({press: 200}, {idle: 500})
+        """
+        waveform = cls(config.get('start', 0), config.get('loop', False), seed)
+        for step in config.get('script', []):
+            if isinstance(step, str):
+                name, params = step, {}
+            elif isinstance(step, dict) and len(step) == 1:
+                name, params = list(step.items())[0]
+            else:
+                raise ConfigError('Waveform step should be gesture name or dictionary with single key')
+            if name not in cls.SCRIPT_STEPS:
+                raise ConfigError('Unknown waveform step {}. Supported: {}'.format(name, cls.SCRIPT_STEPS))
+            try:
+                if isinstance(params, dict):
+                    getattr(waveform, name)(**params)
+                else:
+                    getattr(waveform, name)(params)
+            except TypeError as e:
+                raise ConfigError('Invalid parameters of waveform step {}: {}'.format(name, params), e)
+        return waveform
+
+
+class SimulationGPIODriver(GPIODriver):
+    """
+    GPIO driver replaying scripted waveforms on input pins and recording every write to output pins with timestamp.
+    Allows to exercise input handling and measure input-to-output latency without hardware.
+    """
+
+    class SimulationChannel(GPIODriver.Channel):
+        def __init__(self, driver, pin, direction: int, pullup=True):
+            """
+            :type driver: SimulationGPIODriver
+            """
+            self.__driver = driver
+            self.pin = pin
+            self.direction = direction
+            self.pullup = bool(pullup)
+            self.waveform = None  # type: Waveform
+            self.started_at = utils.capture_time()
+            self.level = 0  # Last written level of output pin
+            self.__subscribers = []  # type: List[Callable]
+            self.__next_edge = None  # type: DelayedCall
+
+        def mode(self):
+            return self.direction
+
+        def read(self, reverse=False) -> int:
+            return self.read_at(utils.capture_time(), reverse)
+
+        def read_at(self, now: int, reverse=False) -> int:
+            """
+            :param now: time in milliseconds
+            """
+            if self.direction == GPIODriver.GPIO_MODE_WRITE:
+                return int(self.level)
+            active = self.waveform.level_at(now - self.started_at) if self.waveform else RELEASED
+            physical = self.__physical(active)
+            return physical ^ 1 if reverse else physical
+
+        def __physical(self, active: int) -> int:
+            # Active input pulls line to the opposite of the resting level
+            return active ^ 1 if self.pullup else active
+
+        def subscribe(self, callback: Callable) -> bool:
+            if self.direction != GPIODriver.GPIO_MODE_READ or not self.__driver.edges:
+                return False
+            self.__subscribers.append(callback)
+            if len(self.__subscribers) == 1:
+                self.restart_edges()
+            return True
+
+        def unsubscribe(self, callback: Callable):
+            if callback in self.__subscribers:
+                self.__subscribers.remove(callback)
+            if not self.__subscribers:
+                self.__cancel_edge()
+
+        def restart_edges(self):
+            """
+            Schedules notification about the next transition of the waveform, e.g. once waveform is replaced
+            """
+            self.__cancel_edge()
+            if self.__subscribers and self.waveform is not None:
+                self.__schedule_edge(utils.capture_time() - self.started_at)
+
+        def __schedule_edge(self, offset: int):
+            transition = self.waveform.next_transition(offset)
+            if transition is not None:
+                application = self.__driver.application
+                delay = self.started_at + transition[0] - utils.capture_time()
+                self.__next_edge = application.call_later(delay, self.__on_edge, self.waveform, *transition)
+
+        def __cancel_edge(self):
+            if self.__next_edge is not None:
+                self.__driver.application.cancel_call(self.__next_edge)
+                self.__next_edge = None
+
+        def __on_edge(self, waveform: Waveform, offset: int, active: int):
+            if waveform is not self.waveform:
+                return  # Waveform has been replaced in the meantime
+            self.__next_edge = None
+            level = self.__physical(active)
+            # Edge is reported with the exact time of the transition, as if it was timestamped by interrupt handler
+            timestamp = self.started_at + offset
+            for callback in list(self.__subscribers):
+                callback(level, timestamp)
+            if self.__subscribers and self.__next_edge is None:
+                self.__schedule_edge(offset)
+
+        def write(self, state: [int, bool]):
+            self.level = int(bool(state))
+            self.__driver.record_write(self.pin, self.level)
+
+    class SimulationLineGroup(GPIODriver.LineGroup):
+        """
+        Samples all the inputs at the same moment and records all the writes with the same timestamp, the way
+        atomic port access behaves on real hardware
+        """
+
+        def __init__(self, driver, channels: list):
+            """
+            :type driver: SimulationGPIODriver
+            """
+            super().__init__(channels)
+            self.__driver = driver
+
+        def read(self, reverse=False) -> List[int]:
+            now = utils.capture_time()
+            return [channel.read_at(now, reverse) for channel in self.channels]
+
+        def write(self, states: List[int]):
+            if len(states) != len(self.channels):
+                raise ValueError('Expected {} states, got {}'.format(len(self.channels), len(states)))
+            writes = []
+            for channel, state in zip(self.channels, states):
+                channel.level = int(bool(state))
+                writes.append((channel.pin, channel.level))
+            self.__driver.record_writes(writes)
+
+    def __init__(self):
+        super().__init__()
+        self.seed = None
+        self.edges = False
+        self.application = None  # type: ApplicationManager
+        self.__pin_configs = {}  # type: Dict[str, dict]
+        self.__channels = {}  # type: Dict[str, SimulationGPIODriver.SimulationChannel]
+        self.__writes = []  # type: List[Tuple[int, str, int]]
+        self.__lock = threading.Lock()
+
+    def configure(self, options: dict):
+        self.seed = options.get('seed')
+        # Inputs notify subscribers about transitions instead of being polled, the way interrupt capable pins do
+        self.edges = bool(options.get('edges', False))
+        pins = options.get('pins', {})
+        if not isinstance(pins, dict):
+            raise ConfigError('pins should be dictionary of pin to waveform definition')
+        for pin, config in pins.items():
+            # Validate eagerly so invalid script is reported during bootstrap
+            Waveform.from_config(config, self.seed)
+            self.__pin_configs[str(pin)] = config
+
+    def on_initialized(self, application):
+        super().on_initialized(application)
+        self.application = application
+
+    def new_channel(self, pin: [str, int], direction: int, pullup=True) -> SimulationChannel:
+        channel = SimulationGPIODriver.SimulationChannel(self, pin, direction, pullup)
+        if str(pin) in self.__pin_configs:
+            channel.waveform = Waveform.from_config(self.__pin_configs[str(pin)], self.seed)
+        self.__channels[str(pin)] = channel
+        return channel
+
+    def new_line_group(self, channels: List[SimulationChannel]) -> SimulationLineGroup:
+        for channel in channels:
+            if not isinstance(channel, SimulationGPIODriver.SimulationChannel):
+                raise ValueError('Channel {} is not created by simulation GPIO driver'.format(channel))
+        return SimulationGPIODriver.SimulationLineGroup(self, channels)
+
+    def get_channel(self, pin: [str, int]) -> SimulationChannel:
+        return self.__channels.get(str(pin))
+
+    def set_waveform(self, pin: [str, int], waveform: Waveform):
+        """
+        Replaces waveform of already opened input channel. Waveform starts from the moment of the call
+        """
+        channel = self.__channels[str(pin)]
+        channel.waveform = waveform
+        channel.started_at = utils.capture_time()
+        channel.restart_edges()
+
+    def record_write(self, pin, level: int):
+        with self.__lock:
+            self.__writes.append((utils.capture_time_ns(), str(pin), level))
+
+    def record_writes(self, writes: List[Tuple[str, int]]):
+        """
+        :param writes: list of (pin, level) made simultaneously
+        """
+        timestamp = utils.capture_time_ns()
+        with self.__lock:
+            self.__writes.extend((timestamp, str(pin), level) for pin, level in writes)
+
+    def get_writes(self, pin: [str, int] = None) -> List[Tuple[int, str, int]]:
+        """
+        :return: list of (time in nanoseconds, pin, level) for all writes or writes to the given pin only
+        """
+        with self.__lock:
+            return [w for w in self.__writes if pin is None or w[1] == str(pin)]
+
+    def expected_gestures(self, pin: [str, int]) -> List[Tuple[int, str]]:
+        """
+        :return: list of (absolute time in milliseconds, gesture) for one pass of the input waveform
+        """
+        channel = self.__channels[str(pin)]
+        if channel.waveform is None:
+            return []
+        return [(channel.started_at + offset, gesture) for offset, gesture in channel.waveform.expected]
+
+    def input_to_output_latency(self, input_pin: [str, int], output_pin: [str, int]) -> List[float]:
+        """
+        Matches every expected gesture on input pin with the first write to output pin which happened after it
+        :return: latencies in milliseconds. Gestures without reaction are skipped
+        """
+        writes = [timestamp / 1000000 for timestamp, _, _ in self.get_writes(output_pin)]
+        latencies = []
+        for gesture_time, _ in self.expected_gestures(input_pin):
+            index = bisect.bisect_left(writes, gesture_time)
+            if index < len(writes):
+                latencies.append(writes[index] - gesture_time)
+        return latencies
@@ -23,6 +23,11 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import threading
+
+from typing import Callable, List
+
+from common import utils
 from common.drivers import GPIODriver
 
 __all__ = ('DIRECTIONS', 'INPUT', 'OUTPUT',
@@ -35,8 +40,6 @@ import select
 import logging
 
 Logger = logging.getLogger('sysfs.gpio')
-Logger.addHandler(logging.StreamHandler())
-Logger.setLevel(logging.DEBUG)
 
 # Sysfs constants
 
@@ -54,6 +57,14 @@ SYSFS_GPIO_ACTIVE_LOW_PATH = SYSFS_GPIO_PATH + '/active_low'
 SYSFS_GPIO_VALUE_LOW = '0'
 SYSFS_GPIO_VALUE_HIGH = '1'
 
+# Values are written to and read from raw file descriptor, so they are kept as bytes
+SYSFS_GPIO_RAW_VALUE_LOW = SYSFS_GPIO_VALUE_LOW.encode('ascii')
+SYSFS_GPIO_RAW_VALUE_HIGH = SYSFS_GPIO_VALUE_HIGH.encode('ascii')
+SYSFS_GPIO_RAW_ZERO = SYSFS_GPIO_RAW_VALUE_LOW[0]
+
+# Reading into preallocated buffer doesn't create bytes object per read. Not available on some platforms
+_preadv = getattr(os, 'preadv', None)
+
 # Public interface
 
 INPUT = 'in'
@@ -94,9 +105,13 @@ class Pin(object):
         self._number = number
         self._direction = direction
         self._callback = callback
+        self._edge = edge
         self._active_low = active_low
 
-        self._fd = open(self._sysfs_gpio_value_path(), 'r+')
+        # Raw descriptor: value is read and written with single positioned syscall without seek and decoding
+        self._fd = os.open(self._sysfs_gpio_value_path(), os.O_RDWR)
+        self._buffer = bytearray(1)
+        self._buffers = [self._buffer]
 
         if callback and not edge:
             raise Exception('You must supply a edge to trigger callback on')
@@ -128,6 +143,24 @@ class Pin(object):
         """
         self._callback = value
 
+    @property
+    def edge(self):
+        """
+        The edge transition that triggers callback
+        """
+        return self._edge
+
+    @edge.setter
+    def edge(self, value):
+        """
+        Sets the edge transition that triggers callback
+        """
+        if value not in EDGES:
+            raise Exception("Pin edge %s not in %s" % (value, EDGES))
+        with open(self._sysfs_gpio_edge_path(), 'w') as fsedge:
+            fsedge.write(value)
+        self._edge = value
+
     @property
     def direction(self):
         """
@@ -153,15 +186,13 @@ class Pin(object):
         """
         Set pin to HIGH logic setLevel
         """
-        self._fd.write(SYSFS_GPIO_VALUE_HIGH)
-        self._fd.seek(0)
+        os.pwrite(self._fd, SYSFS_GPIO_RAW_VALUE_HIGH, 0)
 
     def reset(self):
         """
         Set pin to LOW logic setLevel
         """
-        self._fd.write(SYSFS_GPIO_VALUE_LOW)
-        self._fd.seek(0)
+        os.pwrite(self._fd, SYSFS_GPIO_RAW_VALUE_LOW, 0)
 
     def read(self):
         """
@@ -170,9 +201,10 @@ class Pin(object):
         @rtype: int
         @return: I{0} when LOW, I{1} when HIGH
         """
-        val = self._fd.read()
-        self._fd.seek(0)
-        return int(val)
+        if _preadv is not None:
+            _preadv(self._fd, self._buffers, 0)
+            return self._buffer[0] - SYSFS_GPIO_RAW_ZERO
+        return os.pread(self._fd, 1, 0)[0] - SYSFS_GPIO_RAW_ZERO
 
     def fileno(self):
         """
@@ -181,7 +213,13 @@ class Pin(object):
         @rtype: int
         @return: File descriptor
         """
-        return self._fd.fileno()
+        return self._fd
+
+    def close(self):
+        """
+        Close the file descriptor associated with this pin
+        """
+        os.close(self._fd)
 
     def changed(self, state):
         if callable(self._callback):
@@ -233,6 +271,7 @@ class Controller(object):
         if not hasattr(cls, '_instance'):
             instance = super(Controller, cls).__new__(cls)
             instance._allocated_pins = {}
+            instance._pins_by_fd = {}
             instance._poll_queue = select.epoll()
 
             instance._available_pins = []
@@ -251,16 +290,37 @@ class Controller(object):
         self.EPOLL_TIMEOUT = 1  # second
 
     def _poll_queue_loop(self):
-        pass
-        # while self._running:
-        #     try:
-        #         events = self._poll_queue.poll(EPOLL_TIMEOUT)
-        #     except IOError as error:
-        #         if error.errno != errno.EINTR:
-        #             Logger.error(repr(error))
-        #             reactor.stop()
-        #     if len(events) > 0:
-        #         reactor.callFromThread(self._poll_queue_event, events)
+        """
+        Dispatches edges of input pins until stop() is called. Blocks, so should be executed in dedicated thread
+        """
+        while self._running:
+            self.poll_events(self.EPOLL_TIMEOUT)
+
+    def poll_events(self, timeout=0):
+        """
+        Waits for edges of input pins and invokes callbacks of changed pins
+
+        @type  timeout: float
+        @param timeout: Max time to wait in seconds, I{0} to dispatch only already pending edges
+        """
+        try:
+            events = self._poll_queue.poll(timeout)
+        except (IOError, OSError) as error:
+            if error.errno != errno.EINTR:
+                Logger.error(repr(error))
+            return
+        if len(events) > 0:
+            self._poll_queue_event(events)
+
+    def fileno(self):
+        """
+        Get the file descriptor of the epoll instance. It becomes readable once any of input pins has pending edge,
+        so event loop might watch it instead of running dedicated thread.
+
+        @rtype: int
+        @return: File descriptor
+        """
+        return self._poll_queue.fileno()
 
     @property
     def available_pins(self):
@@ -278,8 +338,8 @@ class Controller(object):
 
     def alloc_pin(self, number, direction, callback=None, edge=None, active_low=0):
         # TODO: remember which pins we exported and do unexport later
-        Logger.debug('SysfsGPIO: alloc_pin(%d, %s, %s, %s, %s)'
-                     % (number, direction, callback, edge, active_low))
+        Logger.debug('SysfsGPIO: alloc_pin(%d, %s, %s, %s, %s)',
+                     number, direction, callback, edge, active_low)
 
         self._check_pin_validity(number)
 
@@ -294,7 +354,7 @@ class Controller(object):
             with open(SYSFS_EXPORT_PATH, 'w') as export:
                 export.write('%d' % number)
         else:
-            Logger.debug("SysfsGPIO: Pin %d already exported" % number)
+            Logger.debug("SysfsGPIO: Pin %d already exported", number)
 
         pin = Pin(number, direction, callback, edge, active_low)
 
@@ -307,13 +367,15 @@ class Controller(object):
     def _poll_queue_register_pin(self, pin):
         ''' Pin responds to fileno(), so it's pollable. '''
         self._poll_queue.register(pin, (select.EPOLLPRI | select.EPOLLET))
+        self._pins_by_fd[pin.fileno()] = pin
 
     def _poll_queue_unregister_pin(self, pin):
         self._poll_queue.unregister(pin)
+        self._pins_by_fd.pop(pin.fileno(), None)
 
     def dealloc_pin(self, number):
 
-        Logger.debug('SysfsGPIO: dealloc_pin(%d)' % number)
+        Logger.debug('SysfsGPIO: dealloc_pin(%d)', number)
 
         if number not in self._allocated_pins:
             raise Exception('Pin %d not allocated' % number)
@@ -326,17 +388,18 @@ class Controller(object):
         if pin.direction is INPUT:
             self._poll_queue_unregister_pin(pin)
 
+        pin.close()
         del pin, self._allocated_pins[number]
 
     def get_pin(self, number):
 
-        Logger.debug('SysfsGPIO: get_pin(%d)' % number)
+        Logger.debug('SysfsGPIO: get_pin(%d)', number)
 
         return self._allocated_pins[number]
 
     def set_pin(self, number):
 
-        Logger.debug('SysfsGPIO: set_pin(%d)' % number)
+        Logger.debug('SysfsGPIO: set_pin(%d)', number)
 
         if number not in self._allocated_pins:
             raise Exception('Pin %d not allocated' % number)
@@ -345,7 +408,7 @@ class Controller(object):
 
     def reset_pin(self, number):
 
-        Logger.debug('SysfsGPIO: reset_pin(%d)' % number)
+        Logger.debug('SysfsGPIO: reset_pin(%d)', number)
 
         if number not in self._allocated_pins:
             raise Exception('Pin %d not allocated' % number)
@@ -354,20 +417,13 @@ class Controller(object):
 
     def get_pin_state(self, number):
 
-        Logger.debug('SysfsGPIO: get_pin_state(%d)' % number)
+        Logger.debug('SysfsGPIO: get_pin_state(%d)', number)
 
         if number not in self._allocated_pins:
             raise Exception('Pin %d not allocated' % number)
 
-        pin = self._allocated_pins[number]
-
-        if pin.direction == INPUT:
-            self._poll_queue_unregister_pin(pin)
-
-        val = pin.read()
-
-        if pin.direction == INPUT:
-            self._poll_queue_register_pin(pin)
+        # Reading value doesn't consume edge-triggered events, so pin stays registered in epoll
+        val = self._allocated_pins[number].read()
 
         if val <= 0:
             return False
@@ -385,13 +441,9 @@ class Controller(object):
             if not (event & (select.EPOLLPRI | select.EPOLLET)):
                 continue
 
-            try:
-                values = self._allocated_pins.itervalues()
-            except AttributeError:
-                values = self._allocated_pins.values()
-            for pin in values:
-                if pin.fileno() == fd:
-                    pin.changed(pin.read())
+            pin = self._pins_by_fd.get(fd)
+            if pin is not None:
+                pin.changed(pin.read())
 
     def _check_pin_already_exported(self, number):
         """
@@ -423,34 +475,143 @@ class Controller(object):
 
 
 class SysfsGPIODriver(GPIODriver):
+    """
+    Every access to sysfs is a syscall, so channels go through the shadow register: inputs are read at most once
+    per tick or not read at all if pin reports edges, writes to outputs are applied once per tick and only if they
+    change the level.
+    """
 
     class SysfsChannel(GPIODriver.Channel):
 
-        def __init__(self, pin: Pin):
+        def __init__(self, driver, pin: Pin):
+            """
+            :type driver: SysfsGPIODriver
+            """
             super().__init__()
+            self.__driver = driver
             self.__pin = pin
+            self.__read_pin = pin.read
+            self.__subscribers = []  # type: List[Callable]
 
         def write(self, state: [int, bool]):
-            if state:
-                self.__pin.set()
-            else:
-                self.__pin.reset()
+            self.__driver.shadow.write(self.__pin.number, 1 if state else 0)
+
+        @property
+        def pin(self) -> Pin:
+            return self.__pin
 
         def mode(self):
             return GPIODriver.GPIO_MODE_READ if self.__pin.direction == INPUT else GPIODriver.GPIO_MODE_WRITE
 
-        def read(self) -> int:
-            return self.__pin.read()
+        def read(self, reverse=False) -> int:
+            if self.__pin.direction == INPUT:
+                value = self.__driver.shadow.read(self.__pin.number, self.__read_pin)
+            else:
+                value = self.__driver.shadow.read_output(self.__pin.number, self.__read_pin)
+            return value ^ 1 if reverse else value
+
+        def subscribe(self, callback: Callable) -> bool:
+            if self.__pin.direction != INPUT:
+                return False
+            if not self.__subscribers:
+                self.__pin.edge = BOTH
+                self.__pin.callback = self.__on_changed
+            self.__subscribers.append(callback)
+            self.__driver.ensure_edge_source()
+            return True
+
+        def unsubscribe(self, callback: Callable):
+            if callback in self.__subscribers:
+                self.__subscribers.remove(callback)
+            if not self.__subscribers:
+                self.__pin.callback = None
+                self.__driver.shadow.forget(self.__pin.number)  # Level is no longer maintained by edges
+
+        def __on_changed(self, number, state):
+            timestamp = utils.capture_time()
+            self.__driver.shadow.update(number, state)
+            for callback in self.__subscribers:
+                try:
+                    callback(state, timestamp)
+                except Exception as e:
+                    Logger.error('SysfsGPIO: edge callback of pin %d failed: %s', number, e)
+
+    class SysfsLineGroup(GPIODriver.LineGroup):
+        """
+        Sysfs exposes every line as separate file, so lines can't be accessed atomically. Group accesses lines
+        through the shadow register bypassing per-channel dispatch.
+        """
+
+        def __init__(self, driver, channels: list):
+            """
+            :type driver: SysfsGPIODriver
+            """
+            super().__init__(channels)
+            self.__driver = driver
+            self.__lines = [(channel.pin.number, channel.pin.read, channel.pin.direction == INPUT)
+                            for channel in channels]
+
+        def read(self, reverse=False) -> List[int]:
+            shadow = self.__driver.shadow
+            levels = [shadow.read(number, read_pin) if is_input else shadow.read_output(number, read_pin)
+                      for number, read_pin, is_input in self.__lines]
+            return [level ^ 1 for level in levels] if reverse else levels
+
+        def write(self, states: List[int]):
+            if len(states) != len(self.__lines):
+                raise ValueError('Expected {} states, got {}'.format(len(self.__lines), len(states)))
+            shadow = self.__driver.shadow
+            for line, state in zip(self.__lines, states):
+                shadow.write(line[0], 1 if state else 0)
 
     def __init__(self):
         super().__init__()
         self.__gpio_controller = Controller()
+        self.__application = None
+        self.__edge_source = None  # Thread or watched descriptor dispatching edges of input pins
+        self.__lock = threading.Lock()
+        # Writes are applied immediately until driver is attached to application which flushes them once per tick
+        self.shadow = GPIODriver.ShadowRegister(self.__write_pin)
 
     def on_initialized(self, application):
+        self.__application = application
+        if application is not None:
+            self.shadow = GPIODriver.ShadowRegister(self.__write_pin, application, driver='sysfs')
         self.__gpio_controller.available_pins = [1, 2, 3, 4, 6, 12] # TODO: This should be in params
 
+    def on_before_unloaded(self, application):
+        if self.__edge_source is self.__gpio_controller:
+            application.unwatch_fd(self.__gpio_controller)
+        self.__edge_source = None
+
+    def ensure_edge_source(self):
+        """
+        Starts dispatching edges of input pins once the first channel is subscribed. Application event loop watches
+        epoll descriptor if runtime supports it, otherwise edges are dispatched by dedicated thread
+        """
+        with self.__lock:
+            if self.__edge_source is not None:
+                return
+            controller = self.__gpio_controller
+            if self.__application.supports_fd_watching():
+                self.__application.watch_fd(controller, controller.poll_events)
+                self.__edge_source = controller
+            else:
+                self.__edge_source = self.__application.thread_manager.request_dedicated_thread(
+                    'SysfsGPIOEdges', controller.poll_events, [controller.EPOLL_TIMEOUT])
+
     def new_channel(self, pin: [str, int], direction: int, pullup=True) -> SysfsChannel:
         pin = self.__gpio_controller.alloc_pin(pin, (INPUT if SysfsGPIODriver.GPIO_MODE_READ == direction else OUTPUT))
-        return SysfsGPIODriver.SysfsChannel(pin)
+        return SysfsGPIODriver.SysfsChannel(self, pin)
 
+    def new_line_group(self, channels: List[SysfsChannel]) -> SysfsLineGroup:
+        for channel in channels:
+            if not isinstance(channel, SysfsGPIODriver.SysfsChannel):
+                raise ValueError('Channel {} is not created by sysfs GPIO driver'.format(channel))
+        return SysfsGPIODriver.SysfsLineGroup(self, channels)
 
+    def __write_pin(self, number: int, level: int):
+        if level:
+            self.__gpio_controller.set_pin(number)
+        else:
+            self.__gpio_controller.reset_pin(number)